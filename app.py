@@ -6,61 +6,173 @@ Here we have all the lambda definitions and Gateway calls
 @mail: eduard@iot-partners.com
 """
 
-from chalice import Chalice, NotFoundError, Response, BadRequestError
-import json
+from chalice import Chalice, NotFoundError, Response, BadRequestError, Rate
 import os
-import boto3
 import logging
+import functools
+import time
+from chalicelib import clients
 from chalicelib.server import Server
+from chalicelib.publisher import BatchPublisher
+from chalicelib.dedup import Deduplicator
+from chalicelib.alarms import AlarmTracker
+from chalicelib.latest import LatestState, MAX_DEVICES
+from chalicelib.geofence import GeofenceEngine
+from chalicelib.rules import RuleEngine, load_rules
+from chalicelib.deadletter import DeadLetterSink, STORE, PARSE
+from chalicelib.rollups import RollupStore, RESOLUTIONS, DEFAULT_SPANS
+from chalicelib import bulk
+from chalicelib import query
+from chalicelib import serialization
+from chalicelib.metrics import Metrics, PayloadSampler
 
 app = Chalice(app_name='platform')
 
-app.log.setLevel(logging.DEBUG)
-app.debug = True
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+app.log.setLevel(getattr(logging, LOG_LEVEL) if LOG_LEVEL in LOG_LEVELS else logging.INFO)
+if LOG_LEVEL not in LOG_LEVELS:
+    app.log.warning("Unknown LOG_LEVEL %s, using INFO", LOG_LEVEL)
+app.debug = os.getenv('APP_DEBUG', 'false') == 'true'
 
 DEVICE_DATA_TABLE = os.getenv('APP_TABLE_NAME', 'defaultTable')
 DEVICE_TABLE = os.getenv('DEVICES_TABLE_NAME', 'defaultTable')
 SNS_TOPIC = os.getenv('SNS_TOPIC', 'defaultSNS')
+# "fused" persists, decodes and evaluates alarms in realtime_lambda_function, "two_stage" goes through PayloadParser
+PIPELINE_MODE = os.getenv('PIPELINE_MODE', 'two_stage')
+# Table keyed on virtual_tx, with TTL on "expires", shared by all the containers to drop duplicated uplinks
+DEDUP_TABLE = os.getenv('DEDUP_TABLE_NAME')
+DEDUP_TTL = int(os.getenv('DEDUP_TTL', '300'))
+# Table keyed on alarm_id that keeps the alarm state of every device between containers
+ALARM_TABLE = os.getenv('ALARM_TABLE_NAME')
+ALARM_RENOTIFY_INTERVAL = int(os.getenv('ALARM_RENOTIFY_INTERVAL', '86400'))
+# Table keyed on DevEUI with the last position, keep alive and time seen of every device
+LATEST_TABLE = os.getenv('LATEST_TABLE_NAME')
+# Table keyed on bucket ("DevEUI#hour" or "DevEUI#day") and start with the rollups of every device
+ROLLUP_TABLE = os.getenv('ROLLUP_TABLE_NAME')
+# Table keyed on fence_id with the polygons, and table keyed on DevEUI with the fences every device is in
+GEOFENCE_TABLE = os.getenv('GEOFENCE_TABLE_NAME')
+GEOFENCE_STATE_TABLE = os.getenv('GEOFENCE_STATE_TABLE_NAME')
+# JSON list of alarm rules, see chalicelib/rules.py, the low voltage rule is used without it
+ALARM_RULES_FILE = os.getenv('ALARM_RULES_FILE')
+# Records that still fail after the retries are published to DEAD_LETTER_TOPIC and are sent again with
+# replay_dead_letters.py. Without it the invocation fails and SNS delivers the whole event again
+DEAD_LETTER_TOPIC = os.getenv('DEAD_LETTER_TOPIC')
+# "compact" stores extra compressed and virtual_tx as bytes, the reads handle both encodings
+STORAGE_ENCODING = os.getenv('STORAGE_ENCODING', 'plain')
+# Fraction of the received payloads that are logged, 0 turns payload logging off
+PAYLOAD_LOG_SAMPLE_RATE = float(os.getenv('PAYLOAD_LOG_SAMPLE_RATE', '0'))
 
-device_data_table = boto3.resource('dynamodb').Table(DEVICE_DATA_TABLE)
-device_table = boto3.resource('dynamodb').Table(DEVICE_TABLE)
+metrics = Metrics()
+payload_sampler = PayloadSampler(app.log, PAYLOAD_LOG_SAMPLE_RATE)
 
-sns_client = boto3.client('sns')
+_server = None
 
-server = Server(device_data_table, device_table, sns_client, app.log)
+
+# The AWS clients are built on the first call that needs them, so index() and cold starts don't pay for them
+def get_server():
+    global _server
+    if _server is None:
+        sns_client = clients.sns_client()
+        publisher = BatchPublisher(sns_client, app.log)
+        dedup_table = clients.dynamodb_table(DEDUP_TABLE) if DEDUP_TABLE else None
+        deduplicator = Deduplicator(app.log, dedup_table, DEDUP_TTL)
+        alarm_table = clients.dynamodb_table(ALARM_TABLE) if ALARM_TABLE else None
+        alarms = AlarmTracker(app.log, alarm_table, ALARM_RENOTIFY_INTERVAL)
+        latest = LatestState(clients.dynamodb_table(LATEST_TABLE), app.log) if LATEST_TABLE else None
+        rollups = RollupStore(clients.dynamodb_table(ROLLUP_TABLE), app.log) if ROLLUP_TABLE else None
+        rules = RuleEngine(load_rules(ALARM_RULES_FILE)) if ALARM_RULES_FILE else None
+        geofences = None
+        if GEOFENCE_TABLE:
+            state_table = clients.dynamodb_table(GEOFENCE_STATE_TABLE) if GEOFENCE_STATE_TABLE else None
+            geofences = GeofenceEngine(app.log, fence_table=clients.dynamodb_table(GEOFENCE_TABLE),
+                                       state_table=state_table)
+        dead_letters = DeadLetterSink(app.log, sns_client=sns_client, topic_arn=DEAD_LETTER_TOPIC) \
+            if DEAD_LETTER_TOPIC else None
+        _server = Server(clients.dynamodb_table(DEVICE_DATA_TABLE), clients.dynamodb_table(DEVICE_TABLE),
+                         sns_client, app.log, publisher=publisher, deduplicator=deduplicator, alarms=alarms,
+                         metrics=metrics, latest=latest, rollups=rollups, compact=STORAGE_ENCODING == 'compact',
+                         geofences=geofences, rules=rules, dead_letters=dead_letters)
+    return _server
+
+
+# Every invocation emits its stage timings and counters as one EMF record
+def emits_metrics(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        finally:
+            metrics.flush(function.__name__)
+    return wrapper
+
+
+# Messages that can not be decoded go to the dead letters instead of failing the rest of the event
+def load_messages(server, event, stage):
+    messages = []
+    raw_messages = []
+    with metrics.timer("parse"):
+        for record in event["Records"]:
+            raw_message = record["Sns"]["Message"]
+            try:
+                messages.append(serialization.loads(raw_message))
+            except ValueError as e:
+                if server.dead_letters is None:
+                    raise
+                server.dead_letters.add(stage, raw_message, e)
+                continue
+            raw_messages.append(raw_message)
+    return messages, raw_messages
 
 
 @app.lambda_function()
+@emits_metrics
 def realtime_lambda_function(event, context):
     app.log.debug("This is the new call from the Lambda realtime")
+    server = get_server()
 
-    for record in event["Records"]:
-        message = record["Sns"]["Message"]
-        message_dic = json.loads(message)
-        print("This is the SNS message! " + message_dic["DevEUI"])
-        server.persist_data(message_dic)
-        server.publish_data_payload_parser(message_dic)
+    messages, raw_messages = load_messages(server, event, STORE)
+    stats = server.store_events(messages, raw_messages, PIPELINE_MODE == 'fused')
+    server.flush_published()
+    app.log.debug("Persisted %s items with %s retries", stats["items"], stats["retries"])
 
     app.log.debug("realtime lambda done")
     return "worked"
 
 
 @app.lambda_function()
+@emits_metrics
 def realtime_parsing_payload(event, context):
     app.log.debug("Parsing payload")
+    server = get_server()
 
-    for record in event["Records"]:
-        message = record["Sns"]["Message"]
-        message_dic = json.loads(message)
-        parsed = Server.parse_payload(message_dic)
-        virtual_tx = message_dic["virtual_tx"]
-        server.dispatch_alarm(virtual_tx, parsed)
-        server.update_data(parsed)
+    messages, _ = load_messages(server, event, PARSE)
+    server.parse_events(messages)
+    server.flush_published()
 
     app.log.debug("Parsing payload done")
     return "worked"
 
 
+# Keep alives that never arrived can only be found from the last one of every device
+@app.schedule(Rate(1, unit=Rate.HOURS))
+@emits_metrics
+def check_overdue_keep_alives(event):
+    if not LATEST_TABLE:
+        return "disabled"
+    server = get_server()
+    table = clients.dynamodb_table(LATEST_TABLE)
+    arguments = {}
+    while True:
+        response = table.scan(**arguments)
+        server.check_overdue(response.get("Items", []), int(time.time() * 1000))
+        if not response.get("LastEvaluatedKey"):
+            break
+        arguments["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    server.flush_published()
+    return "worked"
+
+
 @app.route('/')
 def index():
     print("print: This call is from the API Gateway")
@@ -70,13 +182,17 @@ def index():
 
 
 @app.route('/lora', methods=['POST', 'PUT'])
+@emits_metrics
 def lora():
     try:
         request = app.current_request
-        app.log.debug(request.json_body)
-        parsed_json = Server.parse_lora_json(request.json_body["body"])
-        app.log.debug("Received event virtual_tx:" + parsed_json["virtual_tx"])
-        server.publish_data_store_device(parsed_json)
+        payload_sampler.log_payload("Received LORA document", request.json_body)
+        with metrics.timer("parse"):
+            parsed_json = Server.parse_lora_json(request.json_body["body"])
+        app.log.debug("Received event virtual_tx:%s", parsed_json["virtual_tx"])
+        server = get_server()
+        if not server.is_duplicate(parsed_json):
+            server.publish_accepted([parsed_json])
         return parsed_json
     except KeyError:
             app.log.error("Error parsing LORA document")
@@ -84,14 +200,105 @@ def lora():
 
 
 @app.route('/sigfox')
+@emits_metrics
 def sigfox():
     try:
-        parsed_dic = Server.parse_sigfox_dic(app.current_request.to_dict())
-        app.log.debug("Received event virtual_tx:" + parsed_dic["virtual_tx"])
-        server.publish_data_store_device(parsed_dic)
+        request_dic = app.current_request.to_dict()
+        payload_sampler.log_payload("Received SIGFOX document", request_dic["query_params"])
+        with metrics.timer("parse"):
+            parsed_dic = Server.parse_sigfox_dic(request_dic)
+        app.log.debug("Received event virtual_tx:%s", parsed_dic["virtual_tx"])
+        server = get_server()
+        if not server.is_duplicate(parsed_dic):
+            server.publish_accepted([parsed_dic])
         return Response(body='',
                         status_code=200,
                         headers={'Content-Type': 'text/plain'})
     except KeyError:
         app.log.error("Error parsing SIGFOX document")
         raise BadRequestError("Error parsing SIGFOX document")
+
+
+BULK_CONTENT_TYPES = ['application/json', 'application/x-ndjson', 'text/plain']
+
+
+@app.route('/lora/batch', methods=['POST'], content_types=BULK_CONTENT_TYPES)
+@emits_metrics
+def lora_batch():
+    return ingest_batch(bulk.parse_lora_record)
+
+
+@app.route('/sigfox/batch', methods=['POST'], content_types=BULK_CONTENT_TYPES)
+@emits_metrics
+def sigfox_batch():
+    return ingest_batch(bulk.parse_sigfox_record)
+
+
+def ingest_batch(parse):
+    try:
+        records = bulk.split_records(app.current_request.raw_body)
+    except bulk.BulkBodyError as e:
+        app.log.error("Error parsing batch: %s", e)
+        raise BadRequestError(str(e))
+
+    with metrics.timer("ingest"):
+        report = bulk.ingest_records(get_server(), records, parse)
+    app.log.debug("Batch accepted %s of %s uplinks", report["accepted"], report["received"])
+    return report
+
+
+# Reads only need the DeviceData table, not the SNS clients of get_server()
+@app.route('/devices/{dev_eui}/data')
+def device_data(dev_eui):
+    try:
+        return query.query_from_params(clients.dynamodb_table(DEVICE_DATA_TABLE), dev_eui,
+                                       app.current_request.query_params)
+    except query.QueryError as e:
+        raise BadRequestError(str(e))
+
+
+def latest_state():
+    if not LATEST_TABLE:
+        raise NotFoundError("The latest state view is not enabled")
+    return LatestState(clients.dynamodb_table(LATEST_TABLE), app.log)
+
+
+# GET takes ?ids=A,B,C, POST a JSON list of DevEUIs for fleets that don't fit in a URL
+@app.route('/devices/latest', methods=['GET', 'POST'])
+def devices_latest():
+    request = app.current_request
+    if request.method == 'POST':
+        dev_euis = request.json_body
+    else:
+        dev_euis = (request.query_params or {}).get('ids', '').split(',')
+    if not isinstance(dev_euis, list) or not all(isinstance(dev_eui, str) for dev_eui in dev_euis):
+        raise BadRequestError("Expected a list of DevEUIs")
+    dev_euis = [dev_eui for dev_eui in dev_euis if dev_eui]
+    if not dev_euis or len(dev_euis) > MAX_DEVICES:
+        raise BadRequestError("Between 1 and " + str(MAX_DEVICES) + " DevEUIs are required")
+    return query.plain(latest_state().get_many(dev_euis))
+
+
+@app.route('/devices/{dev_eui}/latest')
+def device_latest(dev_eui):
+    item = latest_state().get(dev_eui)
+    if item is None:
+        raise NotFoundError("Unknown device " + dev_eui)
+    return query.plain(item)
+
+
+@app.route('/devices/{dev_eui}/rollups')
+def device_rollups(dev_eui):
+    if not ROLLUP_TABLE:
+        raise NotFoundError("Rollups are not enabled")
+    params = app.current_request.query_params or {}
+    resolution = params.get('resolution', 'hour')
+    if resolution not in RESOLUTIONS:
+        raise BadRequestError("resolution must be hour or day")
+    try:
+        end = query.parse_timestamp(params.get('to'), int(time.time() * 1000))
+        start = query.parse_timestamp(params.get('from'), end - DEFAULT_SPANS[resolution])
+        buckets = RollupStore(clients.dynamodb_table(ROLLUP_TABLE), app.log).query(dev_eui, resolution, start, end)
+    except query.QueryError as e:
+        raise BadRequestError(str(e))
+    return {"resolution": resolution, "buckets": query.plain(buckets)}
@@ -0,0 +1,112 @@
+"""
+Alarm state per device and alarm type, so notifications follow state changes
+instead of the message rate. An alarm is raised once, stays active without
+notifying until the re-notify interval passes, and is cleared only when the
+value is back past the hysteresis band.
+
+With a table, a state is only saved over the version it was read from. When another
+container changed it meanwhile, that container sent the notification and this one
+drops its copy and reads it again next time.
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+import time
+
+from chalicelib.dedup import TTLCache
+from chalicelib.retry import conditional_check_failed
+
+RAISED = "raised"
+STILL_ACTIVE = "still_active"
+CLEARED = "cleared"
+
+ACTIVE = "active"
+INACTIVE = "inactive"
+
+
+class AlarmTracker:
+    # table is optional, keyed on alarm_id, it keeps the state between containers. The states are cached
+    # for state_ttl seconds
+    def __init__(self, log, table=None, renotify_interval=86400, state_ttl=300, max_states=10000):
+        self.log = log
+        self.table = table
+        self.renotify_interval = renotify_interval
+        self.states = TTLCache(max_states, state_ttl)
+        self.stats = {RAISED: 0, STILL_ACTIVE: 0, CLEARED: 0, "notified": 0, "suppressed": 0, "conflicts": 0}
+
+    # triggered: the value is in alarm, recovered: the value is out of the hysteresis band.
+    # Returns (transition, notify), transition is None when nothing changed
+    def update(self, dev_eui, alarm_type, triggered, recovered, value=None, now=None):
+        now = time.time() if now is None else now
+        alarm_id = dev_eui + "#" + alarm_type
+        state = self._load(alarm_id)
+        read_version = state["version"]
+
+        if state["state"] == ACTIVE:
+            if recovered:
+                transition, notify = CLEARED, True
+                state = {"alarm_id": alarm_id, "state": INACTIVE, "since": now, "notified_at": now}
+            else:
+                transition = STILL_ACTIVE
+                notify = now - state["notified_at"] >= self.renotify_interval
+                if notify:
+                    state = dict(state, notified_at=now)
+        elif triggered:
+            transition, notify = RAISED, True
+            state = {"alarm_id": alarm_id, "state": ACTIVE, "since": now, "notified_at": now}
+        else:
+            return None, False
+
+        if value is not None:
+            state["value"] = str(value)
+        if (transition != STILL_ACTIVE or notify) and not self._save(alarm_id, state, read_version):
+            self.stats["conflicts"] += 1
+            return None, False
+        self.stats[transition] += 1
+        self.stats["notified" if notify else "suppressed"] += 1
+        return transition, notify
+
+    # A state that could not be read is taken as inactive, but it is not cached, and its version is unknown
+    # so saving it only succeeds when no other container saved one
+    def _load(self, alarm_id):
+        state = self.states.get(alarm_id)
+        if state is not None:
+            return state
+        if self.table is not None:
+            try:
+                state = self.table.get_item(Key={"alarm_id": alarm_id}).get("Item")
+            except Exception as e:
+                self.log.error("Alarm state %s not read: %s", alarm_id, e)
+                return {"alarm_id": alarm_id, "state": INACTIVE, "version": 0}
+        if state is not None:
+            state = dict(state, since=float(state["since"]), notified_at=float(state["notified_at"]),
+                         version=int(state.get("version", 0)))
+        else:
+            state = {"alarm_id": alarm_id, "state": INACTIVE, "version": 0}
+        self.states.add(alarm_id, state)
+        return state
+
+    # False when another container saved a newer version. Other errors are logged and the state is kept in
+    # the cache, so the alarm is still debounced in this container
+    def _save(self, alarm_id, state, read_version):
+        state["version"] = read_version + 1
+        if self.table is not None:
+            # Items saved before the states had a version have none either
+            condition = {"ConditionExpression": "attribute_not_exists(#v)",
+                         "ExpressionAttributeNames": {"#v": "version"}}
+            if read_version > 0:
+                condition.update({"ConditionExpression": "#v = :version",
+                                  "ExpressionAttributeValues": {":version": read_version}})
+            # DynamoDB does not take floats
+            item = dict(state, since=int(state["since"]), notified_at=int(state["notified_at"]))
+            try:
+                self.table.put_item(Item=item, **condition)
+            except Exception as e:
+                if conditional_check_failed(e):
+                    self.states.discard(alarm_id)
+                    return False
+                self.log.error("Alarm state %s not saved: %s", alarm_id, e)
+        self.states.add(alarm_id, state)
+        return True
@@ -0,0 +1,276 @@
+"""
+Reprocessing of the stored DeviceData items after a decoder changes. The table is read
+with a parallel Scan, the payloads of every page are decoded in a process pool, and
+only the items whose decoded attributes changed are written back, one coalesced
+update per item, within the given read and write capacity. The payloads of the
+default GEO and keep alive codecs are decoded by columns with batch_decoder.
+
+Every segment saves its position in the checkpoint after a page is written, so an
+interrupted run goes on from there. Pages are written again at most once, and the
+updates are SETs, so that is harmless.
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from chalicelib import batch_decoder
+from chalicelib.coalescer import UpdateCoalescer
+from chalicelib.payload_codecs import decode_geo, decode_keep_alive
+from chalicelib.query import plain, projection
+from chalicelib.retry import AdaptiveRetry, chunks, sleep
+from chalicelib.server import CODECS, Server
+
+SCAN_SEGMENTS = 4
+# Items per Scan page, a page is decoded, written and checkpointed at once
+PAGE_SIZE = 1000
+# Payloads sent to a worker process at once
+DECODE_BATCH_SIZE = 250
+
+# Read with the attributes of the codecs, which are compared with what the decoder returns now
+SCAN_FIELDS = ["DevEUI", "timeStamp", "payload", "model"]
+
+
+class RateLimiter:
+    # Capacity units per second shared by the segment threads. A call waits while the units are spent,
+    # and what it consumed is charged afterwards, as DynamoDB only tells it in the response
+    def __init__(self, units_per_second):
+        self.units_per_second = float(units_per_second) if units_per_second else None
+        self.available = self.units_per_second or 0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.units_per_second, self.available + (now - self.updated) * self.units_per_second)
+        self.updated = now
+
+    def wait(self):
+        if self.units_per_second is None:
+            return
+        while True:
+            with self.lock:
+                self._refill()
+                if self.available > 0:
+                    return
+                missing = -self.available + 1
+            sleep(missing / self.units_per_second)
+
+    def spend(self, units):
+        if self.units_per_second is None:
+            return
+        with self.lock:
+            self._refill()
+            self.available -= units
+
+
+def consumed_units(response, default=1.0):
+    return float(response.get("ConsumedCapacity", {}).get("CapacityUnits", default)) if response else default
+
+
+# The codecs batch_decoder gives the same values as, while they are the ones registered
+COLUMNAR_DECODERS = {batch_decoder.GEO_PACKET_ID: decode_geo, batch_decoder.KEEP_ALIVE_PACKET_ID: decode_keep_alive}
+
+
+# Runs in the worker processes, items are (DevEUI, timeStamp, payload, codec or model). The payloads of
+# the default GEO and keep alive codecs are decoded together, the ones of the other codecs one by one
+def decode_items(items):
+    decoded = [{}] * len(items)
+    columnar = []
+    for position, (dev_eui, time_stamp, payload, model) in enumerate(items):
+        codec = CODECS.lookup(payload[:2], model)
+        if codec is not None and COLUMNAR_DECODERS.get(codec.packet_id) is codec.decode:
+            columnar.append(position)
+            continue
+        parsed = Server.parse_payload({"DevEUI": dev_eui, "timeStamp": time_stamp, "payload": payload}, model)
+        if parsed is not None:
+            decoded[position] = Server.parsed_attributes(parsed)
+
+    batch = batch_decoder.decode_batch([items[position][2] for position in columnar])
+    attributes = CODECS.attributes()
+    geo, keep_alive = batch["GEO"], batch["KA"]
+    # float() first, so the strings are the ones the scalar decoders build
+    for row, index in enumerate(geo["index"]):
+        decoded[columnar[index]] = {attributes["GEO"]: {"lat": str(float(geo["lat"][row])),
+                                                        "lng": str(float(geo["lng"][row]))}}
+    for row, index in enumerate(keep_alive["index"]):
+        decoded[columnar[index]] = {attributes["KA"]: {"interval": str(int(keep_alive["interval"][row])),
+                                                       "voltage": str(float(keep_alive["voltage"][row]))}}
+    return decoded
+
+
+# The decoded attributes that are not stored with the same value
+def changes(item, attributes):
+    return dict((name, value) for name, value in attributes.items() if plain(item.get(name)) != value)
+
+
+class Checkpoint:
+    # The LastEvaluatedKey of every segment, "done" when the segment is finished. Without a path
+    # nothing is saved
+    def __init__(self, path, segments):
+        self.path = path
+        self.segments = segments
+        self.positions = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path) as checkpoint:
+                saved = json.load(checkpoint)
+            if saved["segments"] != segments:
+                raise ValueError("The checkpoint was made with %d segments" % saved["segments"])
+            self.positions = dict((int(segment), position) for segment, position in saved["positions"].items())
+            self.stats = saved.get("stats", {})
+
+    def position(self, segment):
+        return self.positions.get(segment)
+
+    # stats is a copy the caller took, the checkpoint keeps it as it is
+    def save(self, segment, last_key, stats):
+        with self.lock:
+            self.positions[segment] = plain(last_key) if last_key else "done"
+            self.stats = stats
+            if self.path is None:
+                return
+            saved = self.path + ".tmp"
+            with open(saved, "w") as checkpoint:
+                json.dump({"segments": self.segments, "positions": self.positions, "stats": self.stats}, checkpoint)
+            os.replace(saved, self.path)
+
+
+class Backfill:
+    # registry is optional, the codec or model of every device is used like the Lambdas do, and the
+    # model stored in the item without it. workers is the number of decoding processes, 0 decodes in
+    # the segment threads. read_units and write_units are per second, None doesn't limit them
+    def __init__(self, table, log, registry=None, segments=SCAN_SEGMENTS, workers=None, read_units=None,
+                 write_units=None, checkpoint=None, page_size=PAGE_SIZE, dry_run=False):
+        self.table = table
+        self.log = log
+        self.registry = registry
+        self.segments = segments
+        self.workers = workers
+        self.reads = RateLimiter(read_units)
+        self.writes = RateLimiter(write_units)
+        # A dry run does not move the checkpoint of the real run
+        self.checkpoint = Checkpoint(checkpoint if not dry_run else None, segments)
+        self.page_size = page_size
+        self.dry_run = dry_run
+        self.retry = AdaptiveRetry()
+        self.backoff_base = 0.05
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.stats = dict({"scanned": 0, "decoded": 0, "changed": 0, "written": 0, "read_units": 0.0,
+                           "write_units": 0.0}, **self.checkpoint.stats)
+        self.pool = None
+
+    def run(self):
+        pending = [segment for segment in range(self.segments) if self.checkpoint.position(segment) != "done"]
+        if not pending:
+            return self.stats
+        errors = []
+        interrupted = False
+        self.pool = ProcessPoolExecutor(self.workers) if self.workers != 0 else None
+        threads = [threading.Thread(target=self._run_segment, args=(segment, errors), daemon=True)
+                   for segment in pending]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            # The segments finish the page they are writing and save their position
+            self.log.info("Stopping, the next run goes on from the checkpoint")
+            interrupted = True
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+        if errors and not interrupted:
+            raise errors[0]
+        return self.stats
+
+    def _run_segment(self, segment, errors):
+        # The codecs registered before the run are also read, decode_items decodes with them
+        expression, names = projection(SCAN_FIELDS + sorted(CODECS.attributes().values()))
+        arguments = {"Segment": segment, "TotalSegments": self.segments, "Limit": self.page_size,
+                     "ProjectionExpression": expression, "ExpressionAttributeNames": names,
+                     "ReturnConsumedCapacity": "TOTAL"}
+        if self.checkpoint.position(segment) is not None:
+            arguments["ExclusiveStartKey"] = self.checkpoint.position(segment)
+        try:
+            while not self.stop.is_set():
+                self.reads.wait()
+                response = self.retry.call(self.backoff_base, self.table.scan, **arguments)
+                self.reads.spend(consumed_units(response))
+                self._process(response.get("Items", []), consumed_units(response))
+                last_key = response.get("LastEvaluatedKey")
+                # The other segments update the stats under the same lock
+                with self.lock:
+                    stats = dict(self.stats)
+                self.checkpoint.save(segment, last_key, stats)
+                if not last_key:
+                    break
+                arguments["ExclusiveStartKey"] = last_key
+        except Exception as e:
+            # The other segments stop too, the failed page is read again on the next run
+            self.log.error("Segment %d stopped: %s", segment, e)
+            errors.append(e)
+            self.stop.set()
+
+    def _process(self, page, read_units):
+        items = [item for item in page if item.get("payload")]
+        decoded = self._decode(items)
+        coalescer = UpdateCoalescer(self.table, call=self._write)
+        changed = 0
+        for item, attributes in zip(items, decoded):
+            updates = changes(item, attributes)
+            if updates:
+                changed += 1
+                coalescer.add(item, updates)
+        if not self.dry_run:
+            coalescer.flush()
+        with self.lock:
+            self.stats["scanned"] += len(page)
+            self.stats["decoded"] += sum(1 for attributes in decoded if attributes)
+            self.stats["changed"] += changed
+            self.stats["written"] += coalescer.stats["flushed"]
+            self.stats["read_units"] += read_units
+
+    def _decode(self, items):
+        models = self._models(items)
+        rows = [(item["DevEUI"], plain(item["timeStamp"]), item["payload"],
+                 models.get(item["DevEUI"], item.get("model"))) for item in items]
+        batches = list(chunks(rows, DECODE_BATCH_SIZE))
+        if self.pool is None:
+            results = [decode_items(batch) for batch in batches]
+        else:
+            results = self.pool.map(decode_items, batches)
+        return [attributes for batch in results for attributes in batch]
+
+    def _models(self, items):
+        if self.registry is None:
+            return {}
+        dev_euis = set(item["DevEUI"] for item in items)
+        # The registry cache is not thread safe
+        with self.lock:
+            self.registry.prefetch(dev_euis)
+            devices = dict((dev_eui, self.registry.get(dev_eui)) for dev_eui in dev_euis)
+        return dict((dev_eui, device.get("codec", device.get("model"))) for dev_eui, device in devices.items()
+                    if device.get("codec", device.get("model")) is not None)
+
+    def _write(self, function, **kwargs):
+        self.writes.wait()
+        response = self.retry.call(self.backoff_base, function, ReturnConsumedCapacity="TOTAL", **kwargs)
+        units = consumed_units(response)
+        self.writes.spend(units)
+        with self.lock:
+            self.stats["write_units"] += units
+        return response
@@ -0,0 +1,110 @@
+"""
+Columnar batch decoding of GEO and keep-alive payloads, used by the reprocessing in
+chalicelib/backfill.py. The results are the same floats that extract_lat_long and
+extract_keep_alive return as strings.
+
+NumPy is optional, without it the scalar decoders are used and lists are returned.
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+from chalicelib.server import extract_lat_long, extract_keep_alive
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+GEO_PACKET_ID = "10"
+KEEP_ALIVE_PACKET_ID = "02"
+
+# Bytes read from the start of every packet, packet id included
+GEO_PACKET_BYTES = 7
+KEEP_ALIVE_PACKET_BYTES = 4
+
+
+def group_by_packet_id(payloads):
+    groups = {}
+    for index, payload in enumerate(payloads):
+        groups.setdefault(payload[:2], []).append(index)
+    return groups
+
+
+def decode_batch(payloads):
+    groups = group_by_packet_id(payloads)
+    geo_index = groups.pop(GEO_PACKET_ID, [])
+    ka_index = groups.pop(KEEP_ALIVE_PACKET_ID, [])
+
+    geo = decode_lat_long_batch([payloads[i] for i in geo_index])
+    geo["index"] = _select(geo_index, geo.pop("valid"))
+    keep_alive = decode_keep_alive_batch([payloads[i] for i in ka_index])
+    keep_alive["index"] = _select(ka_index, keep_alive.pop("valid"))
+
+    unknown = sorted(i for indexes in groups.values() for i in indexes)
+    return {"GEO": geo, "KA": keep_alive, "unknown": unknown}
+
+
+def decode_lat_long_batch(payloads):
+    rows, valid = _to_rows(payloads, GEO_PACKET_BYTES)
+    if np is None:
+        decoded = [extract_lat_long(payloads[i]) for i in valid]
+        return {"lat": [float(d["lat"]) for d in decoded], "lng": [float(d["lng"]) for d in decoded],
+                "valid": valid}
+
+    lat_int = (rows[:, 1].astype(np.int64) << 16) | (rows[:, 2].astype(np.int64) << 8) | rows[:, 3]
+    lng_int = (rows[:, 4].astype(np.int64) << 16) | (rows[:, 5].astype(np.int64) << 8) | rows[:, 6]
+    lat = (lat_int.astype(np.float64) * 180) / 16777215 - 90
+    lng = (lng_int.astype(np.float64) * 360) / 16777215 - 180
+    return {"lat": lat, "lng": lng, "valid": valid}
+
+
+def decode_keep_alive_batch(payloads):
+    rows, valid = _to_rows(payloads, KEEP_ALIVE_PACKET_BYTES)
+    if np is None:
+        decoded = [extract_keep_alive(payloads[i]) for i in valid]
+        return {"interval": [int(d["interval"]) for d in decoded],
+                "voltage": [float(d["voltage"]) for d in decoded], "valid": valid}
+
+    interval = rows[:, 1].astype(np.int64)
+    voltage = ((rows[:, 2].astype(np.int64) << 8) | rows[:, 3]).astype(np.float64) / 1000
+    return {"interval": interval, "voltage": voltage, "valid": valid}
+
+
+# Payloads that are too short or not hex are left out, the scalar path returns None for them
+def _to_rows(payloads, width):
+    chars = width * 2
+    valid = [i for i, payload in enumerate(payloads) if len(payload) >= chars]
+    heads = [payloads[i][:chars] for i in valid]
+    try:
+        raw = bytes.fromhex("".join(heads))
+    except ValueError:
+        raw = b""
+    if len(raw) != len(heads) * width:
+        valid, heads = _valid_hex(valid, heads, width)
+        raw = bytes.fromhex("".join(heads))
+
+    if np is None:
+        return None, valid
+    return np.frombuffer(raw, dtype=np.uint8).reshape(len(valid), width), valid
+
+
+def _valid_hex(valid, heads, width):
+    kept_index, kept_heads = [], []
+    for index, head in zip(valid, heads):
+        try:
+            if len(bytes.fromhex(head)) != width:
+                continue
+        except ValueError:
+            continue
+        kept_index.append(index)
+        kept_heads.append(head)
+    return kept_index, kept_heads
+
+
+def _select(indexes, positions):
+    selected = [indexes[i] for i in positions]
+    if np is None:
+        return selected
+    return np.array(selected, dtype=np.int64)
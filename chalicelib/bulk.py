@@ -0,0 +1,80 @@
+"""
+Bulk ingestion of uplinks replayed by network servers after an outage. A request
+body is a JSON array or NDJSON, every record is parsed on its own and the parsing
+errors are reported per record.
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+import json
+from chalicelib.server import Server
+
+MAX_BATCH_RECORDS = 10000
+
+
+class BulkBodyError(ValueError):
+    pass
+
+
+def split_records(raw_body):
+    if isinstance(raw_body, bytes):
+        raw_body = raw_body.decode("utf-8")
+    text = raw_body.strip()
+    if not text:
+        raise BulkBodyError("Empty body")
+
+    if text.startswith("["):
+        try:
+            records = json.loads(text)
+        except ValueError:
+            raise BulkBodyError("Body is not a valid JSON array")
+    else:
+        records = [line for line in text.splitlines() if line.strip()]
+
+    if len(records) > MAX_BATCH_RECORDS:
+        raise BulkBodyError("A batch can not have more than " + str(MAX_BATCH_RECORDS) + " records")
+    return records
+
+
+def load_record(record):
+    if isinstance(record, str):
+        return json.loads(record)
+    return record
+
+
+# The records are either the /lora request document, {"body": "<uplink>"}, or the uplink document itself
+def parse_lora_record(record):
+    record = load_record(record)
+    if "body" in record:
+        return Server.parse_lora_json(record["body"])
+    return Server.parse_lora_json(json.dumps(record))
+
+
+# The records are the /sigfox query parameters: {"time": ..., "id": ..., "data": ...}
+def parse_sigfox_record(record):
+    return Server.parse_sigfox_dic({"query_params": load_record(record)})
+
+
+# When publishing fails the claims of every accepted record are released, so the retry of the whole
+# batch goes through. Records published before the failure are then sent again, downstream writes are keyed
+def ingest_records(server, records, parse):
+    report = {"received": len(records), "accepted": 0, "duplicates": 0, "errors": []}
+    accepted = []
+
+    for index, record in enumerate(records):
+        try:
+            parsed = parse(record)
+        except (KeyError, ValueError, TypeError, AttributeError) as e:
+            report["errors"].append({"index": index, "error": type(e).__name__ + ": " + str(e)})
+            continue
+
+        if server.is_duplicate(parsed):
+            report["duplicates"] += 1
+            continue
+        accepted.append(parsed)
+
+    server.publish_accepted(accepted)
+    report["accepted"] = len(accepted)
+    return report
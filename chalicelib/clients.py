@@ -0,0 +1,88 @@
+"""
+Lazily built AWS clients shared by all the handlers of a Lambda container.
+Nothing is imported or created until the first handler that needs it runs.
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+import os
+import time
+
+MAX_POOL_CONNECTIONS = int(os.getenv('AWS_MAX_POOL_CONNECTIONS', '50'))
+CONNECT_TIMEOUT = float(os.getenv('AWS_CONNECT_TIMEOUT', '2'))
+READ_TIMEOUT = float(os.getenv('AWS_READ_TIMEOUT', '5'))
+
+# Milliseconds spent building every client, reported by the cold start benchmark
+timings = {}
+
+_session = None
+_config = None
+_clients = {}
+_resources = {}
+_tables = {}
+
+
+def _timed(name, build):
+    start = time.perf_counter()
+    built = build()
+    timings[name] = round((time.perf_counter() - start) * 1000, 3)
+    return built
+
+
+def session():
+    global _session
+    if _session is None:
+        def build():
+            import boto3
+            return boto3.session.Session()
+        _session = _timed("session", build)
+    return _session
+
+
+def config():
+    global _config
+    if _config is None:
+        from botocore.config import Config
+        _config = Config(max_pool_connections=MAX_POOL_CONNECTIONS,
+                         connect_timeout=CONNECT_TIMEOUT,
+                         read_timeout=READ_TIMEOUT)
+    return _config
+
+
+def client(service):
+    if service not in _clients:
+        _clients[service] = _timed(service, lambda: session().client(service, config=config()))
+    return _clients[service]
+
+
+def resource(service):
+    if service not in _resources:
+        _resources[service] = _timed(service + "_resource", lambda: session().resource(service, config=config()))
+    return _resources[service]
+
+
+def sns_client():
+    return client('sns')
+
+
+def sqs_client():
+    return client('sqs')
+
+
+def dynamodb_table(name):
+    if name not in _tables:
+        _tables[name] = resource('dynamodb').Table(name)
+    return _tables[name]
+
+
+# Used by the tests and the benchmark to start again from a cold container
+def reset():
+    global _session, _config
+    _session = None
+    _config = None
+    _clients.clear()
+    _resources.clear()
+    _tables.clear()
+    timings.clear()
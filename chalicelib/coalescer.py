@@ -0,0 +1,56 @@
+"""
+Coalesces the attribute updates of an invocation, so every DeviceData key is
+written once with a single merged SET expression
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+
+# Attribute names go through #uN placeholders, a codec attribute can be a reserved word or not an identifier
+def update_expression(attributes):
+    names = dict(("#u%d" % i, name) for i, name in enumerate(sorted(attributes)))
+    expression = "SET " + ", ".join(placeholder + " = :" + placeholder[1:] for placeholder in names)
+    values = dict((":" + placeholder[1:], attributes[name]) for placeholder, name in names.items())
+    return expression, names, values
+
+
+class UpdateCoalescer:
+    # return_values is only sent to DynamoDB when somebody is going to read the response, call wraps
+    # every update_item, for the retries
+    def __init__(self, table, return_values=None, call=None):
+        self.table = table
+        self.return_values = return_values
+        self.call = call if call is not None else lambda function, **kwargs: function(**kwargs)
+        self.pending = {}
+        self.stats = {"added": 0, "flushed": 0}
+
+    def add(self, key, attributes):
+        if not attributes:
+            return
+        self.pending.setdefault((key["DevEUI"], key["timeStamp"]), {}).update(attributes)
+        self.stats["added"] += 1
+
+    # Without failed, the first update that fails raises. With it, the (DevEUI, timeStamp) of every
+    # failed update and its error are appended and the rest of the keys are still written
+    def flush(self, failed=None):
+        responses = []
+        pending, self.pending = self.pending, {}
+        for (dev_eui, time_stamp), attributes in pending.items():
+            expression, names, values = update_expression(attributes)
+            kwargs = {"Key": {"timeStamp": time_stamp, "DevEUI": dev_eui},
+                      "UpdateExpression": expression,
+                      "ExpressionAttributeNames": names,
+                      "ExpressionAttributeValues": values}
+            if self.return_values is not None:
+                kwargs["ReturnValues"] = self.return_values
+            try:
+                responses.append(self.call(self.table.update_item, **kwargs))
+            except Exception as e:
+                if failed is None:
+                    raise
+                failed.append(((dev_eui, time_stamp), e))
+                continue
+            self.stats["flushed"] += 1
+        return responses
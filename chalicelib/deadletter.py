@@ -0,0 +1,157 @@
+"""
+Dead letters of the SNS triggered Lambdas. A record that still fails after the
+retries is written here with the stage it failed in, instead of failing the whole
+invocation and making SNS deliver the records that worked again. replay sends the
+records through their stage again, once per virtual_tx.
+
+The Lambdas publish them to a topic. drain_queue replays them from an SQS queue
+subscribed to it, and only deletes the messages whose record worked, so the others
+stay in the queue.
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+from collections import OrderedDict
+import time
+
+from chalicelib import serialization
+from chalicelib.retry import chunks
+
+# StoreDeviceData messages, processed by realtime_lambda_function
+STORE = "store"
+# PayloadParser messages, processed by realtime_parsing_payload
+PARSE = "parse"
+STAGES = (STORE, PARSE)
+
+# ReceiveMessage and DeleteMessageBatch take at most 10 messages
+SQS_BATCH_SIZE = 10
+
+
+def describe(error):
+    return type(error).__name__ + ": " + str(error)
+
+
+class DeadLetterSink:
+    # Entries go to the SNS topic when there is one, to the NDJSON file at path otherwise, and stay in
+    # entries without both. Writing them is not retried here, when it fails the invocation fails and
+    # SNS delivers the event again, so nothing is lost
+    def __init__(self, log, path=None, sns_client=None, topic_arn=None):
+        self.log = log
+        self.path = path
+        self.sns_client = sns_client
+        self.topic_arn = topic_arn
+        self.entries = []
+        self.stats = dict((stage, 0) for stage in STAGES)
+
+    # record is the SNS message, decoded, or as it was received when it could not be decoded
+    def add(self, stage, record, error):
+        virtual_tx = record.get("virtual_tx") if isinstance(record, dict) else None
+        entry = {"stage": stage, "virtual_tx": virtual_tx, "error": describe(error),
+                 "failed_at": int(time.time() * 1000), "record": record}
+        self.log.error("Dead letter %s virtual_tx:%s %s", stage, virtual_tx, entry["error"])
+        if self.topic_arn is not None:
+            self.sns_client.publish(TopicArn=self.topic_arn, Subject="Dead letter " + stage,
+                                    Message=serialization.dumps(entry))
+        elif self.path is not None:
+            with open(self.path, "a") as dead_letters:
+                dead_letters.write(serialization.dumps(entry) + "\n")
+        else:
+            self.entries.append(entry)
+        self.stats[stage] += 1
+
+
+def read_dead_letters(stream):
+    return [serialization.loads(line) for line in stream if line.strip()]
+
+
+def write_dead_letters(stream, entries):
+    for entry in entries:
+        stream.write(serialization.dumps(entry) + "\n")
+
+
+def entry_key(entry):
+    return entry["stage"], entry.get("virtual_tx") or serialization.dumps(entry["record"])
+
+
+# The last entry of every stage and virtual_tx, SNS may have delivered a failing record more than once
+def pending(entries):
+    unique = OrderedDict()
+    for entry in entries:
+        key = entry_key(entry)
+        unique.pop(key, None)
+        unique[key] = entry
+    return list(unique.values())
+
+
+# Stored items are written again with the same key and the decoded attributes are SET again, and the
+# alarms, geofences and views of a record only run once its write worked, so a record can be replayed
+# any number of times. Returns the entries that failed again
+def replay(server, entries, fused=False):
+    sink = DeadLetterSink(server.log)
+    for stage in STAGES:
+        messages = []
+        for entry in pending(entries):
+            if entry["stage"] != stage:
+                continue
+            record = entry["record"]
+            try:
+                messages.append(serialization.loads(record) if isinstance(record, str) else record)
+            except ValueError as e:
+                sink.add(stage, record, e)
+        if not messages:
+            continue
+        if stage == STORE:
+            server.store_events(messages, fused=fused, dead_letters=sink)
+        else:
+            server.parse_events(messages, dead_letters=sink)
+    server.flush_published()
+    return sink.entries
+
+
+# The entry of an SQS message, the queue may be subscribed to the topic with or without raw delivery
+def queue_entry(body):
+    message = serialization.loads(body)
+    if message.get("Type") == "Notification" and "Message" in message:
+        message = serialization.loads(message["Message"])
+    return message
+
+
+# Replays the queue in rounds of max_messages until it is empty. The messages of the entries that fail
+# again are left in the queue and come back after visibility_timeout, set a redrive policy to stop them
+# at some point
+def drain_queue(server, sqs_client, queue_url, fused=False, max_messages=100, visibility_timeout=300):
+    stats = {"received": 0, "replayed": 0, "failed": 0, "unreadable": 0}
+    while True:
+        messages = receive(sqs_client, queue_url, max_messages, visibility_timeout)
+        if not messages:
+            return stats
+        stats["received"] += len(messages)
+        entries = []
+        for message in messages:
+            try:
+                entries.append((message, queue_entry(message["Body"])))
+            except (ValueError, AttributeError) as e:
+                server.log.error("Dead letter message %s not read: %s", message.get("MessageId"), e)
+                stats["unreadable"] += 1
+        failed = set(entry_key(entry) for entry in replay(server, [entry for _, entry in entries], fused))
+        done = [message for message, entry in entries if entry_key(entry) not in failed]
+        for chunk in chunks(done, SQS_BATCH_SIZE):
+            sqs_client.delete_message_batch(QueueUrl=queue_url, Entries=[
+                {"Id": str(i), "ReceiptHandle": message["ReceiptHandle"]} for i, message in enumerate(chunk)])
+        stats["replayed"] += len(done)
+        stats["failed"] += len(entries) - len(done)
+
+
+def receive(sqs_client, queue_url, max_messages, visibility_timeout):
+    messages = []
+    while len(messages) < max_messages:
+        response = sqs_client.receive_message(QueueUrl=queue_url, WaitTimeSeconds=1,
+                                              MaxNumberOfMessages=min(SQS_BATCH_SIZE, max_messages - len(messages)),
+                                              VisibilityTimeout=visibility_timeout)
+        received = response.get("Messages", [])
+        if not received:
+            break
+        messages.extend(received)
+    return messages
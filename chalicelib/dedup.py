@@ -0,0 +1,98 @@
+"""
+Duplicate uplink suppression keyed on virtual_tx. LoRa uplinks heard by several
+gateways and Sigfox callback retries share the same virtual_tx, only the first
+one goes through.
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+from collections import OrderedDict
+import time
+
+_MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, max_entries=10000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires < time.time():
+            del self.entries[key]
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    # ttl overrides the one of the cache for this entry
+    def add(self, key, value=True, ttl=None):
+        self.entries[key] = (time.time() + (ttl if ttl is not None else self.ttl), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Deduplicator:
+    # table is optional, without it only this container sees the uplinks already accepted
+    def __init__(self, log, table=None, ttl=300, max_entries=10000):
+        self.log = log
+        self.table = table
+        self.ttl = ttl
+        self.cache = TTLCache(max_entries, ttl)
+        self.stats = {"hits": 0, "remote_hits": 0, "misses": 0, "errors": 0}
+
+    def is_duplicate(self, virtual_tx):
+        if virtual_tx in self.cache:
+            self.stats["hits"] += 1
+            return True
+
+        if self.table is not None and not self._claim(virtual_tx):
+            self.cache.add(virtual_tx)
+            self.stats["remote_hits"] += 1
+            return True
+
+        self.cache.add(virtual_tx)
+        self.stats["misses"] += 1
+        return False
+
+    # Forgets an uplink that could not be published, so the retry of the sender is not dropped
+    def release(self, virtual_tx):
+        self.cache.discard(virtual_tx)
+        if self.table is None:
+            return
+        try:
+            self.table.delete_item(Key={"virtual_tx": virtual_tx})
+        except Exception as e:
+            # The claim expires with the TTL of the table
+            self.log.error("Dedup claim of %s not released: %s", virtual_tx, e)
+            self.stats["errors"] += 1
+
+    # The conditional write fails when another container already accepted the uplink
+    def _claim(self, virtual_tx):
+        try:
+            self.table.put_item(Item={"virtual_tx": virtual_tx, "expires": int(time.time() + self.ttl)},
+                                ConditionExpression="attribute_not_exists(virtual_tx)")
+            return True
+        except Exception as e:
+            if getattr(e, "response", {}).get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+                return False
+            # Never drop an uplink because the dedup table is not reachable
+            self.log.error("Dedup claim of %s failed, accepting the uplink: %s", virtual_tx, e)
+            self.stats["errors"] += 1
+            return True
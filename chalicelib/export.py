@@ -0,0 +1,274 @@
+"""
+Bulk export of DeviceData. Items are streamed from per-device Queries or from a
+parallel Scan, turned into rows with the decoded position and keep alive, and written
+in chunks, so memory only depends on the chunk size and never on the exported range.
+The range is in epoch milliseconds, Sigfox items, stored with epoch seconds, are read
+with the same range in seconds.
+
+Formats:
+    columnar: array-backed binary chunks, read back with read_columnar
+    parquet: one row group per chunk, needs pyarrow
+    ndjson: the items as they are stored, one per line
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+import array
+import json
+import queue
+import struct
+import sys
+import threading
+
+from chalicelib.compact import decode_item, stored_fields
+from chalicelib.query import plain, projection
+from chalicelib.rollups import SECONDS_BEFORE, epoch_millis
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+CHUNK_ROWS = 65536
+SCAN_SEGMENTS = 4
+# Scan pages waiting for the writer, every page is at most 1MB
+MAX_PENDING_PAGES = 8
+
+# Everything but "extra", the rows are built from these
+EXPORT_FIELDS = ["DevEUI", "timeStamp", "type", "geo", "ka"]
+
+# Column name and array typecode, "str" columns are dictionary encoded
+COLUMNS = [("DevEUI", "str"), ("timeStamp", "q"), ("type", "str"),
+           ("lat", "d"), ("lng", "d"), ("interval", "i"), ("voltage", "d")]
+
+MAGIC = b"DDXC"
+VERSION = 1
+CHUNK = b"CHNK"
+NAN = float("nan")
+# interval of the items without keep alive
+NO_INTERVAL = -1
+
+
+# The stored timeStamps of the range, as the placeholders and the bounds of the range in seconds and of
+# the range in milliseconds. They don't overlap, and a range without timeStamps is left out
+def stored_ranges(start, end):
+    ranges = [(":from_s", ":to_s", -(-start // 1000), min(end // 1000, SECONDS_BEFORE - 1)),
+              (":from", ":to", max(start, SECONDS_BEFORE), end)]
+    return [(low, high, first, last) for low, high, first, last in ranges if first <= last]
+
+
+# A key condition can not hold an OR, every device is queried once per range
+def query_items(table, dev_euis, start, end, fields=None):
+    expression, names = projection(stored_fields(fields or EXPORT_FIELDS))
+    names.update({"#k": "DevEUI", "#t": "timeStamp"})
+    for dev_eui in dev_euis:
+        for low, high, first, last in stored_ranges(start, end):
+            arguments = {"KeyConditionExpression": "#k = :dev_eui AND #t BETWEEN " + low + " AND " + high,
+                         "ExpressionAttributeNames": names,
+                         "ExpressionAttributeValues": {":dev_eui": dev_eui, low: first, high: last},
+                         "ProjectionExpression": expression}
+            while True:
+                response = table.query(**arguments)
+                for item in response.get("Items", []):
+                    yield item
+                if not response.get("LastEvaluatedKey"):
+                    break
+                arguments["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+_DONE = object()
+
+
+# Every segment is scanned by its own thread, the pages go through a bounded queue
+def scan_items(table, start, end, fields=None, segments=SCAN_SEGMENTS, max_pending=MAX_PENDING_PAGES):
+    expression, names = projection(stored_fields(fields or EXPORT_FIELDS))
+    names["#t"] = "timeStamp"
+    ranges = stored_ranges(start, end)
+    if not ranges:
+        return
+    conditions = " OR ".join("(#t BETWEEN " + low + " AND " + high + ")" for low, high, _, _ in ranges)
+    values = {}
+    for low, high, first, last in ranges:
+        values.update({low: first, high: last})
+    pages = queue.Queue(max_pending)
+    stop = threading.Event()
+
+    def put(page):
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def scan(segment):
+        arguments = {"Segment": segment, "TotalSegments": segments,
+                     "FilterExpression": conditions,
+                     "ExpressionAttributeNames": names,
+                     "ExpressionAttributeValues": values,
+                     "ProjectionExpression": expression}
+        try:
+            while True:
+                response = table.scan(**arguments)
+                if not put(response.get("Items", [])) or not response.get("LastEvaluatedKey"):
+                    break
+                arguments["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        except Exception as e:
+            put(e)
+        finally:
+            put(_DONE)
+
+    threads = [threading.Thread(target=scan, args=(segment,), daemon=True) for segment in range(segments)]
+    for thread in threads:
+        thread.start()
+    try:
+        finished = 0
+        while finished < segments:
+            page = pages.get()
+            if page is _DONE:
+                finished += 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                for item in page:
+                    yield item
+    finally:
+        # The consumer may stop early, the scanning threads must not stay blocked on the queue
+        stop.set()
+
+
+def to_row(item):
+    geo = item.get("geo") or {}
+    keep_alive = item.get("ka") or {}
+    return (item["DevEUI"], epoch_millis(item["timeStamp"]), item.get("type", ""),
+            float(geo["lat"]) if "lat" in geo else NAN,
+            float(geo["lng"]) if "lng" in geo else NAN,
+            int(keep_alive["interval"]) if "interval" in keep_alive else NO_INTERVAL,
+            float(keep_alive["voltage"]) if "voltage" in keep_alive else NAN)
+
+
+class NdjsonWriter:
+    def __init__(self, stream):
+        self.stream = stream
+        self.rows = 0
+
+    def write(self, item):
+        self.stream.write((json.dumps(plain(decode_item(item)), separators=(",", ":")) + "\n").encode())
+        self.rows += 1
+
+    def close(self):
+        self.stream.flush()
+
+
+class ChunkedWriter:
+    def __init__(self, chunk_rows=CHUNK_ROWS):
+        self.chunk_rows = chunk_rows
+        self.rows = 0
+        self.columns = self._empty()
+
+    @staticmethod
+    def _empty():
+        return [[] if typecode == "str" else array.array(typecode) for _, typecode in COLUMNS]
+
+    def write(self, item):
+        for column, value in zip(self.columns, to_row(item)):
+            column.append(value)
+        self.rows += 1
+        if len(self.columns[0]) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if self.columns[0]:
+            columns, self.columns = self.columns, self._empty()
+            self._write_chunk(columns)
+
+    def close(self):
+        self.flush()
+
+
+# Chunks of little endian arrays, the text columns as a dictionary plus uint32 indexes
+class ColumnarWriter(ChunkedWriter):
+    def __init__(self, stream, chunk_rows=CHUNK_ROWS):
+        super().__init__(chunk_rows)
+        self.stream = stream
+        self.stream.write(MAGIC + struct.pack("<B", VERSION))
+
+    def _write_chunk(self, columns):
+        self.stream.write(CHUNK + struct.pack("<I", len(columns[0])))
+        for (_, typecode), column in zip(COLUMNS, columns):
+            if typecode == "str":
+                values = {}
+                indexes = array.array("I", (values.setdefault(value, len(values)) for value in column))
+                self.stream.write(struct.pack("<I", len(values)))
+                for value in values:
+                    encoded = value.encode()
+                    self.stream.write(struct.pack("<H", len(encoded)) + encoded)
+                column = indexes
+            if sys.byteorder == "big":
+                column.byteswap()
+            self.stream.write(column.tobytes())
+
+    def close(self):
+        super().close()
+        self.stream.flush()
+
+
+def read_columnar(stream):
+    if stream.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a columnar export")
+    version, = struct.unpack("<B", stream.read(1))
+    if version != VERSION:
+        raise ValueError("Unsupported columnar export version %d" % version)
+
+    while True:
+        header = stream.read(len(CHUNK) + 4)
+        if not header:
+            return
+        rows, = struct.unpack("<I", header[len(CHUNK):])
+        chunk = {}
+        for name, typecode in COLUMNS:
+            values = None
+            if typecode == "str":
+                size, = struct.unpack("<I", stream.read(4))
+                values = []
+                for _ in range(size):
+                    length, = struct.unpack("<H", stream.read(2))
+                    values.append(stream.read(length).decode())
+                typecode = "I"
+            column = array.array(typecode)
+            column.frombytes(stream.read(rows * column.itemsize))
+            if sys.byteorder == "big":
+                column.byteswap()
+            chunk[name] = [values[index] for index in column] if values is not None else column
+        yield chunk
+
+
+class ParquetWriter(ChunkedWriter):
+    def __init__(self, path, chunk_rows=CHUNK_ROWS):
+        if pyarrow is None:
+            raise RuntimeError("pyarrow is needed to export Parquet")
+        super().__init__(chunk_rows)
+        types = {"str": pyarrow.string(), "q": pyarrow.int64(), "i": pyarrow.int32(), "d": pyarrow.float64()}
+        self.schema = pyarrow.schema([(name, types[typecode]) for name, typecode in COLUMNS])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression="snappy")
+
+    def _write_chunk(self, columns):
+        self.writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(column) for column in columns],
+                                                          schema=self.schema))
+
+    def close(self):
+        super().close()
+        self.writer.close()
+
+
+def export(items, writer):
+    try:
+        for item in items:
+            writer.write(item)
+    finally:
+        writer.close()
+    return writer.rows
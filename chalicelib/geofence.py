@@ -0,0 +1,224 @@
+"""
+Geofences for the decoded GEO packets. Fence polygons are indexed in a grid of fixed
+size cells, every position is only tested against the fences of its cell, and the
+fences a device is inside are kept per device so enter and exit events are sent once.
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+import math
+import time
+
+from chalicelib.dedup import TTLCache
+from chalicelib.registry import BATCH_GET_SIZE, batch_get
+from chalicelib.retry import chunks, conditional_check_failed
+
+ENTER = "enter"
+EXIT = "exit"
+
+# About 1km of latitude
+DEFAULT_CELL_SIZE = 0.01
+# Fences over more cells than this are only indexed by their bounding box
+MAX_CELLS_PER_FENCE = 10000
+
+STATE_KEY = "DevEUI"
+
+
+def point_in_polygon(lat, lng, polygon):
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        lat_i, lng_i = polygon[i]
+        lat_j, lng_j = polygon[j]
+        if (lng_i > lng) != (lng_j > lng) and lat < (lat_j - lat_i) * (lng - lng_i) / (lng_j - lng_i) + lat_i:
+            inside = not inside
+        j = i
+    return inside
+
+
+class Fence:
+    # polygon is a list of (lat, lng), devices the DevEUIs it applies to, every device when None
+    def __init__(self, fence_id, polygon, devices=None, name=None):
+        if len(polygon) < 3:
+            raise ValueError("Fence " + fence_id + " needs at least 3 vertices")
+        self.fence_id = fence_id
+        self.polygon = [(float(lat), float(lng)) for lat, lng in polygon]
+        self.devices = frozenset(devices) if devices else None
+        self.name = name or fence_id
+        lats = [lat for lat, _ in self.polygon]
+        lngs = [lng for _, lng in self.polygon]
+        self.bbox = (min(lats), min(lngs), max(lats), max(lngs))
+
+    def applies_to(self, dev_eui):
+        return self.devices is None or dev_eui in self.devices
+
+    def contains(self, lat, lng):
+        min_lat, min_lng, max_lat, max_lng = self.bbox
+        if not (min_lat <= lat <= max_lat and min_lng <= lng <= max_lng):
+            return False
+        return point_in_polygon(lat, lng, self.polygon)
+
+
+class GridIndex:
+    def __init__(self, fences, cell_size=DEFAULT_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.wide = []
+        self.fences = dict((fence.fence_id, fence) for fence in fences)
+        for fence in fences:
+            self._add(fence)
+
+    def cell(self, lat, lng):
+        return int(math.floor(lat / self.cell_size)), int(math.floor(lng / self.cell_size))
+
+    def _add(self, fence):
+        min_lat, min_lng, max_lat, max_lng = fence.bbox
+        first_row, first_column = self.cell(min_lat, min_lng)
+        last_row, last_column = self.cell(max_lat, max_lng)
+        if (last_row - first_row + 1) * (last_column - first_column + 1) > MAX_CELLS_PER_FENCE:
+            self.wide.append(fence)
+            return
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                self.cells.setdefault((row, column), []).append(fence)
+
+    def candidates(self, lat, lng):
+        return self.cells.get(self.cell(lat, lng), []) + self.wide
+
+    def containing(self, dev_eui, lat, lng):
+        return set(fence.fence_id for fence in self.candidates(lat, lng)
+                   if fence.applies_to(dev_eui) and fence.contains(lat, lng))
+
+
+# Fence items: {"fence_id": ..., "polygon": [[lat, lng], ...], "devices": [...], "name": ...}
+def load_fences(table):
+    fences = []
+    arguments = {}
+    while True:
+        response = table.scan(**arguments)
+        for item in response.get("Items", []):
+            fences.append(Fence(item["fence_id"], item["polygon"], item.get("devices"), item.get("name")))
+        if not response.get("LastEvaluatedKey"):
+            return fences
+        arguments["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def positions(parsed_events):
+    for parsed in parsed_events:
+        if parsed is not None and "GEO" in parsed:
+            yield parsed["DevEUI"], parsed["timeStamp"], float(parsed["GEO"]["lat"]), float(parsed["GEO"]["lng"])
+
+
+class GeofenceEngine:
+    # The fences come from fences or from fence_table, reloaded every refresh_interval seconds.
+    # state_table is optional, keyed on DevEUI, it keeps the fences every device is inside between containers.
+    # The states are cached for state_ttl seconds, so the changes other containers save are seen
+    def __init__(self, log, fences=None, fence_table=None, state_table=None, cell_size=DEFAULT_CELL_SIZE,
+                 refresh_interval=300, state_ttl=300, max_states=10000):
+        self.log = log
+        self.fence_table = fence_table
+        self.state_table = state_table
+        self.cell_size = cell_size
+        self.refresh_interval = refresh_interval
+        self.index = GridIndex(fences or [], cell_size)
+        self.loaded_at = None
+        self.states = TTLCache(max_states, state_ttl)
+        self.backoff_base = 0.05
+        self.stats = {"positions": 0, "tested": 0, ENTER: 0, EXIT: 0, "stale": 0, "conflicts": 0, "errors": 0}
+
+    def _refresh(self):
+        if self.fence_table is None:
+            return
+        if self.loaded_at is not None and time.time() - self.loaded_at < self.refresh_interval:
+            return
+        try:
+            self.index = GridIndex(load_fences(self.fence_table), self.cell_size)
+        except Exception as e:
+            # The fences loaded before, if any, are still used
+            self.log.error("Fences not loaded: %s", e)
+        self.loaded_at = time.time()
+
+    # Returns the enter and exit events of a batch of GEO parse_payload results, in time order per device
+    def evaluate(self, parsed_events):
+        self._refresh()
+        by_device = {}
+        for position in positions(parsed_events):
+            by_device.setdefault(position[0], []).append(position)
+        if not by_device:
+            return []
+        self._load_states(by_device)
+
+        events = []
+        for dev_eui, device_positions in by_device.items():
+            state = self.states.get(dev_eui)
+            if state is None:
+                self.stats["errors"] += len(device_positions)
+                continue
+            device_events = []
+            for _, time_stamp, lat, lng in sorted(device_positions, key=lambda position: position[1]):
+                self.stats["positions"] += 1
+                if time_stamp < state["timeStamp"]:
+                    self.stats["stale"] += 1
+                    continue
+                self.stats["tested"] += len(self.index.candidates(lat, lng))
+                inside = self.index.containing(dev_eui, lat, lng)
+                for event, fence_ids in [(EXIT, state["fences"] - inside), (ENTER, inside - state["fences"])]:
+                    for fence_id in sorted(fence_ids):
+                        device_events.append(self._event(event, fence_id, dev_eui, time_stamp, lat, lng))
+                state = {STATE_KEY: dev_eui, "fences": inside, "timeStamp": time_stamp}
+            self.states.add(dev_eui, state)
+            # The state is saved before the events are sent, when another container saved a newer one
+            # it also sent the events of the device and these are dropped
+            if device_events and not self._save_state(state):
+                continue
+            for event in device_events:
+                self.stats[event["event"]] += 1
+            events.extend(device_events)
+        return events
+
+    def _event(self, event, fence_id, dev_eui, time_stamp, lat, lng):
+        fence = self.index.fences.get(fence_id)
+        return {"event": event, "fence_id": fence_id, "name": fence.name if fence is not None else fence_id,
+                "DevEUI": dev_eui, "timeStamp": time_stamp, "lat": str(lat), "lng": str(lng)}
+
+    # The devices that are not cached are read with one BatchGetItem per 100 devices. When the read fails
+    # the devices are left out of this batch instead of sending enter events for fences they were already in
+    def _load_states(self, dev_euis):
+        missing = [dev_eui for dev_eui in dev_euis if dev_eui not in self.states]
+        for chunk in chunks(sorted(missing), BATCH_GET_SIZE):
+            items = []
+            if self.state_table is not None:
+                try:
+                    items = batch_get(self.state_table, [{STATE_KEY: dev_eui} for dev_eui in chunk],
+                                      self.backoff_base)
+                except Exception as e:
+                    self.log.error("Geofence states not loaded: %s", e)
+                    continue
+            found = dict((item[STATE_KEY], item) for item in items)
+            for dev_eui in chunk:
+                item = found.get(dev_eui)
+                self.states.add(dev_eui, {STATE_KEY: dev_eui, "fences": set(item.get("fences", [])),
+                                          "timeStamp": int(item["timeStamp"])} if item is not None else
+                                {STATE_KEY: dev_eui, "fences": set(), "timeStamp": -1})
+
+    # Only replaces an older state, when another container saved a newer one the cached state is dropped
+    # and read again with the next batch. Returns False only when the newer state was kept
+    def _save_state(self, state):
+        if self.state_table is None:
+            return True
+        try:
+            # DynamoDB does not take empty sets, and a list keeps the item readable
+            self.state_table.put_item(Item={STATE_KEY: state[STATE_KEY], "fences": sorted(state["fences"]),
+                                            "timeStamp": state["timeStamp"]},
+                                      ConditionExpression="attribute_not_exists(#t) OR #t < :t",
+                                      ExpressionAttributeNames={"#t": "timeStamp"},
+                                      ExpressionAttributeValues={":t": state["timeStamp"]})
+        except Exception as e:
+            self.states.discard(state[STATE_KEY])
+            if conditional_check_failed(e):
+                self.stats["conflicts"] += 1
+                return False
+            self.log.error("Geofence state of %s not saved: %s", state[STATE_KEY], e)
+        return True
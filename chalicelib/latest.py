@@ -0,0 +1,104 @@
+"""
+Latest known state of every device, one item per DevEUI with the last decoded value
+of every packet type, when it was measured, and when the device was last seen.
+
+Writes are conditional on the stored timestamps, so uplinks that arrive late or are
+processed again never overwrite newer state.
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+from chalicelib.payload_codecs import CODECS
+from chalicelib.registry import BATCH_GET_SIZE, batch_get
+from chalicelib.retry import chunks, conditional_check_failed
+
+LATEST_KEY = "DevEUI"
+LAST_SEEN = "last_seen"
+
+MAX_DEVICES = 1000
+
+
+# Keeps the newest uplink of every device and attribute, a batch only writes each device once
+def collapse(items):
+    # geo and ka and the attributes of the codecs registered since, read for every batch
+    decoded = sorted(CODECS.attributes().values())
+    states = {}
+    for item in items:
+        state = states.setdefault(item["DevEUI"], {LAST_SEEN: -1, "attributes": {}})
+        time_stamp = item["timeStamp"]
+        state[LAST_SEEN] = max(state[LAST_SEEN], time_stamp)
+        attributes = state["attributes"]
+        for attribute in decoded:
+            if attribute in item and time_stamp >= attributes.get(attribute, (-1, None))[0]:
+                attributes[attribute] = (time_stamp, item[attribute])
+    return states
+
+
+class LatestState:
+    def __init__(self, table, log):
+        self.table = table
+        self.log = log
+        self.backoff_base = 0.05
+        self.stats = {"updated": 0, "stale": 0, "errors": 0}
+
+    def update(self, items):
+        for dev_eui, state in collapse(items).items():
+            try:
+                self._write(dev_eui, state)
+            except Exception as e:
+                # The state is fixed by the next uplink of the device, DeviceData already has this one
+                self.log.error("Latest state of %s not updated: %s", dev_eui, e)
+                self.stats["errors"] += 1
+
+    # One write per device, when part of the stored state is newer every part is written on its own
+    def _write(self, dev_eui, state):
+        parts = [(LAST_SEEN, state[LAST_SEEN], None)]
+        parts += [(attribute, time_stamp, value)
+                  for attribute, (time_stamp, value) in sorted(state["attributes"].items())]
+        if self._update(dev_eui, parts):
+            self.stats["updated"] += 1
+            return
+
+        for part in parts:
+            if self._update(dev_eui, [part]):
+                self.stats["updated"] += 1
+            else:
+                self.stats["stale"] += 1
+
+    # The attribute names go through #n placeholders, the registered codecs may use reserved words
+    def _update(self, dev_eui, parts):
+        assignments, conditions, names, values = [], [], {}, {}
+        for attribute, time_stamp, value in parts:
+            stamp = attribute if value is None else attribute + "_ts"
+            fields = [(stamp, time_stamp)] + ([(attribute, value)] if value is not None else [])
+            for field, field_value in fields:
+                name, placeholder = "#n%d" % len(names), ":v%d" % len(values)
+                names[name] = field
+                values[placeholder] = field_value
+                assignments.append(name + " = " + placeholder)
+                if field == stamp:
+                    conditions.append("(attribute_not_exists(" + name + ") OR " + name + " <= " + placeholder + ")")
+        try:
+            self.table.update_item(Key={LATEST_KEY: dev_eui},
+                                   UpdateExpression="SET " + ", ".join(assignments),
+                                   ConditionExpression=" AND ".join(conditions),
+                                   ExpressionAttributeNames=names,
+                                   ExpressionAttributeValues=values)
+            return True
+        except Exception as e:
+            if conditional_check_failed(e):
+                return False
+            raise
+
+    def get(self, dev_eui):
+        return self.table.get_item(Key={LATEST_KEY: dev_eui}).get("Item")
+
+    # One BatchGetItem per 100 devices, unknown devices are left out
+    def get_many(self, dev_euis):
+        found = {}
+        for chunk in chunks(sorted(set(dev_euis)), BATCH_GET_SIZE):
+            for item in batch_get(self.table, [{LATEST_KEY: dev_eui} for dev_eui in chunk], self.backoff_base):
+                found[item[LATEST_KEY]] = item
+        return found
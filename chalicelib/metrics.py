@@ -0,0 +1,92 @@
+"""
+Per-stage timers and counters, emitted once per invocation as a CloudWatch Embedded
+Metric Format record, and sampled payload logging for the hot path.
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+import json
+import os
+import random
+import time
+
+NAMESPACE = os.getenv('METRICS_NAMESPACE', 'IoTPartners/Platform')
+
+
+class Timer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.record(self.stage, (time.perf_counter() - self.start) * 1000)
+        return False
+
+
+class Metrics:
+    # emit receives every EMF record as a JSON line, on Lambda stdout goes straight to CloudWatch
+    def __init__(self, namespace=NAMESPACE, emit=print):
+        self.namespace = namespace
+        self.emit = emit
+        self.timings = {}
+        self.counters = {}
+
+    def timer(self, stage):
+        return Timer(self, stage)
+
+    def record(self, stage, milliseconds):
+        timing = self.timings.get(stage)
+        if timing is None:
+            self.timings[stage] = [milliseconds, 1, milliseconds]
+        else:
+            timing[0] += milliseconds
+            timing[1] += 1
+            if milliseconds > timing[2]:
+                timing[2] = milliseconds
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def flush(self, function_name):
+        if not self.timings and not self.counters:
+            return None
+
+        definitions = []
+        record = {"function": function_name}
+        for stage, (total, calls, slowest) in sorted(self.timings.items()):
+            record[stage + "_ms"] = round(total, 3)
+            record[stage + "_max_ms"] = round(slowest, 3)
+            record[stage + "_calls"] = calls
+            definitions.append({"Name": stage + "_ms", "Unit": "Milliseconds"})
+            definitions.append({"Name": stage + "_max_ms", "Unit": "Milliseconds"})
+            definitions.append({"Name": stage + "_calls", "Unit": "Count"})
+        for name, value in sorted(self.counters.items()):
+            record[name] = value
+            definitions.append({"Name": name, "Unit": "Count"})
+
+        record["_aws"] = {"Timestamp": int(time.time() * 1000),
+                          "CloudWatchMetrics": [{"Namespace": self.namespace,
+                                                 "Dimensions": [["function"]],
+                                                 "Metrics": definitions}]}
+        self.timings = {}
+        self.counters = {}
+        self.emit(json.dumps(record))
+        return record
+
+
+class PayloadSampler:
+    # Logs about rate * 100 percent of the payloads, 0 turns payload logging off
+    def __init__(self, log, rate):
+        self.log = log
+        self.rate = rate
+
+    def log_payload(self, message, payload):
+        if self.rate > 0 and random.random() < self.rate:
+            self.log.info("%s %s", message, payload)
@@ -0,0 +1,110 @@
+"""
+Registry of binary payload codecs, looked up by packet id and optionally by device model.
+Every codec decodes bytes.fromhex of the bytes its struct layout needs, so trailing bytes
+and a trailing odd nibble are ignored, as the string decoders did.
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+import struct
+import time
+
+# Packet id, 24 bits latitude, 24 bits longitude
+GEO_LAYOUT = struct.Struct(">xBHBH")
+# Packet id, interval, voltage in millivolts
+KEEP_ALIVE_LAYOUT = struct.Struct(">xBH")
+
+
+def decode_geo(raw):
+    lat_hi, lat_lo, lng_hi, lng_lo = GEO_LAYOUT.unpack_from(raw)
+    lat = (((lat_hi << 16) | lat_lo) * 180 / 16777215) - 90
+    lng = (((lng_hi << 16) | lng_lo) * 360 / 16777215) - 180
+    return {"lat": str(lat), "lng": str(lng)}
+
+
+def decode_keep_alive(raw):
+    interval, voltage = KEEP_ALIVE_LAYOUT.unpack_from(raw)
+    return {"interval": str(interval), "voltage": str(voltage / 1000)}
+
+
+class Codec:
+    # size is the number of payload bytes decode reads, every whole byte of the payload without it
+    def __init__(self, packet_id, name, attribute, decode, model=None, size=None):
+        self.packet_id = packet_id
+        self.name = name
+        self.attribute = attribute
+        self.decode = decode
+        self.model = model
+        self.size = size
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+
+
+class CodecRegistry:
+    def __init__(self):
+        self.codecs = {}
+        self.unknown = 0
+        self._attributes = None
+
+    # A codec registered with a model only applies to that model, otherwise to every device
+    def register(self, packet_id, name, attribute, decode, model=None, size=None):
+        codec = Codec(packet_id.lower(), name, attribute, decode, model, size)
+        self.codecs[(codec.packet_id, model)] = codec
+        self._attributes = None
+        return codec
+
+    def lookup(self, packet_id, model=None):
+        packet_id = packet_id.lower()
+        codec = self.codecs.get((packet_id, model)) if model is not None else None
+        return codec or self.codecs.get((packet_id, None))
+
+    # Returns (name, decoded) or None when the packet id is unknown or the payload is malformed, a
+    # malformed payload is logged when a log is given and counted in the codec errors anyway
+    def decode(self, payload, model=None, log=None):
+        codec = self.lookup(payload[:2], model)
+        if codec is None:
+            self.unknown += 1
+            return None
+
+        start = time.perf_counter()
+        try:
+            decoded = codec.decode(bytes.fromhex(payload[:codec.size * 2] if codec.size is not None
+                                                 else payload[:len(payload) // 2 * 2]))
+        except (ValueError, struct.error) as e:
+            codec.errors += 1
+            if log is not None:
+                log.warning("Malformed %s payload %s: %s", codec.name, payload, e)
+            return None
+        finally:
+            codec.seconds += time.perf_counter() - start
+        codec.count += 1
+        return codec.name, decoded
+
+    # Built again only when a codec is registered, it is read for every decoded record
+    def attributes(self):
+        if self._attributes is None:
+            self._attributes = dict((codec.name, codec.attribute) for codec in self.codecs.values())
+        return self._attributes
+
+    def stats(self):
+        stats = {"unknown": self.unknown}
+        for (packet_id, model), codec in self.codecs.items():
+            key = codec.name if model is None else codec.name + "/" + model
+            stats[key] = {"packet_id": packet_id, "count": codec.count, "errors": codec.errors,
+                          "seconds": round(codec.seconds, 6)}
+        return stats
+
+
+def default_registry():
+    registry = CodecRegistry()
+    registry.register("10", "GEO", "geo", decode_geo, size=GEO_LAYOUT.size)
+    registry.register("02", "KA", "ka", decode_keep_alive, size=KEEP_ALIVE_LAYOUT.size)
+    return registry
+
+
+# Payload decoders by packet id, new sensor types are registered here. The views read their
+# attributes from it, so they also store the packets of the codecs registered at runtime
+CODECS = default_registry()
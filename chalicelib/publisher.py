@@ -0,0 +1,86 @@
+"""
+Buffered SNS publisher that groups the messages of an invocation per topic
+and sends them with PublishBatch
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+import time
+
+# PublishBatch limits: 10 entries and 256KB of total payload per call
+PUBLISH_BATCH_SIZE = 10
+PUBLISH_BATCH_BYTES = 262144
+
+
+class BatchPublisher:
+    def __init__(self, sns_client, log, max_entries=PUBLISH_BATCH_SIZE, max_bytes=PUBLISH_BATCH_BYTES, max_wait=1.0):
+        self.sns_client = sns_client
+        self.log = log
+        self.max_entries = min(max_entries, PUBLISH_BATCH_SIZE)
+        self.max_bytes = min(max_bytes, PUBLISH_BATCH_BYTES)
+        self.max_wait = max_wait
+        self.buffers = {}
+        self.stats = {"messages": 0, "batch_calls": 0, "failed": 0, "retried": 0}
+
+    def publish(self, topic_arn, subject, message):
+        size = len(message.encode("utf-8")) + len(subject.encode("utf-8"))
+        buffer = self.buffers.get(topic_arn)
+
+        if buffer is not None and buffer["bytes"] + size > self.max_bytes:
+            self.flush(topic_arn)
+            buffer = None
+
+        if buffer is None:
+            buffer = {"entries": [], "bytes": 0, "since": time.time()}
+            self.buffers[topic_arn] = buffer
+
+        buffer["entries"].append({"Id": str(len(buffer["entries"])), "Subject": subject, "Message": message})
+        buffer["bytes"] += size
+        self.stats["messages"] += 1
+
+        if len(buffer["entries"]) >= self.max_entries or time.time() - buffer["since"] >= self.max_wait:
+            self.flush(topic_arn)
+
+    # Without a topic it flushes every buffer, it must be called when the invocation ends. When a send
+    # fails the buffers are emptied anyway, the failed invocation is delivered again and publishes them
+    def flush(self, topic_arn=None):
+        topics = [topic_arn] if topic_arn is not None else list(self.buffers)
+        try:
+            for topic in topics:
+                buffer = self.buffers.pop(topic, None)
+                if buffer and buffer["entries"]:
+                    self._send(topic, buffer["entries"])
+        finally:
+            for topic in topics:
+                self.buffers.pop(topic, None)
+
+    # The messages of an invocation that fails before its flush, the warm container does not send them
+    def discard(self):
+        if self.buffers:
+            self.log.debug("discarding %d buffered messages", self.pending())
+        self.buffers = {}
+
+    def pending(self):
+        return sum(len(buffer["entries"]) for buffer in self.buffers.values())
+
+    def _send(self, topic_arn, entries):
+        self.stats["batch_calls"] += 1
+        try:
+            response = self.sns_client.publish_batch(TopicArn=topic_arn, PublishBatchRequestEntries=entries)
+            failed_ids = set(failed["Id"] for failed in response.get("Failed", []))
+        except Exception as e:
+            self.log.error("PublishBatch to %s failed, publishing %d entries one by one: %s", topic_arn,
+                           len(entries), e)
+            failed_ids = set(entry["Id"] for entry in entries)
+
+        if not failed_ids:
+            return
+
+        self.stats["failed"] += len(failed_ids)
+        self.log.debug("retrying %d failed entries for %s", len(failed_ids), topic_arn)
+        for entry in entries:
+            if entry["Id"] in failed_ids:
+                self.stats["retried"] += 1
+                self.sns_client.publish(TopicArn=topic_arn, Subject=entry["Subject"], Message=entry["Message"])
@@ -0,0 +1,141 @@
+"""
+Time range reads of DeviceData. Every page is a single Query on the DevEUI partition
+with a BETWEEN condition on timeStamp, and the next page starts at an opaque cursor
+built from LastEvaluatedKey.
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+import base64
+import json
+import re
+from decimal import Decimal
+
+from chalicelib.compact import decode_item, stored_fields
+from chalicelib.payload_codecs import CODECS
+from chalicelib.timestamps import to_epoch_millis
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+UPLINK_FIELDS = ["DevEUI", "timeStamp", "virtual_tx", "time_json", "payload", "type", "test", "model", "owner"]
+
+FIELD_NAME = re.compile(r"^[A-Za-z0-9_]+$")
+MAX_TIMESTAMP = 2 ** 63 - 1
+
+
+class QueryError(ValueError):
+    pass
+
+
+# Everything but "extra", the raw uplink document, which is most of the bytes of every item. The decoded
+# attributes are read on every call, so the codecs registered at runtime are also returned
+def default_fields():
+    return UPLINK_FIELDS + sorted(CODECS.attributes().values())
+
+
+# from and to are epoch milliseconds or ISO-8601 dates, both ends are included
+def parse_timestamp(value, default):
+    if value is None or value == "":
+        return default
+    if value.isdigit():
+        return int(value)
+    try:
+        return to_epoch_millis(value)
+    except (ValueError, OverflowError):
+        raise QueryError("Invalid timestamp " + value)
+
+
+def parse_limit(value):
+    if value is None:
+        return DEFAULT_LIMIT
+    if not value.isdigit() or int(value) == 0:
+        raise QueryError("limit must be a positive integer")
+    return min(int(value), MAX_LIMIT)
+
+
+def parse_fields(value):
+    if value is None:
+        return default_fields()
+    fields = [field for field in value.split(",") if field]
+    for field in fields:
+        if not FIELD_NAME.match(field):
+            raise QueryError("Invalid field " + field)
+    if not fields:
+        raise QueryError("fields can not be empty")
+    return fields
+
+
+# Every name goes through ExpressionAttributeNames, a few of the attributes are DynamoDB reserved words
+def projection(fields):
+    names = dict(("#f%d" % i, field) for i, field in enumerate(fields))
+    return ", ".join(names), names
+
+
+def encode_cursor(last_key):
+    if not last_key:
+        return None
+    key = {"DevEUI": last_key["DevEUI"], "timeStamp": int(last_key["timeStamp"])}
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(",", ":")).encode()).decode()
+
+
+def decode_cursor(cursor, dev_eui):
+    if not cursor:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        start_key = {"DevEUI": key["DevEUI"], "timeStamp": int(key["timeStamp"])}
+    except (ValueError, KeyError, TypeError):
+        raise QueryError("Invalid cursor")
+    if start_key["DevEUI"] != dev_eui:
+        raise QueryError("The cursor belongs to another device")
+    return start_key
+
+
+# DynamoDB numbers come back as Decimal, timeStamp and the counters are integers
+def plain(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, dict):
+        return dict((key, plain(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    return value
+
+
+def query_device_data(table, dev_eui, start, end, limit=DEFAULT_LIMIT, cursor=None, fields=None,
+                      newest_first=False):
+    if start > end:
+        raise QueryError("from must not be after to")
+    fields = fields or default_fields()
+    stored = stored_fields(fields)
+    expression, names = projection(stored)
+    names.update({"#k": "DevEUI", "#t": "timeStamp"})
+    arguments = {"KeyConditionExpression": "#k = :dev_eui AND #t BETWEEN :from AND :to",
+                 "ExpressionAttributeNames": names,
+                 "ExpressionAttributeValues": {":dev_eui": dev_eui, ":from": start, ":to": end},
+                 "ProjectionExpression": expression,
+                 "ScanIndexForward": not newest_first,
+                 "Limit": limit}
+    start_key = decode_cursor(cursor, dev_eui)
+    if start_key is not None:
+        arguments["ExclusiveStartKey"] = start_key
+
+    response = table.query(**arguments)
+    items = [decode_item(item) for item in response.get("Items", [])]
+    if stored != fields:
+        items = [dict((name, value) for name, value in item.items() if name in fields) for item in items]
+    return {"items": plain(items), "count": response.get("Count", 0),
+            "cursor": encode_cursor(response.get("LastEvaluatedKey"))}
+
+
+def query_from_params(table, dev_eui, params):
+    params = params or {}
+    if params.get("order") not in (None, "asc", "desc"):
+        raise QueryError("order must be asc or desc")
+    start = parse_timestamp(params.get("from"), 0)
+    end = parse_timestamp(params.get("to"), MAX_TIMESTAMP)
+    return query_device_data(table, dev_eui, start, end, parse_limit(params.get("limit")), params.get("cursor"),
+                             parse_fields(params.get("fields")), params.get("order") == "desc")
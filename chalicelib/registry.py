@@ -0,0 +1,91 @@
+"""
+Device registry backed by the devices table, keyed on DevEUI. Metadata like model,
+codec, owner and alarm thresholds is cached per container, and all the devices of
+an invocation are fetched together with BatchGetItem.
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+from types import MappingProxyType
+
+from chalicelib.dedup import TTLCache
+from chalicelib.retry import backoff_delay, chunks, sleep
+
+# BatchGetItem accepts at most 100 keys per call
+BATCH_GET_SIZE = 100
+BATCH_GET_MAX_RETRIES = 3
+
+DEVICE_KEY = "DevEUI"
+
+# Unknown devices are cached too, so they don't cost a read on every message. It is shared by
+# every unknown device, so it is read only
+UNKNOWN = MappingProxyType({})
+# Seconds the devices that could not be read are taken as unknown before they are read again
+ERROR_TTL = 5
+
+
+class DeviceRegistry:
+    def __init__(self, table, log, ttl=300, max_entries=10000, error_ttl=ERROR_TTL):
+        self.table = table
+        self.log = log
+        self.cache = TTLCache(max_entries, ttl)
+        self.error_ttl = error_ttl
+        self.backoff_base = 0.05
+        self.stats = {"hits": 0, "misses": 0, "fetched": 0, "errors": 0}
+
+    def get(self, dev_eui):
+        device = self.cache.get(dev_eui)
+        if device is not None:
+            self.stats["hits"] += 1
+            return device
+        self.stats["misses"] += 1
+        self.prefetch([dev_eui])
+        return self.cache.get(dev_eui, UNKNOWN)
+
+    # Fetches every device that is not cached yet, one BatchGetItem per 100 devices
+    def prefetch(self, dev_euis):
+        missing = sorted(set(dev_eui for dev_eui in dev_euis if dev_eui not in self.cache))
+        for chunk in chunks(missing, BATCH_GET_SIZE):
+            found = self._batch_get(chunk)
+            if found is None:
+                # Not every message of a failing table costs a read, they are asked for again soon
+                for dev_eui in chunk:
+                    self.cache.add(dev_eui, UNKNOWN, self.error_ttl)
+                continue
+            for dev_eui in chunk:
+                self.cache.add(dev_eui, found.get(dev_eui, UNKNOWN))
+
+    # None when the devices could not be read
+    def _batch_get(self, dev_euis):
+        try:
+            items = batch_get(self.table, [{DEVICE_KEY: dev_eui} for dev_eui in dev_euis], self.backoff_base)
+        except Exception as e:
+            # Without the registry the messages are still processed with the default behaviour
+            self.log.error("batch_get_item failed: %s", e)
+            self.stats["errors"] += 1
+            return None
+        self.stats["fetched"] += len(items)
+        return dict((item[DEVICE_KEY], item) for item in items)
+
+
+class UnprocessedKeysError(Exception):
+    pass
+
+
+# At most BATCH_GET_SIZE keys, the unprocessed ones are asked for again with backoff
+def batch_get(table, keys, backoff_base=0.05):
+    found = []
+    attempt = 0
+    while keys:
+        response = table.meta.client.batch_get_item(RequestItems={table.name: {"Keys": keys}})
+        found.extend(response.get("Responses", {}).get(table.name, []))
+
+        keys = response.get("UnprocessedKeys", {}).get(table.name, {}).get("Keys", [])
+        if keys and attempt >= BATCH_GET_MAX_RETRIES:
+            raise UnprocessedKeysError("%d keys left unprocessed" % len(keys))
+        if keys:
+            sleep(backoff_delay(attempt, backoff_base))
+            attempt += 1
+    return found
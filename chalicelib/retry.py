@@ -0,0 +1,76 @@
+"""
+Retry helpers shared by the DynamoDB and SNS batch paths
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+import random
+import time
+
+
+def backoff_delay(attempt, base=0.05, cap=2.0):
+    # Exponential backoff with full jitter, as recommended by AWS for throttled calls
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def sleep(seconds):
+    if seconds > 0:
+        time.sleep(seconds)
+
+
+# Error codes of the DynamoDB and SNS calls that are worth retrying after a backoff
+THROTTLING_ERRORS = {"ProvisionedThroughputExceededException", "ThrottlingException", "Throttling",
+                     "RequestLimitExceeded", "TransactionConflictException", "InternalServerError",
+                     "ServiceUnavailable"}
+# Highest number of extra doublings added by the throttling seen before
+MAX_LEVEL = 5
+
+
+def error_code(e):
+    return getattr(e, "response", {}).get("Error", {}).get("Code")
+
+
+def is_throttled(e):
+    return error_code(e) in THROTTLING_ERRORS
+
+
+# A conditional write lost against a newer item, it is not retried
+def conditional_check_failed(e):
+    return error_code(e) == "ConditionalCheckFailedException"
+
+
+class AdaptiveRetry:
+    # Throttled calls are retried with jittered exponential backoff. The backoff starts higher while the
+    # previous calls of the container were throttled too, so a throttled table is not hit by every record
+    def __init__(self, max_retries=5, cap=2.0):
+        self.max_retries = max_retries
+        self.cap = cap
+        self.level = 0
+        self.stats = {"calls": 0, "throttled": 0, "gave_up": 0}
+
+    def call(self, base, function, *args, **kwargs):
+        self.stats["calls"] += 1
+        attempt = 0
+        while True:
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                if not is_throttled(e):
+                    raise
+                self.stats["throttled"] += 1
+                self.level = min(MAX_LEVEL, self.level + 1)
+                if attempt >= self.max_retries:
+                    self.stats["gave_up"] += 1
+                    raise
+                sleep(backoff_delay(attempt + self.level, base, self.cap))
+                attempt += 1
+                continue
+            self.level = max(0, self.level - 1)
+            return result
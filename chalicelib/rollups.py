@@ -0,0 +1,201 @@
+"""
+Hourly and daily rollups of every device: uplink count, keep alive count, sum, min and
+max of the voltage, and first and last position of the bucket.
+
+Counters and sums are atomic ADDs. Min, max, first and last can not be expressed as
+one update, so the first write only sets them when the bucket is new and returns the
+bucket, and a second conditional write fixes the ones this batch improves.
+
+The ADDs are not idempotent, items applied twice are counted twice. Server applies
+them once an invocation can no longer fail, see Server.flush_published.
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+from decimal import Decimal
+
+from chalicelib.query import QueryError
+from chalicelib.retry import conditional_check_failed
+
+HOUR = 3600 * 1000
+DAY = 24 * HOUR
+RESOLUTIONS = {"hour": HOUR, "day": DAY}
+
+# Hourly buckets of two months, daily buckets of five years
+MAX_BUCKETS = 1500
+# What the query route returns when "from" is not given
+DEFAULT_SPANS = {"hour": 7 * DAY, "day": 365 * DAY}
+
+BUCKET_KEY = "bucket"
+START_KEY = "start"
+
+# Sigfox uplinks are stored with epoch seconds, LoRa ones with epoch milliseconds
+SECONDS_BEFORE = 10 ** 11
+
+
+def epoch_millis(time_stamp):
+    time_stamp = int(time_stamp)
+    return time_stamp * 1000 if time_stamp < SECONDS_BEFORE else time_stamp
+
+
+def bucket_id(dev_eui, resolution):
+    return dev_eui + "#" + resolution
+
+
+class Bucket:
+    def __init__(self):
+        self.uplinks = 0
+        self.ka_count = 0
+        self.voltage_sum = Decimal(0)
+        self.voltage_min = None
+        self.voltage_max = None
+        self.geo_count = 0
+        self.first_geo = None
+        self.last_geo = None
+
+    def add(self, item, time_stamp):
+        self.uplinks += 1
+        if "ka" in item:
+            voltage = Decimal(item["ka"]["voltage"])
+            self.ka_count += 1
+            self.voltage_sum += voltage
+            self.voltage_min = voltage if self.voltage_min is None else min(self.voltage_min, voltage)
+            self.voltage_max = voltage if self.voltage_max is None else max(self.voltage_max, voltage)
+        if "geo" in item:
+            self.geo_count += 1
+            if self.first_geo is None or time_stamp < self.first_geo[0]:
+                self.first_geo = (time_stamp, item["geo"])
+            if self.last_geo is None or time_stamp >= self.last_geo[0]:
+                self.last_geo = (time_stamp, item["geo"])
+
+    def counters(self):
+        counters = {"uplinks": self.uplinks, "ka_count": self.ka_count, "geo_count": self.geo_count}
+        if self.ka_count:
+            counters["voltage_sum"] = self.voltage_sum
+        return counters
+
+    # (attribute, value, operator that the stored value must satisfy to be replaced)
+    def extremes(self):
+        extremes = []
+        if self.ka_count:
+            extremes += [("voltage_min", self.voltage_min, ">"), ("voltage_max", self.voltage_max, "<")]
+        if self.first_geo is not None:
+            extremes += [("first_geo_ts", self.first_geo[0], ">"), ("last_geo_ts", self.last_geo[0], "<")]
+        return extremes
+
+    # The position travels with its timestamp
+    def positions(self):
+        if self.first_geo is None:
+            return {}
+        return {"first_geo_ts": ("first_geo", self.first_geo[1]), "last_geo_ts": ("last_geo", self.last_geo[1])}
+
+
+# Every device, resolution and bucket start of the batch is written once
+def collect(items):
+    buckets = {}
+    for item in items:
+        time_stamp = epoch_millis(item["timeStamp"])
+        for resolution, width in RESOLUTIONS.items():
+            key = (bucket_id(item["DevEUI"], resolution), time_stamp - time_stamp % width)
+            buckets.setdefault(key, Bucket()).add(item, time_stamp)
+    return buckets
+
+
+def improves(stored, value, operator):
+    if stored is None:
+        return True
+    return stored > value if operator == ">" else stored < value
+
+
+class RollupStore:
+    def __init__(self, table, log):
+        self.table = table
+        self.log = log
+        self.stats = {"buckets": 0, "fixes": 0, "errors": 0}
+
+    # A bucket that fails is logged and skipped, raising would make SNS deliver the whole batch again
+    # and count the other buckets twice
+    def update(self, items):
+        for (bucket, start), values in collect(items).items():
+            try:
+                self._write(bucket, start, values)
+                self.stats["buckets"] += 1
+            except Exception as e:
+                self.log.error("Rollup %s %s not updated: %s", bucket, start, e)
+                self.stats["errors"] += 1
+
+    def _write(self, bucket, start, values):
+        key = {BUCKET_KEY: bucket, START_KEY: start}
+        expression_values = {}
+        adds = []
+        for name, value in sorted(values.counters().items()):
+            adds.append(name + " :" + name)
+            expression_values[":" + name] = value
+        sets = []
+        positions = values.positions()
+        for name, value, _ in values.extremes():
+            sets.append(name + " = if_not_exists(" + name + ", :" + name + ")")
+            expression_values[":" + name] = value
+            if name in positions:
+                position, geo = positions[name]
+                sets.append(position + " = if_not_exists(" + position + ", :" + position + ")")
+                expression_values[":" + position] = geo
+
+        expression = "ADD " + ", ".join(adds)
+        if sets:
+            expression += " SET " + ", ".join(sets)
+        stored = self.table.update_item(Key=key, UpdateExpression=expression,
+                                        ExpressionAttributeValues=expression_values,
+                                        ReturnValues="ALL_NEW").get("Attributes", {})
+
+        fixes = [(name, value, operator) for name, value, operator in values.extremes()
+                 if improves(stored.get(name), value, operator)]
+        if not fixes:
+            return
+        if self._fix(key, fixes, positions):
+            return
+        # Another container moved some of them meanwhile, every one is checked on its own
+        for fix in fixes:
+            self._fix(key, [fix], positions)
+
+    def _fix(self, key, fixes, positions):
+        sets, conditions, expression_values = [], [], {}
+        for name, value, operator in fixes:
+            sets.append(name + " = :" + name)
+            conditions.append("(attribute_not_exists(" + name + ") OR " + name + " " + operator + " :" + name + ")")
+            expression_values[":" + name] = value
+            if name in positions:
+                position, geo = positions[name]
+                sets.append(position + " = :" + position)
+                expression_values[":" + position] = geo
+        try:
+            self.table.update_item(Key=key, UpdateExpression="SET " + ", ".join(sets),
+                                   ConditionExpression=" AND ".join(conditions),
+                                   ExpressionAttributeValues=expression_values)
+            self.stats["fixes"] += 1
+            return True
+        except Exception as e:
+            if conditional_check_failed(e):
+                return False
+            raise
+
+    # Every bucket between start and end, both in epoch milliseconds
+    def query(self, dev_eui, resolution, start, end):
+        width = RESOLUTIONS[resolution]
+        start -= start % width
+        if (end - start) // width >= MAX_BUCKETS:
+            raise QueryError("At most %d %s buckets can be read at once" % (MAX_BUCKETS, resolution))
+
+        arguments = {"KeyConditionExpression": "#b = :bucket AND #s BETWEEN :from AND :to",
+                     "ExpressionAttributeNames": {"#b": BUCKET_KEY, "#s": START_KEY},
+                     "ExpressionAttributeValues": {":bucket": bucket_id(dev_eui, resolution),
+                                                   ":from": start, ":to": end}}
+        buckets = []
+        while True:
+            response = self.table.query(**arguments)
+            buckets.extend(response.get("Items", []))
+            if not response.get("LastEvaluatedKey"):
+                return buckets
+            arguments["ExclusiveStartKey"] = response["LastEvaluatedKey"]
@@ -0,0 +1,201 @@
+"""
+Alarm rules defined as data and compiled once into predicates. Rules are grouped by
+packet type, so a decoded record is only checked against the rules of its packet.
+
+    {"rule_id": "low_voltage", "type": "threshold", "packet": "KA", "field": "voltage",
+     "op": "<=", "value": 2.65, "hysteresis": 0.05, "device_attribute": "low_voltage",
+     "models": {"tracker": 2.5}}
+    {"rule_id": "voltage_drop", "type": "rate", "packet": "KA", "field": "voltage",
+     "op": "<=", "value": -0.1, "per_seconds": 86400}
+    {"rule_id": "missing_keep_alive", "type": "missing", "packet": "KA", "grace": 1.5}
+
+Thresholds come from the device attribute named by device_attribute, then from the
+value of the device model in models, then from value. A rule only applies to the
+devices in devices and to the models in only_models when they are given.
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+import json
+import operator
+
+from chalicelib.dedup import TTLCache
+from chalicelib.payload_codecs import CODECS
+from chalicelib.rollups import epoch_millis
+
+LOW_VOLTAGE_THRESHOLD = 2.65
+# A low voltage alarm is only cleared once the voltage is this much over the threshold
+LOW_VOLTAGE_HYSTERESIS = 0.05
+
+DEFAULT_RULES = [{"rule_id": "low_voltage", "type": "threshold", "packet": "KA", "field": "voltage", "op": "<=",
+                  "value": LOW_VOLTAGE_THRESHOLD, "hysteresis": LOW_VOLTAGE_HYSTERESIS,
+                  "device_attribute": "low_voltage", "subject": "{transition} Alarm {DevEUI}", "tag": False}]
+
+OPERATORS = {"<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+
+# Previous value of every device and rule, for the rate and missing rules
+MAX_PREVIOUS = 100000
+PREVIOUS_TTL = 7 * 86400
+
+
+class RuleError(ValueError):
+    pass
+
+
+class Result:
+    def __init__(self, rule, dev_eui, triggered, recovered, value, record=None, virtual_tx=None):
+        self.rule = rule
+        self.dev_eui = dev_eui
+        self.triggered = triggered
+        self.recovered = recovered
+        self.value = value
+        self.record = record
+        self.virtual_tx = virtual_tx
+
+
+class Rule:
+    def __init__(self, definition):
+        self.definition = definition
+        try:
+            self.rule_id = definition["rule_id"]
+            self.type = definition.get("type", "threshold")
+            self.packet = definition.get("packet", "KA")
+        except (KeyError, TypeError):
+            raise RuleError("Invalid rule " + repr(definition))
+        self.field = definition.get("field")
+        self.subject = definition.get("subject", "{transition} Alarm {rule_id} {DevEUI}")
+        self.tag = definition.get("tag", True)
+        devices = definition.get("devices")
+        self.devices = frozenset(devices) if devices else None
+        only_models = definition.get("only_models")
+        self.only_models = frozenset(only_models) if only_models else None
+
+        if self.type in ("threshold", "rate"):
+            if definition.get("op") not in OPERATORS or self.field is None:
+                raise RuleError("Rule " + self.rule_id + " needs a field and an op in " + ", ".join(OPERATORS))
+            self.compare = OPERATORS[definition["op"]]
+            self.value = float(definition["value"])
+            self.models = dict((model, float(value)) for model, value in definition.get("models", {}).items())
+            self.device_attribute = definition.get("device_attribute")
+            # The hysteresis moves the clear threshold away from the alarm side
+            hysteresis = float(definition.get("hysteresis", 0))
+            self.clear_offset = hysteresis if definition["op"] in ("<", "<=") else -hysteresis
+            self.per_seconds = float(definition.get("per_seconds", 3600))
+        elif self.type == "missing":
+            self.grace = float(definition.get("grace", 1.5))
+            self.interval_field = definition.get("interval_field", "interval")
+            self.interval_seconds = float(definition.get("interval_seconds", 3600))
+        else:
+            raise RuleError("Unknown rule type " + str(self.type))
+
+    def applies_to(self, dev_eui, device):
+        if self.devices is not None and dev_eui not in self.devices:
+            return False
+        return self.only_models is None or device.get("model") in self.only_models
+
+    def threshold(self, device):
+        if self.device_attribute is not None and self.device_attribute in device:
+            return float(device[self.device_attribute])
+        return self.models.get(device.get("model"), self.value)
+
+    def check(self, value, device):
+        threshold = self.threshold(device)
+        triggered = self.compare(value, threshold)
+        recovered = not self.compare(value, threshold + self.clear_offset)
+        return triggered, recovered
+
+    def missing_after(self, packet):
+        return float(packet[self.interval_field]) * self.interval_seconds * self.grace * 1000
+
+
+def compile_rules(definitions):
+    rules = [Rule(definition) for definition in definitions]
+    ids = [rule.rule_id for rule in rules]
+    if len(set(ids)) != len(ids):
+        raise RuleError("Duplicated rule ids")
+    return rules
+
+
+def load_rules(path):
+    with open(path) as rules_file:
+        return compile_rules(json.load(rules_file))
+
+
+class RuleEngine:
+    def __init__(self, rules):
+        self.rules = rules
+        self.by_packet = {}
+        for rule in rules:
+            self.by_packet.setdefault(rule.packet, []).append(rule)
+        self.previous = TTLCache(MAX_PREVIOUS, PREVIOUS_TTL)
+        self.stats = {"records": 0, "evaluated": 0, "triggered": 0}
+
+    # records are (virtual_tx, parse_payload result), device returns the registry metadata of a DevEUI
+    def evaluate(self, records, device):
+        results = []
+        for virtual_tx, record in records:
+            if record is None:
+                continue
+            self.stats["records"] += 1
+            for packet, rules in self.by_packet.items():
+                if packet in record:
+                    self._evaluate(rules, virtual_tx, record, record[packet], device(record["DevEUI"]), results)
+        return results
+
+    def _evaluate(self, rules, virtual_tx, record, packet, metadata, results):
+        dev_eui = record["DevEUI"]
+        values = {}
+        for rule in rules:
+            if not rule.applies_to(dev_eui, metadata):
+                continue
+            self.stats["evaluated"] += 1
+            if rule.field is not None and rule.field not in values:
+                values[rule.field] = float(packet[rule.field])
+
+            if rule.type == "threshold":
+                value = values[rule.field]
+                triggered, recovered = rule.check(value, metadata)
+            else:
+                time_stamp = epoch_millis(record["timeStamp"])
+                key = rule.rule_id + "#" + dev_eui
+                previous = self.previous.get(key)
+                current = values.get(rule.field)
+                if previous is not None and previous[0] >= time_stamp:
+                    continue
+                self.previous.add(key, (time_stamp, current))
+                if rule.type == "missing":
+                    # The keep alive arrived, so it is not missing whatever the gap was. Raising is left to
+                    # overdue, this only clears
+                    value = (time_stamp - previous[0]) / 1000.0 if previous is not None else None
+                    triggered, recovered = False, True
+                elif previous is None:
+                    continue
+                else:
+                    value = (current - previous[1]) * rule.per_seconds * 1000 / (time_stamp - previous[0])
+                    triggered, recovered = rule.check(value, metadata)
+
+            if triggered:
+                self.stats["triggered"] += 1
+            results.append(Result(rule, dev_eui, triggered, recovered, value, record, virtual_tx))
+
+    # Devices of the latest state view whose keep alive is overdue, for the scheduled check. The view
+    # stores every packet under the attribute of its codec, a packet without codec is never stored
+    def overdue(self, latest_items, now_millis, device):
+        results = []
+        attributes = CODECS.attributes()
+        for rule in self.rules:
+            attribute = attributes.get(rule.packet)
+            if rule.type != "missing" or attribute is None:
+                continue
+            for item in latest_items:
+                packet = item.get(attribute)
+                stamp = item.get(attribute + "_ts")
+                if packet is None or stamp is None or not rule.applies_to(item["DevEUI"], device(item["DevEUI"])):
+                    continue
+                silent = now_millis - epoch_millis(stamp)
+                if silent > rule.missing_after(packet):
+                    self.stats["triggered"] += 1
+                    results.append(Result(rule, item["DevEUI"], True, False, silent / 1000.0))
+        return results
@@ -0,0 +1,28 @@
+"""
+JSON for the uplinks that travel through SNS. Messages are decoded with orjson when
+it is installed. They are always encoded with the standard library, so the bytes on
+the wire stay the same whatever backend is installed.
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def loads(message):
+    if orjson is not None:
+        return orjson.loads(message)
+    return json.loads(message)
+
+
+def dumps(data):
+    return json.dumps(data)
@@ -6,13 +6,33 @@ All the logic that can and should be tested will be here
 @mail: eduard@iot-partners.com
 """
 
-from chalice import Chalice, NotFoundError, Response
-import json
+from chalice import NotFoundError
 from datetime import datetime
 import hashlib
-import dateutil
-import boto3
-import logging
+import os
+import time
+from chalicelib.retry import AdaptiveRetry, backoff_delay, chunks, sleep
+from chalicelib.payload_codecs import CODECS
+from chalicelib.coalescer import UpdateCoalescer
+from chalicelib.alarms import RAISED, CLEARED
+from chalicelib.timestamps import to_epoch_millis
+from chalicelib import serialization
+from chalicelib.metrics import Metrics
+from chalicelib.registry import DeviceRegistry, UNKNOWN
+from chalicelib.compact import encode_item
+from chalicelib.rules import RuleEngine, compile_rules, DEFAULT_RULES
+from chalicelib.deadletter import STORE, PARSE
+
+# BatchWriteItem accepts at most 25 put requests per call
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_MAX_RETRIES = 5
+
+STORE_DEVICE_DATA_TOPIC = os.getenv('STORE_DEVICE_DATA_TOPIC', "arn:aws:sns:eu-west-1:488643450383:StoreDeviceData")
+PAYLOAD_PARSER_TOPIC = os.getenv('PAYLOAD_PARSER_TOPIC', "arn:aws:sns:eu-west-1:488643450383:PayloadParser")
+NOTIFY_TOPIC = os.getenv('NOTIFY_TOPIC', "arn:aws:sns:eu-west-1:488643450383:NotifySNS")
+
+# Device metadata copied onto every persisted item
+ENRICHED_ATTRIBUTES = ("model", "owner")
 
 
 def extract_lat_long(payload):
@@ -35,113 +55,418 @@ def extract_keep_alive(payload):
 
 
 class Server:
-    def __init__(self, device_data_table, device_table, sns_client, log):
+    # The optional collaborators are keyword only, so two of them can not be swapped by their position
+    def __init__(self, device_data_table, device_table, sns_client, log, *, publisher=None, deduplicator=None,
+                 alarms=None, metrics=None, latest=None, rollups=None, compact=False, geofences=None,
+                 rules=None, dead_letters=None):
         self.table = device_data_table
+        self.registry = DeviceRegistry(device_table, log) if device_table is not None else None
         self.sns_client = sns_client
         self.log = log
+        self.publisher = publisher
+        self.deduplicator = deduplicator
+        self.alarms = alarms
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.latest = latest
+        self.rollups = rollups
+        # Items of the invocation for the rollups, applied by flush_published
+        self.pending_rollups = []
+        self.compact = compact
+        self.geofences = geofences
+        self.rules = rules if rules is not None else RuleEngine(compile_rules(DEFAULT_RULES))
+        # Without dead letters the first record that fails raises and SNS delivers the whole event again
+        self.dead_letters = dead_letters
+        self.retry = AdaptiveRetry()
+        self.backoff_base = 0.05
+
+    # Uplinks already accepted, by this container or by another one through the dedup table, are dropped
+    def is_duplicate(self, event):
+        if self.deduplicator is None:
+            return False
+        if self.deduplicator.is_duplicate(event["virtual_tx"]):
+            self.log.debug("dropping duplicated virtual_tx:%s", event["virtual_tx"])
+            self.metrics.count("duplicates")
+            return True
+        return False
+
+    # Publishes accepted uplinks to StoreDeviceData. When publishing fails their dedup claims are released
+    # before raising, so the retry of the sender is not dropped as a duplicate
+    def publish_accepted(self, events):
+        try:
+            for event in events:
+                self.publish_data_store_device(event)
+            self.flush_published()
+        except Exception:
+            if self.deduplicator is not None:
+                for event in events:
+                    self.deduplicator.release(event["virtual_tx"])
+            raise
+
+    # Metadata of a device, empty when there is no registry or the device is not registered
+    def device(self, dev_eui):
+        if self.registry is None:
+            return UNKNOWN
+        return self.registry.get(dev_eui)
+
+    # Reads every device of the invocation with one BatchGetItem before the messages are processed
+    def prefetch_devices(self, events):
+        if self.registry is not None:
+            self.registry.prefetch(event["DevEUI"] for event in events)
+
+    def enrich(self, event):
+        device = self.device(event["DevEUI"])
+        attributes = [name for name in ENRICHED_ATTRIBUTES if name in device and name not in event]
+        if not attributes:
+            return event
+        enriched = dict(event)
+        for name in attributes:
+            enriched[name] = device[name]
+        return enriched
+
+    # The codec of the device, or of its model, takes precedence over the default one of the packet id
+    def decode(self, event):
+        device = self.device(event["DevEUI"])
+        with self.metrics.timer("decode"):
+            return Server.parse_payload(event, device.get("codec", device.get("model")), self.log)
 
     # StoreDeviceData executes realtime_lambda_function
     def publish_data_store_device(self, data_to_publish):
-        self.log.debug("publishing virtual_tx:" + data_to_publish["virtual_tx"])
-        expected_message = json.dumps(data_to_publish)
-
-        self.sns_client.publish(
-            TopicArn="arn:aws:sns:eu-west-1:488643450383:StoreDeviceData",
-            Subject="New IOT Event",
-            Message=expected_message
-        )
-
-    # PayloadParser executes realtime_parsing_payload
-    def publish_data_payload_parser(self, data_to_publish):
-        self.log.debug("publishing virtual_tx for payload" + data_to_publish["virtual_tx"])
-        expected_message = json.dumps(data_to_publish)
-
-        self.sns_client.publish(
-            TopicArn="arn:aws:sns:eu-west-1:488643450383:PayloadParser",
-            Subject="New IOT Event",
-            Message=expected_message
-        )
+        self.log.debug("publishing virtual_tx:%s", data_to_publish["virtual_tx"])
+        expected_message = serialization.dumps(data_to_publish)
+
+        self.publish(STORE_DEVICE_DATA_TOPIC, "New IOT Event", expected_message)
+
+    # PayloadParser executes realtime_parsing_payload. The message received from StoreDeviceData is the
+    # same document, when it is given it is forwarded as is instead of encoding it again
+    def publish_data_payload_parser(self, data_to_publish, raw_message=None):
+        self.log.debug("publishing virtual_tx for payload:%s", data_to_publish["virtual_tx"])
+        expected_message = raw_message if raw_message is not None else serialization.dumps(data_to_publish)
+
+        self.publish(PAYLOAD_PARSER_TOPIC, "New IOT Event", expected_message)
+
+    # Messages go through the buffered publisher when there is one, flush_published sends what is left
+    def publish(self, topic_arn, subject, message):
+        with self.metrics.timer("publish"):
+            if self.publisher is None:
+                self.sns_client.publish(TopicArn=topic_arn, Subject=subject, Message=message)
+            else:
+                self.publisher.publish(topic_arn, subject, message)
+
+    # Called when the invocation ends. The rollup ADDs are not idempotent, so they are applied last, when
+    # nothing can fail the invocation and make SNS deliver it again. A failed publish drops them, the
+    # invocation that is delivered again applies them
+    def flush_published(self):
+        items, self.pending_rollups = self.pending_rollups, []
+        if self.publisher is not None:
+            with self.metrics.timer("publish"):
+                self.publisher.flush()
+        if items:
+            with self.metrics.timer("rollups"):
+                self.rollups.update(items)
+
+    # Items as they are written to DeviceData, see chalicelib/compact.py
+    def stored_item(self, event):
+        return encode_item(event) if self.compact else event
+
+    # DynamoDB calls, retried while they are throttled
+    def call(self, function, **kwargs):
+        return self.retry.call(self.backoff_base, function, **kwargs)
+
+    @staticmethod
+    def key(event):
+        return event["DevEUI"], event["timeStamp"]
 
     def persist_data(self, event):
         try:
-            self.table.put_item(Item=event)
+            self.call(self.table.put_item, Item=self.stored_item(event))
         except Exception as e:
-            print(e)
+            self.log.error("put_item failed: %s", e)
             raise NotFoundError("Error adding an element on dynamodb")
         self.log.debug("print: Data persisted")
 
-    def update_data(self, event):
+    # Writes all the events of an invocation with BatchWriteItem, falling back to put_item for the items
+    # DynamoDB still leaves unprocessed after the retries. Without failed the first error raises, with it
+    # the key and error of every item that could not be written are appended and the others are written
+    def persist_data_batch(self, events, failed=None):
+        with self.metrics.timer("persist"):
+            stats = self._persist_data_batch(events, failed)
+        self.metrics.count("persisted", stats["items"] - stats["failed"])
+        self.metrics.count("persist_retries", stats["retries"])
+        return stats
+
+    def _persist_data_batch(self, events, failed):
+        start = time.time()
+        items = [self.stored_item(item) for item in Server.unique_items(events)]
+        stats = {"items": len(items), "batches": 0, "retries": 0, "unprocessed": 0, "fallbacks": 0, "failed": 0}
+
+        for chunk in chunks(items, BATCH_WRITE_SIZE):
+            requests = [{"PutRequest": {"Item": item}} for item in chunk]
+            attempt = 0
+            while requests:
+                try:
+                    response = self.call(self.table.meta.client.batch_write_item,
+                                         RequestItems={self.table.name: requests})
+                except Exception as e:
+                    self.log.error("batch_write_item failed: %s", e)
+                    if failed is None:
+                        raise NotFoundError("Error adding elements on dynamodb")
+                    # One invalid item fails the whole request, every item is tried on its own
+                    self._put_each(requests, stats, failed)
+                    break
+                stats["batches"] += 1
+
+                requests = response.get("UnprocessedItems", {}).get(self.table.name, [])
+                if not requests:
+                    break
+                stats["unprocessed"] += len(requests)
+
+                if attempt >= BATCH_WRITE_MAX_RETRIES:
+                    self._put_each(requests, stats, failed)
+                    break
+
+                stats["retries"] += 1
+                sleep(backoff_delay(attempt, self.backoff_base))
+                attempt += 1
+
+        elapsed = time.time() - start
+        stats["elapsed_ms"] = round(elapsed * 1000, 3)
+        stats["items_per_second"] = round(len(items) / elapsed, 1) if elapsed > 0 else float(len(items))
+        self.log.debug("print: Batch persisted %s", stats)
+        return stats
+
+    def _put_each(self, requests, stats, failed):
+        for request in requests:
+            item = request["PutRequest"]["Item"]
+            try:
+                self.call(self.table.put_item, Item=item)
+            except Exception as e:
+                self.log.error("put_item failed: %s", e)
+                if failed is None:
+                    raise NotFoundError("Error adding an element on dynamodb")
+                failed.append((Server.key(item), e))
+                stats["failed"] += 1
+                continue
+            stats["fallbacks"] += 1
+
+    # A batch can not hold two puts for the same key, the last one wins as it would with put_item
+    @staticmethod
+    def unique_items(events):
+        unique = {}
+        for event in events:
+            unique[(event["DevEUI"], event["timeStamp"])] = event
+        return list(unique.values())
+
+    # StoreDeviceData messages of an invocation, persisted and then forwarded to PayloadParser, or decoded
+    # here in fused mode. The records that still fail after the retries go to the dead letters and are
+    # neither forwarded nor decoded
+    def store_events(self, events, raw_messages=None, fused=False, dead_letters=None):
+        dead_letters = dead_letters if dead_letters is not None else self.dead_letters
+        failed = [] if dead_letters is not None else None
+        try:
+            if fused:
+                stats = self.persist_and_parse(events, failed)
+            else:
+                self.prefetch_devices(events)
+                stats = self.persist_data_batch([self.enrich(event) for event in events], failed)
+            failed_keys = self.dead_letter(STORE, events, failed, dead_letters)
+            if not fused:
+                for event, raw_message in zip(events, raw_messages or [None] * len(events)):
+                    if Server.key(event) not in failed_keys:
+                        self.publish_data_payload_parser(event, raw_message)
+        except Exception:
+            self.discard_pending()
+            raise
+        return stats
+
+    # PayloadParser messages of an invocation. Alarms, geofences and views only run for the records whose
+    # decoded attributes were written, the others go to the dead letters
+    def parse_events(self, events, dead_letters=None):
+        dead_letters = dead_letters if dead_letters is not None else self.dead_letters
+        failed = [] if dead_letters is not None else None
+        self.prefetch_devices(events)
+        parsed_events = [self.decode(event) for event in events]
+        self.update_data_batch(parsed_events, failed=failed)
+        failed_keys = self.dead_letter(PARSE, events, failed, dead_letters)
+
+        done = [(event, parsed) for event, parsed in zip(events, parsed_events) if Server.key(event) not in failed_keys]
         try:
-            if event is None:
-                return
-
-            update_expression = ''
-            expression_attribute_values = {}
-            if "GEO" in event:
-                update_expression = 'SET geo = :val'
-                expression_attribute_values = {
-                    ':val': event["GEO"]
-                }
-            if "KA" in event:
-                update_expression = 'SET ka = :val'
-                expression_attribute_values = {
-                    ':val': event["KA"]
-                }
-
-            response = self.table.update_item(
-                Key={"timeStamp": event["timeStamp"], "DevEUI": event["DevEUI"]},
-                UpdateExpression=update_expression,
-                ExpressionAttributeValues=expression_attribute_values,
-                ReturnValues="UPDATED_NEW"
-            )
+            self.dispatch_alarms([(event["virtual_tx"], parsed) for event, parsed in done])
+            self.dispatch_geofences([parsed for _, parsed in done])
+        except Exception:
+            self.discard_pending()
+            raise
+        self.update_views([Server.merge_parsed(event, parsed) for event, parsed in done])
+
+    # The rollups and buffered messages of an invocation that fails are not sent by the warm container,
+    # SNS delivers the invocation again and its retry queues them once more
+    def discard_pending(self):
+        if self.pending_rollups:
+            self.log.debug("discarding the rollups of %d items", len(self.pending_rollups))
+        self.pending_rollups = []
+        if self.publisher is not None:
+            self.publisher.discard()
+
+    # The events whose key failed go to the dead letters, returns the failed keys
+    def dead_letter(self, stage, events, failed, dead_letters):
+        if not failed:
+            return set()
+        errors = dict(failed)
+        for event in events:
+            if Server.key(event) in errors:
+                dead_letters.add(stage, event, errors[Server.key(event)])
+                self.metrics.count("dead_letters")
+        return set(errors)
+
+    # Fused mode: decodes every event before persisting it, so the decoded fields go in the same write,
+    # alarms are evaluated here and the PayloadParser hop is skipped
+    def persist_and_parse(self, events, failed=None):
+        decoded = []
+        items = []
+        self.prefetch_devices(events)
+        for event in events:
+            parsed = self.decode(event)
+            items.append(Server.merge_parsed(self.enrich(event), parsed))
+            if parsed is not None:
+                decoded.append((event["virtual_tx"], parsed))
+
+        stats = self.persist_data_batch(items, failed)
+        if failed:
+            failed_keys = set(key for key, _ in failed)
+            items = [item for item in items if Server.key(item) not in failed_keys]
+            decoded = [(virtual_tx, parsed) for virtual_tx, parsed in decoded if Server.key(parsed) not in failed_keys]
 
-            self.log.debug("print: Data persisted")
-            return response
+        try:
+            self.dispatch_alarms(decoded)
+            self.dispatch_geofences([parsed for _, parsed in decoded])
+        except Exception:
+            self.discard_pending()
+            raise
+        self.update_views(items)
+
+        stats["decoded"] = len(decoded)
+        return stats
+
+    # Items with the decoded attributes merged in, the latest state view and the rollups are optional. The
+    # rollups wait for flush_published
+    def update_views(self, items):
+        if self.latest is not None:
+            with self.metrics.timer("latest"):
+                self.latest.update(items)
+        if self.rollups is not None:
+            self.pending_rollups.extend(items)
+
+    @staticmethod
+    def merge_parsed(event, parsed):
+        if parsed is None:
+            return event
+        item = dict(event)
+        item.update(Server.parsed_attributes(parsed))
+        return item
+
+    # DeviceData attributes for the decoded packets of a parse_payload result
+    @staticmethod
+    def parsed_attributes(parsed):
+        return dict((attribute, parsed[key]) for key, attribute in CODECS.attributes().items() if key in parsed)
+
+    def update_data(self, event, return_values=None):
+        if event is None:
+            return
+
+        responses = self.update_data_batch([event], return_values)
+        return responses[0] if responses else None
+
+    # All the updates of the same key are merged into one update_item. Without failed the first error
+    # raises, with it the key and error of every failed update are appended
+    def update_data_batch(self, events, return_values=None, failed=None):
+        with self.metrics.timer("update"):
+            responses = self._update_data_batch(events, return_values, failed)
+        self.metrics.count("updated", len(responses))
+        return responses
 
+    def _update_data_batch(self, events, return_values, failed):
+        coalescer = UpdateCoalescer(self.table, return_values, self.call)
+        for event in events:
+            if event is not None:
+                coalescer.add(event, Server.parsed_attributes(event))
+
+        try:
+            responses = coalescer.flush(failed)
         except Exception as e:
-            print(e)
+            self.log.error("update_item failed: %s", e)
             raise NotFoundError("Error updating an element on dynamodb")
 
-    # NotifySNS sends a mail
-    def dispatch_alarm(self, virtual_tx, data):
-        is_alarm_activated = False
-
-        if "KA" in data:
-            voltage = float(data["KA"]["voltage"])
-            if voltage <= 2.65:
-                is_alarm_activated = True
+        if responses:
+            self.log.debug("print: Data persisted")
+        return responses
 
-        if not is_alarm_activated:
+    def dispatch_alarm(self, virtual_tx, data):
+        self.dispatch_alarms([(virtual_tx, data)])
+
+    # records are (virtual_tx, parse_payload result), every alarm rule is evaluated over the whole batch.
+    # NotifySNS sends a mail. With an alarm tracker only state changes and re-notifications are sent
+    def dispatch_alarms(self, records):
+        with self.metrics.timer("alarm"):
+            evaluated = self.rules.stats["evaluated"]
+            for result in self.rules.evaluate(records, self.device):
+                self.notify_alarm(result)
+        self.metrics.count("rules_evaluated", self.rules.stats["evaluated"] - evaluated)
+
+    def notify_alarm(self, result):
+        if self.alarms is None:
+            transition = RAISED if result.triggered else None
+            notify = result.triggered
+        else:
+            transition, notify = self.alarms.update(result.dev_eui, result.rule.rule_id, result.triggered,
+                                                    result.recovered, result.value)
+
+        if not notify:
             return
 
-        data.update({"virtual_tx": virtual_tx})
-        expected_message = json.dumps(data)
-        self.log.debug("dispatch_alarm virtual_tx:" + virtual_tx)
-        self.sns_client.publish(
-            TopicArn="arn:aws:sns:eu-west-1:488643450383:NotifySNS",
-            Subject="Triggered Alarm " + data["DevEUI"],
-            Message=expected_message
-        )
+        subject = result.rule.subject.format(transition="Cleared" if transition == CLEARED else "Triggered",
+                                             rule_id=result.rule.rule_id, DevEUI=result.dev_eui)
+        data = dict(result.record) if result.record is not None else {"DevEUI": result.dev_eui}
+        data["virtual_tx"] = result.virtual_tx
+        if result.rule.tag:
+            data.update({"alarm": result.rule.rule_id, "value": result.value})
+        self.log.debug("dispatch_alarm virtual_tx:%s", result.virtual_tx)
+        self.metrics.count("alarms_notified")
+        self.publish(NOTIFY_TOPIC, subject, serialization.dumps(data))
+
+    # Scheduled check of the devices whose keep alive is overdue, over the latest state view
+    def check_overdue(self, latest_items, now_millis):
+        with self.metrics.timer("alarm"):
+            self.prefetch_devices(latest_items)
+            for result in self.rules.overdue(latest_items, now_millis, self.device):
+                self.notify_alarm(result)
+
+    # All the GEO positions of an invocation are evaluated together, enter and exit events go to NotifySNS
+    def dispatch_geofences(self, parsed_events):
+        if self.geofences is None:
+            return
+        with self.metrics.timer("geofence"):
+            events = self.geofences.evaluate(parsed_events)
+            for event in events:
+                subject = "Geofence " + event["event"] + " " + event["name"] + " " + event["DevEUI"]
+                self.publish(NOTIFY_TOPIC, subject, serialization.dumps(event))
+        self.metrics.count("geofence_events", len(events))
 
     @staticmethod
-    def parse_payload(body):
+    def parse_payload(body, model=None, log=None):
         try:
-            payload = body["payload"]
-            str_packet_id = payload[:2]
-
-            if str_packet_id == "10":
-                return {"timeStamp": body["timeStamp"], "DevEUI": body["DevEUI"], "GEO": extract_lat_long(payload)}
-            elif str_packet_id == "02":
-                return {"timeStamp": body["timeStamp"], "DevEUI": body["DevEUI"], "KA": extract_keep_alive(payload)}
+            decoded = CODECS.decode(body["payload"], model, log)
+            if decoded is not None:
+                name, value = decoded
+                return {"timeStamp": body["timeStamp"], "DevEUI": body["DevEUI"], name: value}
 
         except Exception as e:
-            print(e)
+            if log is not None:
+                log.error("Payload of %s not decoded: %s", body.get("DevEUI"), e)
 
         return None
 
     @staticmethod
     def parse_lora_json(json_body):
-        jsonbody = json.loads(json_body)
+        jsonbody = serialization.loads(json_body)
         time = jsonbody["DevEUI_uplink"]["Time"]
         payload = jsonbody["DevEUI_uplink"]["payload_hex"]
         device_id = jsonbody["DevEUI_uplink"]["DevAddr"]
@@ -150,12 +475,10 @@ class Server:
         hash_object = hashlib.sha256(virtual_tx.encode())
         hex_dig = hash_object.hexdigest()
 
-        dt = dateutil.parser.parse(time)
-        strftime = dt.strftime("%s")
-        time_millis = int(strftime) * 1000
+        time_millis = to_epoch_millis(time)
 
         return {"virtual_tx": hex_dig, "time_json": time, "timeStamp": time_millis, "payload": payload,
-                "DevEUI": device_id, "type": "LORA", "extra": json.dumps(jsonbody)}
+                "DevEUI": device_id, "type": "LORA", "extra": json_body}
 
     @staticmethod
     def parse_sigfox_dic(sigfox_dic):
@@ -0,0 +1,79 @@
+"""
+Epoch milliseconds from the ISO-8601 times sent by the LoRa network server, like
+2017-03-11T11:52:50.412+01:00. The fixed layout is read with slicing, any other
+format goes through dateutil.
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+import calendar
+from datetime import date
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+MAX_MEMO_ENTRIES = 256
+
+# Recently seen timezone suffixes ("+01:00", "Z") and their offset in milliseconds
+_offsets = {}
+
+
+def to_epoch_millis(text):
+    try:
+        return _fast_epoch_millis(text)
+    except (ValueError, IndexError, KeyError):
+        return _dateutil_epoch_millis(text)
+
+
+def _fast_epoch_millis(text):
+    if text[4] != "-" or text[7] != "-" or text[10] not in "Tt" or text[13] != ":" or text[16] != ":":
+        raise ValueError("Not the network server time format: " + text)
+
+    days = date(int(text[0:4]), int(text[5:7]), int(text[8:10])).toordinal() - EPOCH_ORDINAL
+    hour, minute, second = int(text[11:13]), int(text[14:16]), int(text[17:19])
+    if hour > 23 or minute > 59 or second > 59:
+        raise ValueError("Time out of range: " + text)
+
+    position = 19
+    millis = 0
+    if len(text) > position and text[position] == ".":
+        end = position + 1
+        while end < len(text) and text[end].isdigit():
+            end += 1
+        fraction = text[position + 1:end]
+        if not fraction:
+            raise ValueError("Empty fraction: " + text)
+        millis = int(fraction[:3].ljust(3, "0"))
+        position = end
+
+    offset = _offset_millis(text[position:])
+    return (((days * 24 + hour) * 60 + minute) * 60 + second) * 1000 + millis - offset
+
+
+def _offset_millis(suffix):
+    offset = _offsets.get(suffix)
+    if offset is not None:
+        return offset
+
+    if suffix in ("Z", "z"):
+        offset = 0
+    elif len(suffix) == 6 and suffix[0] in "+-" and suffix[3] == ":":
+        offset = (int(suffix[1:3]) * 60 + int(suffix[4:6])) * 60000
+        if suffix[0] == "-":
+            offset = -offset
+    else:
+        raise KeyError(suffix)
+
+    if len(_offsets) >= MAX_MEMO_ENTRIES:
+        _offsets.clear()
+    _offsets[suffix] = offset
+    return offset
+
+
+# Times without a timezone are taken as UTC, never as the host timezone
+def _dateutil_epoch_millis(text):
+    from dateutil import parser
+    dt = parser.parse(text)
+    if dt.tzinfo is not None:
+        dt = dt - dt.utcoffset()
+    return calendar.timegm(dt.timetuple()) * 1000 + dt.microsecond // 1000
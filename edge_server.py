@@ -0,0 +1,227 @@
+"""
+Standalone asyncio ingestion server for our own hosts. It takes the same /lora and
+/sigfox requests as the Chalice app, parses them with Server and micro-batches the
+uplinks into bulk SNS publishes or DynamoDB writes.
+
+Uplinks are acknowledged once they are queued. When the sink lags behind, the queue
+fills up and new requests wait, and get a 503 if no room is made in time, so the
+network server retries them later. A batch the sink keeps failing after it was
+acknowledged goes to the dead letter file, see replay_dead_letters.py.
+
+    $ python edge_server.py --port 8080 --sink sns
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+from aiohttp import web
+
+from chalicelib import clients
+from chalicelib.deadletter import DeadLetterSink, STORE
+from chalicelib.dedup import Deduplicator
+from chalicelib.publisher import BatchPublisher
+from chalicelib.retry import backoff_delay
+from chalicelib.server import Server
+
+
+class MicroBatcher:
+    # sink is called from a worker thread with a list of parsed uplinks, one batch at a time. A failing batch
+    # is tried max_retries more times, then its uplinks go to dead_letters, already acknowledged as they are
+    def __init__(self, sink, log, max_batch=100, max_latency=0.05, max_pending=1000, dead_letters=None,
+                 max_retries=3, backoff_base=0.1):
+        self.sink = sink
+        self.log = log
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.max_pending = max_pending
+        self.dead_letters = dead_letters
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.queue = None
+        self.task = None
+        self.stats = {"accepted": 0, "rejected": 0, "batches": 0, "flushed": 0, "retries": 0, "errors": 0,
+                      "dead_letters": 0}
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_pending)
+        self.task = asyncio.ensure_future(self._run())
+
+    # Waits up to timeout for room in the queue, False means the sink is lagging
+    async def put(self, event, timeout=1.0):
+        try:
+            await asyncio.wait_for(self.queue.put(event), timeout)
+        except asyncio.TimeoutError:
+            self.stats["rejected"] += 1
+            return False
+        self.stats["accepted"] += 1
+        return True
+
+    async def stop(self):
+        await self.queue.join()
+        self.task.cancel()
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    await asyncio.sleep(min(remaining, 0.005))
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        loop = asyncio.get_event_loop()
+        for attempt in range(self.max_retries + 1):
+            try:
+                await loop.run_in_executor(None, self.sink, batch)
+            except Exception as e:
+                self.log.error("Sink failed for %d uplinks: %s", len(batch), e)
+                if attempt < self.max_retries:
+                    self.stats["retries"] += 1
+                    await asyncio.sleep(backoff_delay(attempt, self.backoff_base))
+                    continue
+                self.stats["errors"] += len(batch)
+                self._dead_letter(batch, e)
+            else:
+                self.stats["flushed"] += len(batch)
+            break
+        self.stats["batches"] += 1
+        for _ in batch:
+            self.queue.task_done()
+
+    def _dead_letter(self, batch, error):
+        for event in batch:
+            try:
+                if self.dead_letters is None:
+                    raise ValueError("no dead letter sink")
+                self.dead_letters.add(STORE, event, error)
+                self.stats["dead_letters"] += 1
+            except Exception as e:
+                self.log.error("Uplink virtual_tx:%s lost: %s", event.get("virtual_tx"), e)
+
+
+def sns_sink(server):
+    def sink(batch):
+        for event in batch:
+            server.publish_data_store_device(event)
+        server.flush_published()
+    return sink
+
+
+def dynamodb_sink(server, fused=False):
+    def sink(batch):
+        if fused:
+            server.persist_and_parse(batch)
+        else:
+            server.persist_data_batch(batch)
+            for event in batch:
+                server.publish_data_payload_parser(event)
+        server.flush_published()
+    return sink
+
+
+class EdgeServer:
+    def __init__(self, server, batcher, log, put_timeout=1.0):
+        self.server = server
+        self.batcher = batcher
+        self.log = log
+        self.put_timeout = put_timeout
+
+    def application(self):
+        application = web.Application()
+        application.router.add_post('/lora', self.lora)
+        application.router.add_put('/lora', self.lora)
+        application.router.add_get('/sigfox', self.sigfox)
+        application.router.add_get('/stats', self.stats)
+        application.on_startup.append(self._start)
+        application.on_cleanup.append(self._stop)
+        return application
+
+    async def lora(self, request):
+        try:
+            body = json.loads((await request.read()).decode())
+            parsed_json = Server.parse_lora_json(body["body"])
+        except (KeyError, ValueError, TypeError):
+            self.log.error("Error parsing LORA document")
+            raise web.HTTPBadRequest(text="Error parsing LORA document")
+        await self._enqueue(parsed_json)
+        return web.json_response(parsed_json)
+
+    async def sigfox(self, request):
+        try:
+            parsed_dic = Server.parse_sigfox_dic({"query_params": dict(request.query)})
+        except (KeyError, ValueError):
+            self.log.error("Error parsing SIGFOX document")
+            raise web.HTTPBadRequest(text="Error parsing SIGFOX document")
+        await self._enqueue(parsed_dic)
+        return web.Response(text='', content_type='text/plain')
+
+    async def stats(self, request):
+        stats = {"batcher": self.batcher.stats}
+        if self.server.deduplicator is not None:
+            stats["dedup"] = self.server.deduplicator.stats
+        return web.json_response(stats)
+
+    # The uplink is claimed before it is queued, and the claim is released when it is rejected, so the
+    # retry of the network server is not dropped as a duplicate
+    async def _enqueue(self, event):
+        if self.server.is_duplicate(event):
+            return
+        if not await self.batcher.put(event, self.put_timeout):
+            if self.server.deduplicator is not None:
+                self.server.deduplicator.release(event["virtual_tx"])
+            raise web.HTTPServiceUnavailable(text="Ingestion queue is full")
+
+    async def _start(self, application):
+        await self.batcher.start()
+
+    async def _stop(self, application):
+        await self.batcher.stop()
+
+
+def build(args, log):
+    sns_client = clients.sns_client()
+    server = Server(clients.dynamodb_table(args.table), None, sns_client, log,
+                    publisher=BatchPublisher(sns_client, log), deduplicator=Deduplicator(log))
+    if args.sink == 'sns':
+        sink = sns_sink(server)
+    else:
+        sink = dynamodb_sink(server, args.sink == 'fused')
+    batcher = MicroBatcher(sink, log, args.max_batch, args.max_latency, args.max_pending,
+                           DeadLetterSink(log, args.dead_letter_file))
+    return EdgeServer(server, batcher, log)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="IoT Partners edge ingestion server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--sink', choices=['sns', 'dynamodb', 'fused'], default='sns')
+    parser.add_argument('--table', default=os.getenv('APP_TABLE_NAME', 'DeviceData'))
+    parser.add_argument('--max-batch', type=int, default=100)
+    parser.add_argument('--max-latency', type=float, default=0.05, help="seconds a batch waits to fill up")
+    parser.add_argument('--max-pending', type=int, default=1000, help="queued uplinks before backpressure")
+    parser.add_argument('--dead-letter-file', default='edge_dead_letters.ndjson',
+                        help="NDJSON file with the acknowledged uplinks the sink could not take")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    log = logging.getLogger('edge_server')
+    web.run_app(build(args, log).application(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Exports DeviceData to a file, for a list of devices with one Query per device or for
+the whole table with a parallel Scan.
+
+    $ python export_data.py --format columnar --output march.ddxc --from 2018-03-01T00:00:00Z --to 2018-03-31T23:59:59Z
+    $ python export_data.py --format parquet --output fleet.parquet --devices 260113E3,260113E4
+    $ python export_data.py --format ndjson --output - --devices 260113E3 | gzip > 260113E3.ndjson.gz
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+from chalicelib import clients
+from chalicelib import export
+from chalicelib.query import MAX_TIMESTAMP, default_fields, parse_fields, parse_timestamp
+
+
+def items(args, table, fields):
+    start = parse_timestamp(args.start, 0)
+    end = parse_timestamp(args.end, MAX_TIMESTAMP)
+    if args.devices:
+        return export.query_items(table, [dev_eui for dev_eui in args.devices.split(",") if dev_eui], start, end,
+                                  fields)
+    return export.scan_items(table, start, end, fields, args.segments)
+
+
+def writer(args):
+    if args.format == "parquet":
+        return export.ParquetWriter(args.output, args.chunk_rows)
+    stream = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    if args.format == "ndjson":
+        return export.NdjsonWriter(stream)
+    return export.ColumnarWriter(stream, args.chunk_rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DeviceData export")
+    parser.add_argument('--table', default=os.getenv('APP_TABLE_NAME', 'DeviceData'))
+    parser.add_argument('--format', choices=['columnar', 'parquet', 'ndjson'], default='columnar')
+    parser.add_argument('--output', required=True, help="file name, - writes columnar and ndjson to stdout")
+    parser.add_argument('--devices', help="comma separated DevEUIs, the whole table is scanned without them")
+    parser.add_argument('--from', dest='start', help="epoch milliseconds or ISO-8601")
+    parser.add_argument('--to', dest='end', help="epoch milliseconds or ISO-8601")
+    parser.add_argument('--fields', help="ndjson attributes, every one but extra by default")
+    parser.add_argument('--segments', type=int, default=export.SCAN_SEGMENTS, help="parallel Scan segments")
+    parser.add_argument('--chunk-rows', type=int, default=export.CHUNK_ROWS, help="rows held in memory")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    log = logging.getLogger('export_data')
+
+    if args.format == "ndjson":
+        fields = parse_fields(args.fields) if args.fields else default_fields()
+    else:
+        fields = export.EXPORT_FIELDS
+
+    started = time.time()
+    rows = export.export(items(args, clients.dynamodb_table(args.table), fields), writer(args))
+    log.info("Exported %d items in %.1fs", rows, time.time() - started)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Sends the dead letters of the SNS triggered Lambdas through their stage again, with the
+same configuration as the Lambdas. They are read from an SQS queue subscribed to
+DEAD_LETTER_TOPIC, and the messages that fail again stay in the queue. They can also be
+read from an NDJSON file, the entries that fail again are written back to it, so it can
+be run until the file is empty.
+
+    $ python replay_dead_letters.py --queue https://sqs.eu-west-1.amazonaws.com/488643450383/DeadLetters
+    $ python replay_dead_letters.py dead_letters.ndjson
+    $ PIPELINE_MODE=fused python replay_dead_letters.py dead_letters.ndjson
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import argparse
+import logging
+import os
+
+import app
+from chalicelib import clients
+from chalicelib import deadletter
+
+
+def replay_file(args, log):
+    with open(args.path) as stream:
+        entries = deadletter.read_dead_letters(stream)
+    pending = deadletter.pending(entries)
+    log.info("%d dead letters, %d to replay", len(entries), len(pending))
+    if args.dry_run:
+        return
+
+    failed = deadletter.replay(app.get_server(), pending, app.PIPELINE_MODE == 'fused')
+    replaced = args.path + ".tmp"
+    with open(replaced, "w") as stream:
+        deadletter.write_dead_letters(stream, failed)
+    os.replace(replaced, args.path)
+    log.info("%d replayed, %d failed again", len(pending) - len(failed), len(failed))
+
+
+def replay_queue(args, log):
+    sqs_client = clients.sqs_client()
+    if args.dry_run:
+        attributes = sqs_client.get_queue_attributes(QueueUrl=args.queue,
+                                                     AttributeNames=["ApproximateNumberOfMessages"])
+        log.info("About %s dead letters to replay", attributes["Attributes"]["ApproximateNumberOfMessages"])
+        return
+
+    stats = deadletter.drain_queue(app.get_server(), sqs_client, args.queue, app.PIPELINE_MODE == 'fused',
+                                   args.max_messages)
+    log.info("%d received, %d replayed, %d failed again, %d unreadable", stats["received"], stats["replayed"],
+             stats["failed"], stats["unreadable"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dead letter replay")
+    parser.add_argument('path', nargs='?', help="NDJSON file with one dead letter per line")
+    parser.add_argument('--queue', help="URL of the SQS queue subscribed to DEAD_LETTER_TOPIC")
+    parser.add_argument('--max-messages', type=int, default=100, help="queue messages replayed at once")
+    parser.add_argument('--dry-run', action='store_true', help="only count the entries that would be sent")
+    args = parser.parse_args()
+    if (args.path is None) == (args.queue is None):
+        parser.error("give either a file or --queue")
+
+    logging.basicConfig(level=logging.INFO)
+    log = logging.getLogger('replay_dead_letters')
+
+    if args.queue is not None:
+        replay_queue(args, log)
+    else:
+        replay_file(args, log)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Decodes the payloads stored at DeviceData again and writes back the geo and ka that
+changed, after a decoder is fixed or a packet type is added. Progress is saved to the
+checkpoint file after every page, run the same command again to resume.
+
+    $ python reprocess_data.py --checkpoint backfill.json --write-units 200 --read-units 400
+    $ python reprocess_data.py --dry-run --segments 8
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import argparse
+import logging
+import os
+import time
+
+from chalicelib import backfill
+from chalicelib import clients
+from chalicelib.registry import DeviceRegistry
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DeviceData reprocessing")
+    parser.add_argument('--table', default=os.getenv('APP_TABLE_NAME', 'DeviceData'))
+    parser.add_argument('--devices-table', default=os.getenv('DEVICES_TABLE_NAME'),
+                        help="device registry with the codec or model of every device")
+    parser.add_argument('--checkpoint', help="JSON file with the position of every segment")
+    parser.add_argument('--segments', type=int, default=backfill.SCAN_SEGMENTS, help="parallel Scan segments")
+    parser.add_argument('--workers', type=int, help="decoding processes, one per CPU by default, 0 for none")
+    parser.add_argument('--page-size', type=int, default=backfill.PAGE_SIZE, help="items per Scan page")
+    parser.add_argument('--read-units', type=float, help="read capacity units per second")
+    parser.add_argument('--write-units', type=float, help="write capacity units per second")
+    parser.add_argument('--dry-run', action='store_true', help="count the items that would change")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    log = logging.getLogger('reprocess_data')
+
+    registry = DeviceRegistry(clients.dynamodb_table(args.devices_table), log) if args.devices_table else None
+    started = time.time()
+    stats = backfill.Backfill(clients.dynamodb_table(args.table), log, registry, args.segments, args.workers,
+                              args.read_units, args.write_units, args.checkpoint, args.page_size,
+                              args.dry_run).run()
+    log.info("%s in %.1fs", stats, time.time() - started)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""
+Offline end-to-end benchmark. It drives the app.py handlers and Server with the
+in-memory SNS and DynamoDB stand-ins used by the tests, so nothing leaves the laptop.
+
+Every uplink goes through /lora or /sigfox, realtime_lambda_function and
+realtime_parsing_payload, and every stage reports its throughput and p50/p99 latency.
+The p50 of every stage is compared with the stored baseline and the run fails when
+one of them is slower than the tolerance allows.
+
+    $ python test/benchmark.py --uplinks 10000 --save-baseline
+    $ python test/benchmark.py --uplinks 10000 --tolerance 1.5
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app
+from chalicelib.alarms import AlarmTracker
+from chalicelib.dedup import Deduplicator
+from chalicelib.publisher import BatchPublisher
+from chalicelib.server import Server
+from test.test_app import TestDynamoDB, TestLog, TestSNS
+
+BASELINE = os.path.join(ROOT, "test", "benchmark_baseline.json")
+
+STAGES = ["ingest", "parse", "publish", "persist", "decode", "alarm", "update",
+          "realtime_lambda_function", "realtime_parsing_payload"]
+
+
+class BenchmarkRequest:
+    def __init__(self, json_body=None, query_params=None):
+        self.json_body = json_body
+        self.query_params = query_params
+
+    def to_dict(self):
+        return {"query_params": self.query_params}
+
+
+class StageTimer:
+    def __init__(self):
+        self.durations = dict((stage, []) for stage in STAGES)
+
+    def wrap(self, stage, function):
+        durations = self.durations[stage]
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                durations.append(time.perf_counter() - start)
+        return timed
+
+    def report(self):
+        report = {}
+        for stage in STAGES:
+            durations = sorted(self.durations[stage])
+            if not durations:
+                continue
+            total = sum(durations)
+            report[stage] = {"calls": len(durations),
+                             "per_second": round(len(durations) / total, 1) if total > 0 else 0.0,
+                             "p50_us": round(percentile(durations, 0.50) * 1e6, 2),
+                             "p99_us": round(percentile(durations, 0.99) * 1e6, 2)}
+        return report
+
+
+def percentile(ordered, fraction):
+    return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+
+def lora_body(i, rnd):
+    millis = 1489229570000 + i * 1000
+    seconds, millis = divmod(millis, 1000)
+    when = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds)) + ".%03d+00:00" % millis
+    if rnd.random() < 0.5:
+        payload = "10%06x%06x0734" % (rnd.randint(0, 0xFFFFFF), rnd.randint(0, 0xFFFFFF))
+    else:
+        payload = "02%02x%04x" % (rnd.randint(1, 48), rnd.randint(2500, 3100))
+    return json.dumps({"DevEUI_uplink": {"Time": when, "DevEUI": "0004A30B001C%04X" % (i % 500),
+                                         "payload_hex": payload, "DevAddr": "2601%04X" % (i % 500)}})
+
+
+def sigfox_params(i, rnd):
+    return {"time": str(1515360218 + i), "id": "SIG%04X" % (i % 500),
+            "data": "02%02x%04x" % (rnd.randint(1, 48), rnd.randint(2500, 3100))}
+
+
+# Stage timers go on the Server instance and on its static parsers, app.py is used untouched
+def instrument(server, timer):
+    server.publish_data_store_device = timer.wrap("publish", server.publish_data_store_device)
+    server.publish_data_payload_parser = timer.wrap("publish", server.publish_data_payload_parser)
+    server.persist_data_batch = timer.wrap("persist", server.persist_data_batch)
+    server.dispatch_alarms = timer.wrap("alarm", server.dispatch_alarms)
+    server.update_data_batch = timer.wrap("update", server.update_data_batch)
+
+    originals = {name: getattr(Server, name) for name in ["parse_lora_json", "parse_sigfox_dic", "parse_payload"]}
+    Server.parse_lora_json = staticmethod(timer.wrap("parse", originals["parse_lora_json"]))
+    Server.parse_sigfox_dic = staticmethod(timer.wrap("parse", originals["parse_sigfox_dic"]))
+    Server.parse_payload = staticmethod(timer.wrap("decode", originals["parse_payload"]))
+    return originals
+
+
+def run(uplinks, records_per_invocation, seed):
+    rnd = random.Random(seed)
+    log = TestLog()
+    store_sns, parser_sns = TestSNS(), TestSNS()
+    device_data = TestDynamoDB()
+    server = Server(device_data, TestDynamoDB(), store_sns, log, publisher=BatchPublisher(store_sns, log),
+                    deduplicator=Deduplicator(log), alarms=AlarmTracker(log), metrics=app.metrics)
+    emitted = []
+    app.metrics.emit = emitted.append
+    timer = StageTimer()
+    originals = instrument(server, timer)
+    app._server = server
+    lora = timer.wrap("ingest", app.lora)
+    sigfox = timer.wrap("ingest", app.sigfox)
+    realtime_lambda_function = timer.wrap("realtime_lambda_function", app.realtime_lambda_function)
+    realtime_parsing_payload = timer.wrap("realtime_parsing_payload", app.realtime_parsing_payload)
+
+    start = time.perf_counter()
+    try:
+        for i in range(uplinks):
+            if i % 2 == 0:
+                app.app.current_request = BenchmarkRequest(json_body={"body": lora_body(i, rnd)})
+                lora()
+            else:
+                app.app.current_request = BenchmarkRequest(query_params=sigfox_params(i, rnd))
+                sigfox()
+
+        stored = [entry["Message"] for _, entries in store_sns.batches for entry in entries]
+        server.sns_client = parser_sns
+        server.publisher.sns_client = parser_sns
+        for first in range(0, len(stored), records_per_invocation):
+            records = [{"Sns": {"Message": message}} for message in stored[first:first + records_per_invocation]]
+            realtime_lambda_function({"Records": records}, None)
+
+        parsed = [entry["Message"] for _, entries in parser_sns.batches for entry in entries]
+        for first in range(0, len(parsed), records_per_invocation):
+            records = [{"Sns": {"Message": message}} for message in parsed[first:first + records_per_invocation]]
+            realtime_parsing_payload({"Records": records}, None)
+    finally:
+        app.metrics.emit = print
+        for name, function in originals.items():
+            setattr(Server, name, staticmethod(function))
+    elapsed = time.perf_counter() - start
+
+    return {"uplinks": uplinks, "uplinks_per_second": round(uplinks / elapsed, 1),
+            "persisted": len(device_data.batch_written), "metric_records": len(emitted), "stages": timer.report()}
+
+
+def regressions(result, baseline, tolerance):
+    found = []
+    for stage, stats in result["stages"].items():
+        previous = baseline["stages"].get(stage)
+        if previous and stats["p50_us"] > previous["p50_us"] * tolerance:
+            found.append("%s p50 %.2fus > %.2fus x %.2f" % (stage, stats["p50_us"], previous["p50_us"], tolerance))
+    return found
+
+
+def print_result(result):
+    print("%d uplinks, %.1f uplinks/s end to end, %d items persisted"
+          % (result["uplinks"], result["uplinks_per_second"], result["persisted"]))
+    print("%-26s %8s %12s %10s %10s" % ("stage", "calls", "calls/s", "p50 us", "p99 us"))
+    for stage in STAGES:
+        stats = result["stages"].get(stage)
+        if stats:
+            print("%-26s %8d %12.1f %10.2f %10.2f"
+                  % (stage, stats["calls"], stats["per_second"], stats["p50_us"], stats["p99_us"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark")
+    parser.add_argument("--uplinks", type=int, default=10000)
+    parser.add_argument("--records", type=int, default=25, help="SNS records per Lambda invocation")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="allowed p50 slowdown over the baseline")
+    args = parser.parse_args()
+
+    app.app.log.setLevel(logging.WARNING)
+    result = run(args.uplinks, args.records, args.seed)
+    print_result(result)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(result, baseline_file, indent=2, sort_keys=True)
+        print("Baseline saved to " + args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline at " + args.baseline + ", run with --save-baseline first")
+        return 0
+
+    with open(args.baseline) as baseline_file:
+        found = regressions(result, json.load(baseline_file), args.tolerance)
+    for regression in found:
+        print("REGRESSION " + regression)
+    return 1 if found else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+"""
+Import time and cold start benchmark. Every run starts a fresh interpreter, as a new
+Lambda container would, and reports the milliseconds spent per module and per client.
+
+    $ python test/cold_start_benchmark.py [runs]
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imported in this order, so every module only reports what it adds on top of the previous ones
+MODULES = ["json", "chalice", "chalicelib.server", "app", "dateutil.parser", "boto3"]
+
+CHILD = """
+import json, time, importlib
+result = {"modules": {}, "clients": {}}
+for name in %r:
+    start = time.perf_counter()
+    importlib.import_module(name)
+    result["modules"][name] = (time.perf_counter() - start) * 1000
+
+import app
+start = time.perf_counter()
+app.index()
+result["index"] = (time.perf_counter() - start) * 1000
+
+from chalicelib import clients
+start = time.perf_counter()
+app.get_server()
+result["get_server"] = (time.perf_counter() - start) * 1000
+result["clients"] = dict(clients.timings)
+print(json.dumps(result))
+""" % (MODULES,)
+
+
+def run_once():
+    env = dict(os.environ)
+    env.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+    output = subprocess.check_output([sys.executable, "-c", CHILD], cwd=ROOT, env=env)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(runs):
+    results = [run_once() for _ in range(runs)]
+
+    print("Median of " + str(runs) + " cold starts (ms)")
+    for name in MODULES:
+        print("  import %-20s %8.2f" % (name, median([r["modules"][name] for r in results])))
+    print("  %-27s %8.2f" % ("index()", median([r["index"] for r in results])))
+    for name in sorted(results[0]["clients"]):
+        print("  client %-20s %8.2f" % (name, median([r["clients"][name] for r in results])))
+    print("  %-27s %8.2f" % ("get_server() total", median([r["get_server"] for r in results])))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
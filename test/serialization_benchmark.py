@@ -0,0 +1,98 @@
+"""
+Micro-benchmark of the JSON work done for one LoRa uplink across both SNS hops,
+before and after the serialization layer. It first checks every message published
+against the one the previous hops published: `extra` now carries the request body as
+received, so it only has to hold the same document, every other field has to be
+encoded byte for byte the same.
+
+    $ python test/serialization_benchmark.py [uplinks]
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chalicelib import serialization
+from chalicelib.server import Server
+
+UPLINK = '{"DevEUI_uplink": {"Time": "2017-03-11T11:52:50.%03d+01:00","DevEUI": "0004A30B001C3306",' \
+         '"FPort": "7","FCntUp": "1","MType": "2","FCntDn": "2","payload_hex": "10bb17f18198100734",' \
+         '"mic_hex": "c00c1cfa","Lrcid": "00000127","LrrRSSI": "-64.000000","LrrSNR": "9.000000",' \
+         '"SpFact": "11","SubBand": "G1","Channel": "LC2","DevLrrCnt": "1","Lrrid": "08060412","Late":' \
+         ' "0","LrrLAT": "41.550377","LrrLON": "2.241691","Lrrs": {"Lrr": {"Lrrid": "08060412",' \
+         '"Chain": "0","LrrRSSI": "-64.000000","LrrSNR": "9.000000","LrrESP": "-64.514969"}},' \
+         '"CustomerID": "100001774","CustomerData": {"alr":{"pro":"LORA/Generic","ver":"1"}},' \
+         '"ModelCfg": "0","DevAddr": "260113E2","AckRequested": "0","rawMacCommands": "0703070307030703"}}'
+
+
+# What every hop did before: re-encode extra, then decode and encode again on each SNS hop
+def previous_hops(body):
+    parsed = Server.parse_lora_json(body)
+    parsed["extra"] = json.dumps(json.loads(body))
+    store_message = json.dumps(parsed)
+    parser_message = json.dumps(json.loads(store_message))
+    json.loads(parser_message)
+    return store_message, parser_message
+
+
+def current_hops(body):
+    parsed = Server.parse_lora_json(body)
+    store_message = serialization.dumps(parsed)
+    serialization.loads(store_message)
+    parser_message = store_message
+    serialization.loads(parser_message)
+    return store_message, parser_message
+
+
+# The message without extra, encoded again, and the document extra holds
+def split_extra(message):
+    data = json.loads(message)
+    extra = json.loads(data.pop("extra"))
+    return json.dumps(data), extra
+
+
+def check_compatibility(bodies):
+    changed_extra = 0
+    for body in bodies:
+        previous_store, previous_parser = previous_hops(body)
+        current_store, current_parser = current_hops(body)
+
+        for previous, current, topic in [(previous_store, current_store, "StoreDeviceData"),
+                                         (previous_parser, current_parser, "PayloadParser")]:
+            if split_extra(previous) != split_extra(current):
+                raise AssertionError(topic + " message differs for " + body)
+            if previous != current:
+                changed_extra += 1
+        if serialization.loads(current_store) != json.loads(current_store):
+            raise AssertionError("Decoded message differs for " + body)
+    return changed_extra
+
+
+def measure(hops, bodies):
+    start = time.perf_counter()
+    for body in bodies:
+        hops(body)
+    return time.perf_counter() - start
+
+
+def main(count):
+    bodies = [UPLINK % (i % 1000) for i in range(count)]
+    changed_extra = check_compatibility(bodies)
+
+    previous = min(measure(previous_hops, bodies) for _ in range(3))
+    current = min(measure(current_hops, bodies) for _ in range(3))
+
+    print("Decoding backend: " + serialization.BACKEND)
+    print("Messages compatible: %d, with extra encoded differently: %d" % (count * 2, changed_extra))
+    print("previous: %8.2f us per uplink" % (previous / count * 1e6))
+    print("current:  %8.2f us per uplink (%.1fx)" % (current / count * 1e6, previous / current))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,70 @@
+"""
+Bytes and write units of a DeviceData item with the plain and the compact storage
+encodings, for LoRa uplinks heard by 1, 3 and 8 gateways and for Sigfox uplinks.
+
+    $ python test/storage_benchmark.py
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chalicelib import compact
+from chalicelib.server import Server
+
+
+def lora_uplink(gateways):
+    lrrs = [{"Lrrid": "0806%04d" % i, "Chain": "0", "LrrRSSI": "-%d.000000" % (64 + i), "LrrSNR": "9.000000",
+             "LrrESP": "-64.514969"} for i in range(gateways)]
+    uplink = {"Time": "2017-03-11T11:52:50.412+01:00", "DevEUI": "0004A30B001C3306", "FPort": "7",
+              "FCntUp": "1", "MType": "2", "FCntDn": "2", "payload_hex": "10bb17f18198100734",
+              "mic_hex": "c00c1cfa", "Lrcid": "00000127", "LrrRSSI": "-64.000000", "LrrSNR": "9.000000",
+              "SpFact": "11", "SubBand": "G1", "Channel": "LC2", "DevLrrCnt": str(gateways), "Lrrid": "08060412",
+              "Late": "0", "LrrLAT": "41.550377", "LrrLON": "2.241691",
+              "Lrrs": {"Lrr": lrrs[0] if gateways == 1 else lrrs}, "CustomerID": "100001774",
+              "CustomerData": {"alr": {"pro": "LORA/Generic", "ver": "1"}}, "ModelCfg": "0",
+              "DevAddr": "260113E2", "AckRequested": "0", "rawMacCommands": "0703070307030703"}
+    return json.dumps({"DevEUI_uplink": uplink})
+
+
+def items():
+    found = [("LoRa, %d gateway%s" % (gateways, "s" if gateways > 1 else ""),
+              Server.parse_lora_json(lora_uplink(gateways))) for gateways in [1, 3, 8]]
+    found.append(("Sigfox", Server.parse_sigfox_dic({"query_params": {"time": "1515360218", "id": "1C8A3E",
+                                                                      "data": "02180AE4"}})))
+    return found
+
+
+def run(number=1000):
+    results = []
+    for name, item in items():
+        encoded = compact.encode_item(item)
+        results.append({"item": name,
+                        "plain_bytes": compact.item_size(item),
+                        "compact_bytes": compact.item_size(encoded),
+                        "plain_wcu": compact.write_units(item),
+                        "compact_wcu": compact.write_units(encoded),
+                        "encode_us": round(timeit.timeit(lambda: compact.encode_item(item), number=number)
+                                           / number * 1e6, 2),
+                        "decode_us": round(timeit.timeit(lambda: compact.decode_item(encoded), number=number)
+                                           / number * 1e6, 2)})
+    return results
+
+
+def main():
+    print("%-20s %12s %14s %10s %12s %10s %10s"
+          % ("item", "plain bytes", "compact bytes", "plain WCU", "compact WCU", "encode us", "decode us"))
+    for result in run():
+        print("%-20s %12d %14d %10d %12d %10.2f %10.2f"
+              % (result["item"], result["plain_bytes"], result["compact_bytes"], result["plain_wcu"],
+                 result["compact_wcu"], result["encode_us"], result["decode_us"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Tests for the alarm state machine and the debounced dispatch_alarm
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+
+from chalicelib.alarms import AlarmTracker, RAISED, STILL_ACTIVE, CLEARED
+from chalicelib.server import Server
+from test.test_app import TestDynamoDB, TestLog, TestSNS, TestConditionalCheckFailed
+
+
+# put_item only replaces the version it is given, or an item without version
+class AlarmTable(TestDynamoDB):
+    def __init__(self):
+        TestDynamoDB.__init__(self, "AlarmState")
+        self.failing_reads = 0
+
+    def get_item(self, Key):
+        if self.failing_reads > 0:
+            self.failing_reads -= 1
+            raise Exception("ProvisionedThroughputExceededException")
+        return TestDynamoDB.get_item(self, Key)
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        stored = TestDynamoDB.get_item(self, {"alarm_id": Item["alarm_id"]}).get("Item", {})
+        if stored.get("version") != (ExpressionAttributeValues or {}).get(":version"):
+            raise TestConditionalCheckFailed()
+        TestDynamoDB.put_item(self, Item)
+
+
+def keep_alive(voltage):
+    return {"timeStamp": 1499366509000, "DevEUI": "260113E3", "KA": {"interval": "24", "voltage": voltage}}
+
+
+class AlarmTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.log = TestLog()
+
+    def test_transitions(self):
+        tracker = AlarmTracker(self.log, renotify_interval=3600)
+
+        self.assertEqual((None, False), tracker.update("D1", "low_voltage", False, True, now=0))
+        self.assertEqual((RAISED, True), tracker.update("D1", "low_voltage", True, False, now=10))
+        self.assertEqual((STILL_ACTIVE, False), tracker.update("D1", "low_voltage", True, False, now=20))
+        self.assertEqual((STILL_ACTIVE, True), tracker.update("D1", "low_voltage", True, False, now=3700))
+        self.assertEqual((STILL_ACTIVE, False), tracker.update("D1", "low_voltage", False, False, now=3800))
+        self.assertEqual((CLEARED, True), tracker.update("D1", "low_voltage", False, True, now=3900))
+        self.assertEqual((None, False), tracker.update("D1", "low_voltage", False, True, now=4000))
+
+    def test_state_is_per_device_and_type(self):
+        tracker = AlarmTracker(self.log)
+
+        self.assertEqual((RAISED, True), tracker.update("D1", "low_voltage", True, False, now=0))
+        self.assertEqual((RAISED, True), tracker.update("D2", "low_voltage", True, False, now=0))
+        self.assertEqual((RAISED, True), tracker.update("D1", "geofence", True, False, now=0))
+
+    def test_state_is_shared_through_table(self):
+        table = AlarmTable()
+        AlarmTracker(self.log, table).update("D1", "low_voltage", True, False, now=10)
+
+        other_container = AlarmTracker(self.log, table)
+        self.assertEqual((STILL_ACTIVE, False), other_container.update("D1", "low_voltage", True, False, now=20))
+        self.assertEqual(1, table.return_persisted_times())
+
+    def test_only_one_container_notifies_a_change(self):
+        table = AlarmTable()
+        tracker = AlarmTracker(self.log, table)
+        other_container = AlarmTracker(self.log, table)
+        self.assertEqual((None, False), tracker.update("D1", "low_voltage", False, True, now=0))
+
+        self.assertEqual((RAISED, True), other_container.update("D1", "low_voltage", True, False, now=10))
+        self.assertEqual((None, False), tracker.update("D1", "low_voltage", True, False, now=20))
+        self.assertEqual(1, tracker.stats["conflicts"])
+        # The state of the other container is read again
+        self.assertEqual((CLEARED, True), tracker.update("D1", "low_voltage", False, True, now=30))
+        self.assertEqual((None, False), other_container.update("D1", "low_voltage", False, True, now=40))
+        self.assertEqual(2, table.return_persisted_times())
+
+    def test_failed_read_is_not_cached(self):
+        table = AlarmTable()
+        AlarmTracker(self.log, table).update("D1", "low_voltage", True, False, now=10)
+        table.failing_reads = 1
+        tracker = AlarmTracker(self.log, table)
+
+        # Taken as inactive, but saving over the stored state fails
+        self.assertEqual((None, False), tracker.update("D1", "low_voltage", True, False, now=20))
+        self.assertEqual("Alarm state D1#low_voltage not read: ProvisionedThroughputExceededException",
+                         self.log.return_message())
+        self.assertEqual((STILL_ACTIVE, False), tracker.update("D1", "low_voltage", True, False, now=30))
+
+    def test_states_expire(self):
+        table = AlarmTable()
+        tracker = AlarmTracker(self.log, table, state_ttl=-1)
+        tracker.update("D1", "low_voltage", True, False, now=10)
+        TestDynamoDB.put_item(table, dict(table.return_persisted_item(), state="inactive", version=2))
+        self.assertEqual((RAISED, True), tracker.update("D1", "low_voltage", True, False, now=20))
+
+
+class DebouncedDispatchAlarmTest(unittest.TestCase):
+    def setUp(self):
+        self.sns_client = TestSNS()
+        self.log = TestLog()
+        self.server = Server(None, None, self.sns_client, self.log, alarms=AlarmTracker(self.log))
+
+    def test_dying_battery_notifies_once(self):
+        for i in range(20):
+            self.server.dispatch_alarm("A%03d" % i, keep_alive("2.456"))
+
+        self.assertEqual(1, self.sns_client.return_published_times())
+        self.assertEqual("Triggered Alarm 260113E3", self.sns_client.return_subject())
+
+    def test_hysteresis_and_clear(self):
+        self.server.dispatch_alarm("A001", keep_alive("2.6"))
+        self.server.dispatch_alarm("A002", keep_alive("2.68"))
+        self.assertEqual(1, self.sns_client.return_published_times())
+
+        self.server.dispatch_alarm("A003", keep_alive("2.9"))
+        self.assertEqual(2, self.sns_client.return_published_times())
+        self.assertEqual("Cleared Alarm 260113E3", self.sns_client.return_subject())
+
+    def test_unknown_payload_does_not_dispatch(self):
+        self.server.dispatch_alarm("A001", None)
+        self.assertEqual(0, self.sns_client.return_published_times())
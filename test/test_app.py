@@ -9,8 +9,6 @@ functions from QRColorChecker modules.
 import unittest
 import hashlib
 
-import dateutil
-
 from chalicelib.server import Server
 import sys
 import json
@@ -48,16 +46,15 @@ class AppTest(unittest.TestCase):
         hash_object = hashlib.sha256(virtual_tx.encode())
         hex_dig = hash_object.hexdigest()
 
-        dt = dateutil.parser.parse(time)
-        strftime = dt.strftime("%s")
-        time_millis = int(strftime) * 1000
+        # 2017-03-11T10:52:50.412Z
+        time_millis = 1489229570412
 
         self.assertEqual(parsed_json["time_json"], time)
         self.assertEqual(parsed_json["timeStamp"], int(time_millis))
         self.assertEqual(parsed_json["payload"], payload)
         self.assertEqual(parsed_json["DevEUI"], device_id)
         self.assertEqual(parsed_json["type"], "LORA")
-        self.assertEqual(parsed_json["extra"], json.dumps(jsonbody))
+        self.assertEqual(parsed_json["extra"], self.str_data)
         self.assertEqual(parsed_json["virtual_tx"], hex_dig)
 
     # http "https://d8dsx2bkn9.execute-api.eu-west-1.amazonaws.com/api/sigfox?time=1515360218&id=IDTest&data=02180AE4"
@@ -162,6 +159,80 @@ class AppTest(unittest.TestCase):
         self.assertEqual(1, self.dynamodb_device_data.return_persisted_times())
         self.assertEqual(expected_item, self.dynamodb_device_data.return_persisted_item())
 
+    def test_persist_data_batch_in_groups_of_25(self):
+        server = Server(self.dynamodb_device_data, None, None, self.log)
+        events = [{"DevEUI": "260113E3", "timeStamp": 1499366509000 + i, "payload": "02180AE4"} for i in range(60)]
+
+        stats = server.persist_data_batch(events)
+
+        self.assertEqual(3, self.dynamodb_device_data.batch_calls)
+        self.assertEqual(events, self.dynamodb_device_data.batch_written)
+        self.assertEqual(60, stats["items"])
+        self.assertEqual(0, stats["retries"])
+
+    def test_persist_data_batch_retries_unprocessed_items(self):
+        dynamodb = TestDynamoDB(unprocessed_rounds=2)
+        server = Server(dynamodb, None, None, self.log)
+        server.backoff_base = 0
+        events = [{"DevEUI": "260113E3", "timeStamp": 1499366509000 + i} for i in range(3)]
+
+        stats = server.persist_data_batch(events)
+
+        self.assertEqual(3, dynamodb.batch_calls)
+        self.assertEqual(2, stats["retries"])
+        self.assertEqual(2, stats["unprocessed"])
+        self.assertEqual(sorted(e["timeStamp"] for e in events),
+                         sorted(item["timeStamp"] for item in dynamodb.batch_written))
+        self.assertEqual(0, dynamodb.return_persisted_times())
+
+    def test_persist_data_batch_falls_back_to_put_item(self):
+        dynamodb = TestDynamoDB(unprocessed_rounds=100)
+        server = Server(dynamodb, None, None, self.log)
+        server.backoff_base = 0
+        events = [{"DevEUI": "260113E3", "timeStamp": 1499366509000}]
+
+        stats = server.persist_data_batch(events)
+
+        self.assertEqual(1, stats["fallbacks"])
+        self.assertEqual(1, dynamodb.return_persisted_times())
+        self.assertEqual(events[0], dynamodb.return_persisted_item())
+
+    def test_persist_data_batch_keeps_last_duplicate_key(self):
+        server = Server(self.dynamodb_device_data, None, None, self.log)
+        events = [{"DevEUI": "260113E3", "timeStamp": 1499366509000, "payload": "first"},
+                  {"DevEUI": "260113E3", "timeStamp": 1499366509000, "payload": "second"}]
+
+        server.persist_data_batch(events)
+
+        self.assertEqual([events[1]], self.dynamodb_device_data.batch_written)
+
+    def test_persist_and_parse_writes_decoded_fields_in_same_item(self):
+        server = Server(self.dynamodb_device_data, None, self.sns_client, self.log)
+        events = [{"virtual_tx": "A001", "timeStamp": 1499366509000, "DevEUI": "260113E3", "payload": "02180AE4"},
+                  {"virtual_tx": "A002", "timeStamp": 1499366509001, "DevEUI": "260113E3",
+                   "payload": "10bb17f18198100734"},
+                  {"virtual_tx": "A003", "timeStamp": 1499366509002, "DevEUI": "260113E3", "payload": "A1"}]
+
+        stats = server.persist_and_parse(events)
+
+        written = self.dynamodb_device_data.batch_written
+        self.assertEqual(2, stats["decoded"])
+        self.assertEqual({"interval": "24", "voltage": "2.788"}, written[0]["ka"])
+        self.assertIn("geo", written[1])
+        self.assertNotIn("geo", written[2])
+        self.assertNotIn("ka", written[2])
+        self.assertEqual(0, self.dynamodb_device_data.return_updated_times())
+        self.assertEqual(0, self.sns_client.return_published_times())
+
+    def test_persist_and_parse_dispatches_alarms(self):
+        server = Server(self.dynamodb_device_data, None, self.sns_client, self.log)
+        events = [{"virtual_tx": "A001", "timeStamp": 1499366509000, "DevEUI": "260113E3", "payload": "02180998"}]
+
+        server.persist_and_parse(events)
+
+        self.assertEqual(1, self.sns_client.return_published_times())
+        self.assertEqual("Triggered Alarm 260113E3", self.sns_client.return_subject())
+
     def test_parsing_none_known_payload(self):
         expected_item = {"virtual_tx": "A001", "time_json": "2017-01-21T12:12:12.001Z", "timeStamp": 1499366509000,
                          "payload": "A1bb17f18198100734",
@@ -267,11 +338,49 @@ class AppTest(unittest.TestCase):
             {"timeStamp": 1499366509000, "DevEUI": "260113E3"},
             self.dynamodb_device_data.return_updated_item()["Key"])
         self.assertEqual(
-            'SET geo = :val',
+            'SET #u0 = :u0',
+            self.dynamodb_device_data.return_updated_item()["UpdateExpression"])
+        self.assertEqual({"#u0": "geo"}, self.dynamodb_device_data.return_updated_item()["ExpressionAttributeNames"])
+        self.assertEqual(
+            {':u0': {"lat": "12.5", "lng": "1.4"}},
+            self.dynamodb_device_data.return_updated_item()["ExpressionAttributeValues"])
+        self.assertEqual("NONE", self.dynamodb_device_data.return_updated_item()["ReturnValues"])
+
+    def test_update_data_keeps_geo_and_ka_of_same_event(self):
+        server = Server(self.dynamodb_device_data, None, None, self.log)
+        expected_item = {
+            "timeStamp": 1499366509000,
+            "DevEUI": "260113E3",
+            "GEO": {"lat": "12.5", "lng": "1.4"},
+            "KA": {"interval": "24", "voltage": "2.788"}
+        }
+
+        server.update_data(expected_item, return_values="UPDATED_NEW")
+        self.assertEqual(1, self.dynamodb_device_data.return_updated_times())
+        self.assertEqual(
+            'SET #u0 = :u0, #u1 = :u1',
             self.dynamodb_device_data.return_updated_item()["UpdateExpression"])
+        self.assertEqual({"#u0": "geo", "#u1": "ka"},
+                         self.dynamodb_device_data.return_updated_item()["ExpressionAttributeNames"])
         self.assertEqual(
-            {':val': {"lat": "12.5", "lng": "1.4"}},
+            {':u0': {"lat": "12.5", "lng": "1.4"}, ':u1': {"interval": "24", "voltage": "2.788"}},
             self.dynamodb_device_data.return_updated_item()["ExpressionAttributeValues"])
+        self.assertEqual("UPDATED_NEW", self.dynamodb_device_data.return_updated_item()["ReturnValues"])
+
+    def test_update_data_batch_coalesces_same_key(self):
+        server = Server(self.dynamodb_device_data, None, None, self.log)
+        events = [{"timeStamp": 1499366509000, "DevEUI": "260113E3", "GEO": {"lat": "12.5", "lng": "1.4"}},
+                  None,
+                  {"timeStamp": 1499366509000, "DevEUI": "260113E3", "KA": {"interval": "24", "voltage": "2.788"}},
+                  {"timeStamp": 1499366509001, "DevEUI": "260113E3", "KA": {"interval": "24", "voltage": "2.7"}}]
+
+        server.update_data_batch(events)
+
+        self.assertEqual(2, self.dynamodb_device_data.return_updated_times())
+        self.assertEqual({"#u0": "geo", "#u1": "ka"}, self.dynamodb_device_data.updates[0]["ExpressionAttributeNames"])
+        self.assertEqual({"timeStamp": 1499366509001, "DevEUI": "260113E3"},
+                         self.dynamodb_device_data.return_updated_item()["Key"])
+        self.assertEqual({"#u0": "ka"}, self.dynamodb_device_data.return_updated_item()["ExpressionAttributeNames"])
 
     @staticmethod
     def printGeoLocation(lat, lat_hex, lat_str, lng_hex, lng_str, payload, lng):
@@ -291,10 +400,19 @@ class TestLog:
         self.message = ''
         self.logged = 0
 
-    def debug(self, message):
-        self.message = message
+    def debug(self, message, *args):
+        self.message = message % args if args else message
         self.logged += 1
-        return message
+        return self.message
+
+    def info(self, message, *args):
+        return self.debug(message, *args)
+
+    def warning(self, message, *args):
+        return self.debug(message, *args)
+
+    def error(self, message, *args):
+        return self.debug(message, *args)
 
     def return_message(self):
         return self.message
@@ -304,11 +422,13 @@ class TestLog:
 
 
 class TestSNS:
-    def __init__(self):
+    def __init__(self, failed_ids=()):
         self.Message = ''
         self.TopicArn = ''
         self.Subject = ''
         self.published = 0
+        self.batches = []
+        self.failed_ids = set(failed_ids)
 
     def publish(self, TopicArn, Subject, Message):
         self.Message = Message
@@ -316,6 +436,14 @@ class TestSNS:
         self.Subject = Subject
         self.published += 1
 
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self.batches.append((TopicArn, PublishBatchRequestEntries))
+        failed = [{"Id": entry["Id"], "Code": "InternalError", "SenderFault": False}
+                  for entry in PublishBatchRequestEntries if entry["Id"] in self.failed_ids]
+        successful = [{"Id": entry["Id"], "MessageId": entry["Id"]}
+                      for entry in PublishBatchRequestEntries if entry["Id"] not in self.failed_ids]
+        return {"Successful": successful, "Failed": failed}
+
     def return_topicarn(self):
         return self.TopicArn
 
@@ -330,25 +458,75 @@ class TestSNS:
 
 
 class TestDynamoDB:
-    def __init__(self):
+    def __init__(self, name="DeviceData", unprocessed_rounds=0):
+        self.name = name
+        self.meta = TestMeta(self)
         self.Item = ''
         self.persisted = 0
         self.updated = 0
         self.Key = ''
         self.UpdateExpression = ''
+        self.ExpressionAttributeNames = None
         self.ExpressionAttributeValues = ''
         self.ReturnValues = ''
-
-    def put_item(self, Item):
+        self.batch_written = []
+        self.batch_calls = 0
+        self.unprocessed_rounds = unprocessed_rounds
+        self.updates = []
+        self.conditional_keys = set()
+        self.items = []
+        self.batch_gets = 0
+
+    # Only supports the attribute_not_exists condition on the partition key used by the dedup table
+    def put_item(self, Item, ConditionExpression=None):
+        if ConditionExpression is not None:
+            key = Item[ConditionExpression[len("attribute_not_exists("):-1]]
+            if key in self.conditional_keys:
+                raise TestConditionalCheckFailed()
+            self.conditional_keys.add(key)
         self.Item = Item
         self.persisted += 1
+        self.items.append(Item)
 
-    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ReturnValues):
+    def delete_item(self, Key):
+        self.conditional_keys.discard(Key["virtual_tx"])
+        self.items = [item for item in self.items if item.get("virtual_tx") != Key["virtual_tx"]]
+
+    def get_item(self, Key):
+        for item in reversed(self.items):
+            if all(item.get(name) == value for name, value in Key.items()):
+                return {"Item": item}
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ReturnValues="NONE",
+                    ExpressionAttributeNames=None):
         self.Key = Key
         self.UpdateExpression = UpdateExpression
+        self.ExpressionAttributeNames = ExpressionAttributeNames
         self.ExpressionAttributeValues = ExpressionAttributeValues
         self.ReturnValues = ReturnValues
         self.updated += 1
+        self.updates.append(self.return_updated_item())
+
+    # Leaves the last item of every request unprocessed while unprocessed_rounds lasts
+    def batch_write_item(self, RequestItems):
+        self.batch_calls += 1
+        requests = RequestItems[self.name]
+        unprocessed = []
+        if self.unprocessed_rounds > 0:
+            self.unprocessed_rounds -= 1
+            unprocessed = requests[-1:]
+            requests = requests[:-1]
+        self.batch_written.extend(request["PutRequest"]["Item"] for request in requests)
+        if unprocessed:
+            return {"UnprocessedItems": {self.name: unprocessed}}
+        return {"UnprocessedItems": {}}
+
+    def batch_get_item(self, RequestItems):
+        self.batch_gets += 1
+        keys = RequestItems[self.name]["Keys"]
+        found = [self.get_item(key).get("Item") for key in keys]
+        return {"Responses": {self.name: [item for item in found if item is not None]}, "UnprocessedKeys": {}}
 
     def return_persisted_item(self):
         return self.Item
@@ -359,8 +537,20 @@ class TestDynamoDB:
     def return_updated_item(self):
         return {"Key": self.Key,
                 "UpdateExpression": self.UpdateExpression,
+                "ExpressionAttributeNames": self.ExpressionAttributeNames,
                 "ExpressionAttributeValues": self.ExpressionAttributeValues,
                 "ReturnValues": self.ReturnValues}
 
     def return_updated_times(self):
         return self.updated
+
+
+class TestMeta:
+    def __init__(self, client):
+        self.client = client
+
+
+class TestConditionalCheckFailed(Exception):
+    def __init__(self):
+        Exception.__init__(self, "The conditional request failed")
+        self.response = {"Error": {"Code": "ConditionalCheckFailedException"}}
@@ -0,0 +1,206 @@
+"""
+Tests for the DeviceData reprocessing
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+import json
+import os
+import random
+import tempfile
+import threading
+from decimal import Decimal
+
+from chalicelib.backfill import Backfill, Checkpoint, RateLimiter, changes, decode_items
+from chalicelib.registry import DeviceRegistry
+from chalicelib.server import CODECS, Server
+from test.test_app import TestDynamoDB, TestLog
+from test.test_deadletter import TestClientError
+
+KEEP_ALIVE = "02180AE4"
+GEO = "10bb17f18198100734"
+
+
+# Scan with segments and pages, every update consumes 1 unit, update_item fails for the timeStamps
+# in failing and the scan stops with an error after stop_after pages
+class ScannedDeviceData:
+    def __init__(self, items, failing=(), stop_after=None):
+        self.items = items
+        self.failing = set(failing)
+        self.stop_after = stop_after
+        self.scans = 0
+        self.updates = []
+        self.lock = threading.Lock()
+
+    def scan(self, Segment, TotalSegments, Limit, ProjectionExpression, ExpressionAttributeNames,
+             ReturnConsumedCapacity, ExclusiveStartKey=None):
+        with self.lock:
+            self.scans += 1
+            if self.stop_after is not None and self.scans > self.stop_after:
+                raise TestClientError("InternalFailure")
+        segment = [item for i, item in enumerate(self.items) if i % TotalSegments == Segment]
+        first = 0
+        if ExclusiveStartKey is not None:
+            keys = [(item["DevEUI"], item["timeStamp"]) for item in segment]
+            first = keys.index((ExclusiveStartKey["DevEUI"], ExclusiveStartKey["timeStamp"])) + 1
+        fields = list(ExpressionAttributeNames.values())
+        page = [dict((name, value) for name, value in item.items() if name in fields)
+                for item in segment[first:first + Limit]]
+        response = {"Items": page, "ConsumedCapacity": {"CapacityUnits": 0.5}}
+        if first + Limit < len(segment):
+            last = segment[first + Limit - 1]
+            response["LastEvaluatedKey"] = {"DevEUI": last["DevEUI"], "timeStamp": Decimal(last["timeStamp"])}
+        return response
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues,
+                    ReturnConsumedCapacity):
+        if Key["timeStamp"] in self.failing:
+            raise TestClientError("ValidationException")
+        with self.lock:
+            self.updates.append((Key["DevEUI"], Key["timeStamp"], sorted(ExpressionAttributeNames.values())))
+        return {"ConsumedCapacity": {"CapacityUnits": 1.0}}
+
+
+def stored(count):
+    items = []
+    for i in range(count):
+        item = {"DevEUI": "DEV%d" % (i % 3), "timeStamp": 1499366509000 + i, "payload": KEEP_ALIVE,
+                "extra": "{}"}
+        if i % 2 == 0:
+            # Decoded with the current decoder already
+            item["ka"] = {"interval": "24", "voltage": "2.788"}
+        items.append(item)
+    items.append({"DevEUI": "DEV0", "timeStamp": 1499366510000, "payload": GEO})
+    items.append({"DevEUI": "DEV0", "timeStamp": 1499366510001, "payload": "A1"})
+    return items
+
+
+class BackfillTest(unittest.TestCase):
+    def setUp(self):
+        self.log = TestLog()
+
+    def test_only_changed_items_are_written(self):
+        table = ScannedDeviceData(stored(40))
+
+        stats = Backfill(table, self.log, segments=3, workers=0, page_size=4).run()
+
+        self.assertEqual(42, stats["scanned"])
+        self.assertEqual(41, stats["decoded"])
+        self.assertEqual(21, stats["changed"])
+        self.assertEqual(21, len(table.updates))
+        self.assertEqual(21.0, stats["write_units"])
+        self.assertIn(("DEV0", 1499366510000, ["geo"]), table.updates)
+        self.assertEqual(20, len([update for update in table.updates if update[2] == ["ka"]]))
+
+    def test_process_pool(self):
+        table = ScannedDeviceData(stored(40))
+        stats = Backfill(table, self.log, segments=2, workers=2, page_size=10).run()
+        self.assertEqual(21, stats["changed"])
+
+    def test_dry_run(self):
+        table = ScannedDeviceData(stored(10))
+        stats = Backfill(table, self.log, workers=0, dry_run=True).run()
+        self.assertEqual(6, stats["changed"])
+        self.assertEqual([], table.updates)
+
+    def test_device_codec_from_registry(self):
+        devices = TestDynamoDB("Devices")
+        devices.put_item({"DevEUI": "DEV1", "codec": "tracker"})
+        table = ScannedDeviceData(stored(4))
+
+        CODECS.register("02", "KA", "ka", lambda raw: {"tracker": raw.hex()}, model="tracker")
+        try:
+            stats = Backfill(table, self.log, DeviceRegistry(devices, self.log), workers=0).run()
+        finally:
+            del CODECS.codecs[("02", "tracker")]
+
+        self.assertEqual(3, stats["changed"])
+        self.assertEqual([("DEV1", 1499366509001, ["ka"])], [update for update in table.updates
+                                                                     if update[0] == "DEV1"])
+
+    def test_attributes_of_the_codecs_registered_at_runtime_are_read(self):
+        table = ScannedDeviceData([{"DevEUI": "DEV1", "timeStamp": 1499366509000, "payload": "0315",
+                                    "temp": {"celsius": "21"}}])
+        CODECS.register("03", "TEMP", "temp", lambda raw: {"celsius": str(raw[1])})
+        try:
+            stats = Backfill(table, self.log, workers=0).run()
+        finally:
+            del CODECS.codecs[("03", None)]
+            CODECS._attributes = None
+
+        self.assertEqual(1, stats["decoded"])
+        self.assertEqual(0, stats["changed"])
+
+    def test_resumes_from_checkpoint(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as checkpoint_file:
+            path = checkpoint_file.name
+        os.remove(path)
+        try:
+            table = ScannedDeviceData(stored(40), stop_after=3)
+            with self.assertRaises(TestClientError):
+                Backfill(table, self.log, segments=1, workers=0, page_size=5, checkpoint=path).run()
+            with open(path) as checkpoint:
+                saved = json.load(checkpoint)
+            self.assertEqual(1499366509014, saved["positions"]["0"]["timeStamp"])
+            written = len(table.updates)
+
+            table.stop_after = None
+            stats = Backfill(table, self.log, segments=1, workers=0, page_size=5, checkpoint=path).run()
+
+            self.assertEqual(42, stats["scanned"])
+            self.assertEqual(21, len(table.updates))
+            self.assertEqual(7, written)
+            self.assertEqual("done", Checkpoint(path, 1).position(0))
+            with self.assertRaises(ValueError):
+                Checkpoint(path, 4)
+        finally:
+            os.remove(path)
+
+    def test_failed_page_is_not_checkpointed(self):
+        table = ScannedDeviceData(stored(10), failing=[1499366509007])
+        backfill = Backfill(table, self.log, segments=1, workers=0, page_size=5)
+        with self.assertRaises(TestClientError):
+            backfill.run()
+        self.assertEqual(1499366509004, backfill.checkpoint.position(0)["timeStamp"])
+
+    def test_columnar_decoding_matches_the_lambdas(self):
+        rnd = random.Random(5)
+        payloads = ["10%012x" % rnd.getrandbits(48) for _ in range(50)]
+        payloads += ["02%06x" % rnd.getrandbits(24) for _ in range(50)]
+        payloads += [GEO + "ff", GEO + "f", "10bb", "02zz0000", KEEP_ALIVE + "1", "A1", ""]
+        rnd.shuffle(payloads)
+        items = [("DEV%d" % i, 1499366509000 + i, payload, None) for i, payload in enumerate(payloads)]
+
+        expected = []
+        for dev_eui, time_stamp, payload, model in items:
+            parsed = Server.parse_payload({"DevEUI": dev_eui, "timeStamp": time_stamp, "payload": payload}, model)
+            expected.append(Server.parsed_attributes(parsed) if parsed is not None else {})
+        self.assertEqual(expected, decode_items(items))
+
+    def test_changes(self):
+        item = {"ka": {"interval": Decimal("24"), "voltage": "2.788"}}
+        self.assertEqual({}, changes({"ka": {"interval": "24", "voltage": "2.788"}},
+                                     {"ka": {"interval": "24", "voltage": "2.788"}}))
+        self.assertEqual({"ka": {"interval": "24", "voltage": "2.788"}},
+                         changes(item, {"ka": {"interval": "24", "voltage": "2.788"}}))
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_spent_units_make_the_next_call_wait(self):
+        limiter = RateLimiter(1000)
+        limiter.wait()
+        limiter.spend(1010)
+        self.assertLess(limiter.available, 0)
+        limiter.wait()
+        self.assertGreater(limiter.available, 0)
+
+    def test_unlimited(self):
+        limiter = RateLimiter(None)
+        limiter.spend(10 ** 6)
+        limiter.wait()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+"""
+Tests for the columnar batch decoder, every value must match the scalar decoders
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+import random
+
+from chalicelib import batch_decoder
+from chalicelib.server import extract_lat_long, extract_keep_alive
+
+
+class BatchDecoderTest(unittest.TestCase):
+    def setUp(self):
+        rnd = random.Random(7)
+        self.geo_payloads = ["10%06x%06x0734" % (rnd.randint(0, 0xFFFFFF), rnd.randint(0, 0xFFFFFF))
+                             for _ in range(500)]
+        self.geo_payloads += ["10000000000000", "10ffffffffffff", "10bb17f18198100734"]
+        self.ka_payloads = ["02%02x%04x" % (rnd.randint(0, 0xFF), rnd.randint(0, 0xFFFF)) for _ in range(500)]
+        self.ka_payloads += ["02180AE4", "02000000", "02FFFFFF"]
+
+    def test_lat_long_batch_matches_scalar(self):
+        decoded = batch_decoder.decode_lat_long_batch(self.geo_payloads)
+
+        for i, payload in enumerate(self.geo_payloads):
+            expected = extract_lat_long(payload)
+            self.assertEqual(expected["lat"], str(float(decoded["lat"][i])))
+            self.assertEqual(expected["lng"], str(float(decoded["lng"][i])))
+
+    def test_keep_alive_batch_matches_scalar(self):
+        decoded = batch_decoder.decode_keep_alive_batch(self.ka_payloads)
+
+        for i, payload in enumerate(self.ka_payloads):
+            expected = extract_keep_alive(payload)
+            self.assertEqual(expected["interval"], str(int(decoded["interval"][i])))
+            self.assertEqual(expected["voltage"], str(float(decoded["voltage"][i])))
+
+    def test_decode_batch_groups_by_packet_id(self):
+        payloads = ["02180AE4", "10bb17f18198100734", "A1bb17f1", "02180998", "10zz17f18198100734", "10bb"]
+
+        decoded = batch_decoder.decode_batch(payloads)
+
+        self.assertEqual([1], list(decoded["GEO"]["index"]))
+        self.assertEqual([0, 3], list(decoded["KA"]["index"]))
+        self.assertEqual([2], decoded["unknown"])
+        self.assertEqual(extract_lat_long(payloads[1])["lat"], str(float(decoded["GEO"]["lat"][0])))
+        self.assertEqual(["2.788", "2.456"], [str(float(v)) for v in decoded["KA"]["voltage"]])
+
+    def test_decode_empty_batch(self):
+        decoded = batch_decoder.decode_batch([])
+
+        self.assertEqual(0, len(decoded["GEO"]["lat"]))
+        self.assertEqual(0, len(decoded["KA"]["voltage"]))
+        self.assertEqual([], decoded["unknown"])
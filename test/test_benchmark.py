@@ -0,0 +1,43 @@
+"""
+Smoke tests for the offline benchmark, so it keeps working as the handlers change
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+import logging
+
+import app
+from chalicelib.server import Server
+from test import benchmark
+
+
+class BenchmarkTest(unittest.TestCase):
+    def setUp(self):
+        self.level = app.app.log.level
+        app.app.log.setLevel(logging.WARNING)
+
+    def tearDown(self):
+        app.app.log.setLevel(self.level)
+        app._server = None
+
+    def test_run_drives_every_stage(self):
+        parse_lora_json = Server.parse_lora_json
+
+        result = benchmark.run(200, 25, 1)
+
+        self.assertEqual(200, result["persisted"])
+        self.assertEqual(200 + 8 + 8, result["metric_records"])
+        for stage in ["ingest", "parse", "publish", "persist", "decode", "alarm", "update"]:
+            self.assertGreater(result["stages"][stage]["calls"], 0, stage)
+        self.assertIs(parse_lora_json, Server.parse_lora_json)
+
+    def test_regressions_compare_p50_with_tolerance(self):
+        baseline = {"stages": {"parse": {"p50_us": 10.0}, "decode": {"p50_us": 4.0}}}
+        result = {"stages": {"parse": {"p50_us": 14.0}, "decode": {"p50_us": 6.1}, "alarm": {"p50_us": 9.0}}}
+
+        found = benchmark.regressions(result, baseline, 1.5)
+
+        self.assertEqual(1, len(found))
+        self.assertTrue(found[0].startswith("decode"))
@@ -0,0 +1,93 @@
+"""
+Tests for the bulk NDJSON / JSON array ingestion
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+import json
+
+from chalicelib import bulk
+from chalicelib.dedup import Deduplicator
+from chalicelib.publisher import BatchPublisher
+from chalicelib.server import Server
+from test.test_app import TestLog, TestSNS
+
+
+def lora_uplink(dev_addr, time="2017-03-11T11:52:50.412+01:00"):
+    return {"DevEUI_uplink": {"Time": time, "payload_hex": "02180AE4", "DevAddr": dev_addr}}
+
+
+class UnreachableSNS(TestSNS):
+    def __init__(self):
+        TestSNS.__init__(self)
+        self.reachable = False
+
+    def publish(self, TopicArn, Subject, Message):
+        if not self.reachable:
+            raise IOError("SNS unreachable")
+        TestSNS.publish(self, TopicArn, Subject, Message)
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        if not self.reachable:
+            raise IOError("SNS unreachable")
+        return TestSNS.publish_batch(self, TopicArn, PublishBatchRequestEntries)
+
+
+class BulkTest(unittest.TestCase):
+    def setUp(self):
+        self.log = TestLog()
+        self.sns_client = TestSNS()
+        self.server = Server(None, None, self.sns_client, self.log,
+                             publisher=BatchPublisher(self.sns_client, self.log, max_wait=60),
+                             deduplicator=Deduplicator(self.log))
+
+    def test_split_json_array_and_ndjson(self):
+        records = [{"time": "1515360218", "id": "D1", "data": "02180AE4"},
+                   {"time": "1515360219", "id": "D1", "data": "02180AE4"}]
+
+        self.assertEqual(records, bulk.split_records(json.dumps(records)))
+        ndjson = "\n".join(json.dumps(record) for record in records) + "\n\n"
+        self.assertEqual(records, [json.loads(line) for line in bulk.split_records(ndjson.encode())])
+
+    def test_split_rejects_bad_bodies(self):
+        for body in ["", "  ", "[{", "[" + ",".join(["{}"] * (bulk.MAX_BATCH_RECORDS + 1)) + "]"]:
+            with self.assertRaises(bulk.BulkBodyError):
+                bulk.split_records(body)
+
+    def test_lora_records_with_and_without_body_wrapper(self):
+        wrapped = {"body": json.dumps(lora_uplink("260113E2"))}
+        bare = lora_uplink("260113E2")
+
+        self.assertEqual(Server.parse_lora_json(json.dumps(bare)), bulk.parse_lora_record(wrapped))
+        self.assertEqual("260113E2", bulk.parse_lora_record(json.dumps(bare))["DevEUI"])
+
+    def test_ingest_reports_errors_per_record_and_publishes_in_batches(self):
+        records = [json.dumps({"time": str(1515360218 + i), "id": "D1", "data": "02180AE4"}) for i in range(20)]
+        records.insert(3, "{not json")
+        records.insert(7, json.dumps({"id": "D1"}))
+        records.append(records[0])
+
+        report = bulk.ingest_records(self.server, records, bulk.parse_sigfox_record)
+
+        self.assertEqual(23, report["received"])
+        self.assertEqual(20, report["accepted"])
+        self.assertEqual(1, report["duplicates"])
+        self.assertEqual([3, 7], [error["index"] for error in report["errors"]])
+        self.assertEqual([10, 10], [len(entries) for _, entries in self.sns_client.batches])
+        self.assertEqual(0, self.sns_client.return_published_times())
+
+    def test_failed_batch_can_be_sent_again(self):
+        records = [json.dumps({"time": str(1515360218 + i), "id": "D1", "data": "02180AE4"}) for i in range(12)]
+        sns_client = UnreachableSNS()
+        server = Server(None, None, sns_client, self.log,
+                        publisher=BatchPublisher(sns_client, self.log, max_wait=60), deduplicator=Deduplicator(self.log))
+
+        with self.assertRaises(IOError):
+            bulk.ingest_records(server, records, bulk.parse_sigfox_record)
+        sns_client.reachable = True
+        report = bulk.ingest_records(server, records, bulk.parse_sigfox_record)
+
+        self.assertEqual(12, report["accepted"])
+        self.assertEqual(0, report["duplicates"])
@@ -0,0 +1,42 @@
+"""
+Tests for the lazily built AWS clients
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+import os
+import subprocess
+import sys
+
+from chalicelib import clients
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ClientsTest(unittest.TestCase):
+    def setUp(self):
+        clients.reset()
+        os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+
+    def tearDown(self):
+        clients.reset()
+
+    def test_importing_app_does_not_load_boto3(self):
+        code = "import sys, app; app.index(); print('boto3' in sys.modules, 'dateutil.parser' in sys.modules)"
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=ROOT)
+        self.assertEqual("False False", output.decode().strip().splitlines()[-1])
+
+    def test_clients_are_built_once_and_shared(self):
+        self.assertEqual({}, clients.timings)
+
+        sns_client = clients.sns_client()
+        table = clients.dynamodb_table("DeviceData")
+
+        self.assertIs(sns_client, clients.sns_client())
+        self.assertIs(table, clients.dynamodb_table("DeviceData"))
+        clients.dynamodb_table("Devices")
+        self.assertEqual(1, len(clients._resources))
+        self.assertEqual(["dynamodb_resource", "session", "sns"], sorted(clients.timings))
+        self.assertEqual(clients.MAX_POOL_CONNECTIONS, sns_client.meta.config.max_pool_connections)
@@ -0,0 +1,77 @@
+"""
+Tests for the compact storage encoding of DeviceData items
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+import json
+
+from chalicelib import compact
+from chalicelib.query import query_device_data
+from chalicelib.server import Server
+from test import storage_benchmark
+from test.test_app import TestDynamoDB, TestLog, TestSNS
+from test.test_query import TestDeviceDataTable
+
+
+class Binary:
+    def __init__(self, value):
+        self.value = value
+
+
+class CompactTest(unittest.TestCase):
+    def setUp(self):
+        self.body = storage_benchmark.lora_uplink(3)
+        self.item = Server.parse_lora_json(self.body)
+
+    def test_round_trip(self):
+        encoded = compact.encode_item(self.item)
+
+        self.assertNotIn("extra", encoded)
+        self.assertEqual(32, len(encoded["virtual_tx"]))
+        decoded = compact.decode_item(encoded)
+        self.assertEqual(json.dumps(json.loads(self.body)), decoded["extra"])
+        self.assertEqual(self.item["virtual_tx"], decoded["virtual_tx"])
+        self.assertEqual(set(self.item), set(decoded))
+
+    def test_boto3_binary_attributes(self):
+        encoded = compact.encode_item(self.item)
+        stored = dict(encoded, virtual_tx=Binary(encoded["virtual_tx"]), extra_z=Binary(encoded["extra_z"]))
+        self.assertEqual(self.item["virtual_tx"], compact.decode_item(stored)["virtual_tx"])
+
+    def test_promoted_values_that_differ_are_kept(self):
+        item = dict(self.item, payload="02180AE4")
+        decoded = compact.decode_item(compact.encode_item(item))
+        self.assertEqual("10bb17f18198100734", json.loads(decoded["extra"])["DevEUI_uplink"]["payload_hex"])
+
+    def test_plain_and_sigfox_items_are_untouched(self):
+        sigfox = Server.parse_sigfox_dic({"query_params": {"time": "1515360218", "id": "1C8A3E", "data": "02"}})
+        self.assertIs(self.item, compact.decode_item(self.item))
+        self.assertEqual(sigfox, compact.decode_item(compact.encode_item(sigfox)))
+
+    def test_compact_items_are_smaller(self):
+        encoded = compact.encode_item(self.item)
+        self.assertLess(compact.item_size(encoded), compact.item_size(self.item) / 2)
+        self.assertEqual(1, compact.write_units(encoded))
+
+    def test_server_writes_compact_items_and_query_reads_them_back(self):
+        device_data = TestDynamoDB()
+        server = Server(device_data, None, TestSNS(), TestLog(), compact=True)
+        server.persist_data_batch([self.item])
+        self.assertIn("extra_z", device_data.batch_written[0])
+
+        table = TestDeviceDataTable(device_data.batch_written)
+        found = query_device_data(table, self.item["DevEUI"], 0, 2 ** 63, fields=["timeStamp", "extra"])
+        self.assertEqual([{"timeStamp": self.item["timeStamp"], "extra": json.dumps(json.loads(self.body))}],
+                         found["items"])
+
+    def test_benchmark_runs(self):
+        results = storage_benchmark.run(1)
+        self.assertEqual(4, len(results))
+        self.assertTrue(all(result["compact_bytes"] <= result["plain_bytes"] for result in results))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,243 @@
+"""
+Tests for the per record failure isolation, the throttling retries and the dead letter replay
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+import json
+import os
+import tempfile
+
+from chalice import NotFoundError
+
+import app
+from chalicelib.deadletter import DeadLetterSink, STORE, PARSE, drain_queue, pending, read_dead_letters, replay
+from chalicelib.retry import AdaptiveRetry
+from chalicelib.server import Server, PAYLOAD_PARSER_TOPIC
+from test.test_app import TestDynamoDB, TestLog, TestSNS
+
+
+class TestClientError(Exception):
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.response = {"Error": {"Code": code}}
+
+
+# batch_write_item and update_item are throttled for the first rounds, and the timeStamps in
+# invalid are always rejected, as DynamoDB does with an item over the size limit
+class FlakyDynamoDB(TestDynamoDB):
+    def __init__(self, throttled_rounds=0, invalid=()):
+        TestDynamoDB.__init__(self)
+        self.throttled_rounds = throttled_rounds
+        self.invalid = set(invalid)
+
+    def throttle(self):
+        if self.throttled_rounds > 0:
+            self.throttled_rounds -= 1
+            raise TestClientError("ProvisionedThroughputExceededException")
+
+    def batch_write_item(self, RequestItems):
+        self.throttle()
+        if any(request["PutRequest"]["Item"]["timeStamp"] in self.invalid for request in RequestItems[self.name]):
+            raise TestClientError("ValidationException")
+        return TestDynamoDB.batch_write_item(self, RequestItems)
+
+    def put_item(self, Item, ConditionExpression=None):
+        if Item["timeStamp"] in self.invalid:
+            raise TestClientError("ValidationException")
+        TestDynamoDB.put_item(self, Item, ConditionExpression)
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ReturnValues="NONE",
+                    ExpressionAttributeNames=None):
+        self.throttle()
+        if Key["timeStamp"] in self.invalid:
+            raise TestClientError("ValidationException")
+        TestDynamoDB.update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ReturnValues,
+                                 ExpressionAttributeNames)
+
+
+# Messages are received in order and hidden once received, deleted ones are gone
+class TestSQS:
+    def __init__(self, bodies):
+        self.messages = [{"MessageId": "m%d" % i, "ReceiptHandle": "r%d" % i, "Body": body}
+                         for i, body in enumerate(bodies)]
+        self.visible = list(self.messages)
+        self.deleted = []
+
+    def receive_message(self, QueueUrl, WaitTimeSeconds, MaxNumberOfMessages, VisibilityTimeout):
+        received, self.visible = self.visible[:MaxNumberOfMessages], self.visible[MaxNumberOfMessages:]
+        return {"Messages": received} if received else {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.deleted.extend(entry["ReceiptHandle"] for entry in Entries)
+
+
+def uplink(i, payload="02180998"):
+    return {"virtual_tx": "vtx%d" % i, "DevEUI": "260113E3", "timeStamp": 1499366509000 + i, "payload": payload}
+
+
+class AdaptiveRetryTest(unittest.TestCase):
+    def test_throttled_calls_are_retried(self):
+        table = FlakyDynamoDB(throttled_rounds=2)
+        retry = AdaptiveRetry()
+
+        retry.call(0, table.update_item, Key={"DevEUI": "A", "timeStamp": 1}, UpdateExpression="SET ka = :ka",
+                   ExpressionAttributeValues={":ka": {}})
+
+        self.assertEqual(1, table.return_updated_times())
+        self.assertEqual(2, retry.stats["throttled"])
+        self.assertEqual(1, retry.level)
+
+    def test_other_errors_and_the_last_retry_raise(self):
+        retry = AdaptiveRetry(max_retries=2)
+        with self.assertRaises(TestClientError):
+            retry.call(0, FlakyDynamoDB(invalid=[1]).put_item, Item={"timeStamp": 1})
+        self.assertEqual(0, retry.stats["throttled"])
+
+        with self.assertRaises(TestClientError):
+            retry.call(0, FlakyDynamoDB(throttled_rounds=10).batch_write_item, RequestItems={})
+        self.assertEqual(3, retry.stats["throttled"])
+        self.assertEqual(1, retry.stats["gave_up"])
+
+
+class FailureIsolationTest(unittest.TestCase):
+    def setUp(self):
+        self.log = TestLog()
+        self.sns = TestSNS()
+        self.dead_letters = DeadLetterSink(self.log)
+
+    def server(self, table, dead_letters=True):
+        server = Server(table, None, self.sns, self.log, dead_letters=self.dead_letters if dead_letters else None)
+        server.backoff_base = 0
+        return server
+
+    def test_throttled_batch_is_written(self):
+        table = FlakyDynamoDB(throttled_rounds=3)
+        stats = self.server(table).store_events([uplink(i) for i in range(3)])
+
+        self.assertEqual(3, len(table.batch_written))
+        self.assertEqual(0, stats["failed"])
+        self.assertEqual(3, self.sns.return_published_times())
+
+    def test_failed_record_goes_to_dead_letters(self):
+        table = FlakyDynamoDB(invalid=[1499366509001])
+        events = [uplink(i) for i in range(3)]
+
+        stats = self.server(table).store_events(events)
+
+        self.assertEqual(1, stats["failed"])
+        self.assertEqual(2, table.return_persisted_times())
+        self.assertEqual(2, self.sns.return_published_times())
+        self.assertEqual(PAYLOAD_PARSER_TOPIC, self.sns.return_topicarn())
+        self.assertEqual([(STORE, "vtx1")], [(entry["stage"], entry["virtual_tx"])
+                                             for entry in self.dead_letters.entries])
+        self.assertEqual(events[1], self.dead_letters.entries[0]["record"])
+
+    def test_without_dead_letters_the_invocation_fails(self):
+        with self.assertRaises(NotFoundError):
+            self.server(FlakyDynamoDB(invalid=[1499366509001]), False).store_events([uplink(i) for i in range(3)])
+
+    def test_fused_mode_skips_alarms_of_failed_records(self):
+        table = FlakyDynamoDB(invalid=[1499366509000])
+
+        self.server(table).store_events([uplink(0), uplink(1)], fused=True)
+
+        self.assertEqual(1, self.sns.return_published_times())
+        self.assertEqual("vtx1", json.loads(self.sns.return_message())["virtual_tx"])
+        self.assertEqual(["vtx0"], [entry["virtual_tx"] for entry in self.dead_letters.entries])
+
+    def test_failed_update_skips_the_alarm(self):
+        table = FlakyDynamoDB(throttled_rounds=1, invalid=[1499366509000])
+
+        self.server(table).parse_events([uplink(0), uplink(1), uplink(2, "A1")])
+
+        self.assertEqual(1, table.return_updated_times())
+        self.assertEqual(1, self.sns.return_published_times())
+        self.assertEqual("vtx1", json.loads(self.sns.return_message())["virtual_tx"])
+        self.assertEqual([(PARSE, "vtx0")], [(entry["stage"], entry["virtual_tx"])
+                                             for entry in self.dead_letters.entries])
+
+    def test_undecodable_message_does_not_fail_the_event(self):
+        table = FlakyDynamoDB()
+        app._server = self.server(table)
+        app.metrics.emit = lambda record: None
+        try:
+            app.realtime_lambda_function({"Records": [{"Sns": {"Message": "{not json"}},
+                                                      {"Sns": {"Message": json.dumps(uplink(0))}}]}, None)
+        finally:
+            app._server = None
+            app.metrics.emit = print
+
+        self.assertEqual(1, len(table.batch_written))
+        self.assertEqual([(STORE, None, "{not json")], [(entry["stage"], entry["virtual_tx"], entry["record"])
+                                                        for entry in self.dead_letters.entries])
+
+
+class ReplayTest(unittest.TestCase):
+    def test_pending_keeps_one_entry_per_virtual_tx(self):
+        entries = [{"stage": STORE, "virtual_tx": "vtx0", "record": uplink(0), "error": "first"},
+                   {"stage": STORE, "virtual_tx": "vtx1", "record": uplink(1)},
+                   {"stage": PARSE, "virtual_tx": "vtx0", "record": uplink(0)},
+                   {"stage": STORE, "virtual_tx": "vtx0", "record": uplink(0), "error": "second"}]
+
+        self.assertEqual([(STORE, "vtx1"), (PARSE, "vtx0"), (STORE, "vtx0")],
+                         [(entry["stage"], entry["virtual_tx"]) for entry in pending(entries)])
+        self.assertEqual("second", pending(entries)[-1]["error"])
+
+    def test_file_sink_and_replay(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".ndjson", delete=False) as dead_letters_file:
+            path = dead_letters_file.name
+        try:
+            sink = DeadLetterSink(TestLog(), path)
+            for i in range(3):
+                sink.add(STORE, uplink(i), TestClientError("ValidationException"))
+            sink.add(STORE, uplink(0), TestClientError("ValidationException"))
+            sink.add(PARSE, "{not json", ValueError("Expecting value"))
+            with open(path) as stream:
+                entries = read_dead_letters(stream)
+        finally:
+            os.remove(path)
+
+        table = FlakyDynamoDB(invalid=[1499366509002])
+        sns = TestSNS()
+        server = Server(table, None, sns, TestLog())
+        failed = replay(server, entries)
+
+        self.assertEqual(5, len(entries))
+        self.assertEqual(2, len(table.batch_written) + table.return_persisted_times())
+        self.assertEqual(2, sns.return_published_times())
+        self.assertEqual([(STORE, "vtx2"), (PARSE, None)], [(entry["stage"], entry["virtual_tx"]) for entry in failed])
+
+    def test_queue_is_drained(self):
+        sns = TestSNS()
+        topic_sink = DeadLetterSink(TestLog(), sns_client=sns, topic_arn="arn:dead-letters")
+        bodies = []
+        for i in range(12):
+            topic_sink.add(STORE, uplink(i), TestClientError("ValidationException"))
+            message = sns.return_message()
+            # Without raw message delivery the entry comes in an SNS notification
+            bodies.append(message if i % 2 else json.dumps({"Type": "Notification", "Message": message}))
+        bodies.append("{not json")
+        sqs = TestSQS(bodies)
+
+        table = FlakyDynamoDB(invalid=[1499366509003])
+        server = Server(table, None, TestSNS(), TestLog())
+        stats = drain_queue(server, sqs, "https://queue", max_messages=5)
+
+        self.assertEqual({"received": 13, "replayed": 11, "failed": 1, "unreadable": 1}, stats)
+        self.assertEqual(11, len(table.batch_written) + table.return_persisted_times())
+        self.assertEqual(["r%d" % i for i in range(12) if i != 3], sorted(sqs.deleted, key=lambda r: int(r[1:])))
+
+    def test_topic_sink(self):
+        sns = TestSNS()
+        DeadLetterSink(TestLog(), "/nonexistent/dead_letters", sns, "arn:dead-letters").add(PARSE, uplink(0),
+                                                                                            ValueError("boom"))
+        self.assertEqual("arn:dead-letters", sns.return_topicarn())
+        self.assertEqual("Dead letter parse", sns.return_subject())
+        self.assertEqual("vtx0", json.loads(sns.return_message())["virtual_tx"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+"""
+Tests for the duplicate uplink suppression
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+
+from chalicelib.dedup import Deduplicator, TTLCache
+from chalicelib.server import Server
+from test.test_app import TestDynamoDB, TestLog, TestSNS
+
+
+class FailingTable:
+    def put_item(self, Item, ConditionExpression=None):
+        raise IOError("connection refused")
+
+
+class FailingSNS(TestSNS):
+    def publish(self, TopicArn, Subject, Message):
+        raise IOError("SNS unreachable")
+
+
+class DedupTest(unittest.TestCase):
+    def setUp(self):
+        self.log = TestLog()
+
+    def test_second_uplink_is_a_local_hit(self):
+        deduplicator = Deduplicator(self.log)
+
+        self.assertFalse(deduplicator.is_duplicate("A001"))
+        self.assertTrue(deduplicator.is_duplicate("A001"))
+        self.assertFalse(deduplicator.is_duplicate("A002"))
+        self.assertEqual({"hits": 1, "remote_hits": 0, "misses": 2, "errors": 0}, deduplicator.stats)
+
+    def test_uplink_accepted_by_other_container_is_a_remote_hit(self):
+        table = TestDynamoDB()
+        Deduplicator(self.log, table).is_duplicate("A001")
+        deduplicator = Deduplicator(self.log, table)
+
+        self.assertTrue(deduplicator.is_duplicate("A001"))
+        self.assertTrue(deduplicator.is_duplicate("A001"))
+        self.assertEqual(1, deduplicator.stats["remote_hits"])
+        self.assertEqual(1, deduplicator.stats["hits"])
+        self.assertEqual(1, table.return_persisted_times())
+
+    def test_unreachable_table_lets_uplinks_through(self):
+        deduplicator = Deduplicator(self.log, FailingTable())
+
+        self.assertFalse(deduplicator.is_duplicate("A001"))
+        self.assertEqual(1, deduplicator.stats["errors"])
+
+    def test_cache_is_bounded_and_expires(self):
+        cache = TTLCache(max_entries=2, ttl=300)
+        for key in ["A001", "A002", "A003"]:
+            cache.add(key)
+        self.assertEqual(2, len(cache))
+        self.assertNotIn("A001", cache)
+        self.assertIn("A003", cache)
+
+        expired = TTLCache(ttl=-1)
+        expired.add("A001")
+        self.assertNotIn("A001", expired)
+
+    def test_server_does_not_publish_duplicates(self):
+        sns_client = TestSNS()
+        server = Server(None, None, sns_client, self.log, deduplicator=Deduplicator(self.log))
+        event = {"virtual_tx": "A001", "DevEUI": "260113E3"}
+
+        for _ in range(3):
+            if not server.is_duplicate(event):
+                server.publish_data_store_device(event)
+
+        self.assertEqual(1, sns_client.return_published_times())
+
+    def test_failed_publish_releases_the_claim(self):
+        table = TestDynamoDB()
+        event = {"virtual_tx": "A001", "DevEUI": "260113E3"}
+        server = Server(None, None, FailingSNS(), self.log, deduplicator=Deduplicator(self.log, table))
+
+        self.assertFalse(server.is_duplicate(event))
+        with self.assertRaises(IOError):
+            server.publish_accepted([event])
+
+        retry = Server(None, None, TestSNS(), self.log, deduplicator=Deduplicator(self.log, table))
+        server.sns_client = retry.sns_client
+        self.assertFalse(server.is_duplicate(event))
+        server.publish_accepted([event])
+        self.assertTrue(retry.is_duplicate(event))
+        self.assertEqual(1, server.sns_client.return_published_times())
+
+    def test_server_without_deduplicator_accepts_everything(self):
+        server = Server(None, None, None, self.log)
+        self.assertFalse(server.is_duplicate({"virtual_tx": "A001"}))
+        self.assertFalse(server.is_duplicate({"virtual_tx": "A001"}))
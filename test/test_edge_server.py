@@ -0,0 +1,110 @@
+"""
+Tests for the asyncio edge ingestion server, run offline against the fake SNS and DynamoDB
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+import asyncio
+import json
+import time
+
+from aiohttp.test_utils import TestServer, TestClient
+
+from chalicelib.deadletter import DeadLetterSink, STORE
+from chalicelib.dedup import Deduplicator
+from chalicelib.publisher import BatchPublisher
+from chalicelib.server import Server
+from edge_server import EdgeServer, MicroBatcher, sns_sink, dynamodb_sink
+from test.test_app import TestDynamoDB, TestLog, TestSNS
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class EdgeServerTest(unittest.TestCase):
+    def setUp(self):
+        self.log = TestLog()
+        self.sns_client = TestSNS()
+        self.table = TestDynamoDB()
+        self.server = Server(self.table, None, self.sns_client, self.log,
+                             publisher=BatchPublisher(self.sns_client, self.log, max_wait=60),
+                             deduplicator=Deduplicator(self.log))
+
+    def request_all(self, sink, requests, max_batch=100, max_latency=0.05, max_pending=1000, dead_letters=None):
+        batcher = MicroBatcher(sink, self.log, max_batch, max_latency, max_pending, dead_letters, max_retries=1,
+                               backoff_base=0)
+        edge = EdgeServer(self.server, batcher, self.log, put_timeout=0.2)
+
+        async def go():
+            client = TestClient(TestServer(edge.application()))
+            await client.start_server()
+            try:
+                statuses = []
+                for method, path, body in requests:
+                    response = await client.request(method, path, data=body)
+                    statuses.append(response.status)
+                return statuses
+            finally:
+                await client.close()
+        return run(go()), batcher
+
+    def test_sigfox_uplinks_are_batched_into_publish_batch(self):
+        requests = [("GET", "/sigfox?time=1515360218&id=D%d&data=02180AE4" % i, None) for i in range(25)]
+
+        statuses, batcher = self.request_all(sns_sink(self.server), requests, max_batch=25, max_latency=0.5)
+
+        self.assertEqual([200] * 25, statuses)
+        self.assertEqual(25, batcher.stats["flushed"])
+        self.assertEqual(25, sum(len(entries) for _, entries in self.sns_client.batches))
+        self.assertEqual(0, self.sns_client.return_published_times())
+
+    def test_lora_uplinks_are_written_in_bulk(self):
+        uplink = {"DevEUI_uplink": {"Time": "2017-03-11T11:52:50.412+01:00", "payload_hex": "02180AE4",
+                                    "DevAddr": "260113E2"}}
+        requests = [("POST", "/lora", json.dumps({"body": json.dumps(uplink)}))] * 3
+        requests.append(("POST", "/lora", json.dumps({"body": "{}"})))
+
+        statuses, batcher = self.request_all(dynamodb_sink(self.server, fused=True), requests)
+
+        self.assertEqual([200, 200, 200, 400], statuses)
+        self.assertEqual(1, len(self.table.batch_written))
+        self.assertEqual("2.788", self.table.batch_written[0]["ka"]["voltage"])
+        self.assertEqual(2, self.server.deduplicator.stats["hits"])
+
+    def test_lagging_sink_applies_backpressure(self):
+        def slow_sink(batch):
+            time.sleep(1)
+
+        requests = [("GET", "/sigfox?time=1515360218&id=D%d&data=02180AE4" % i, None) for i in range(4)]
+        statuses, batcher = self.request_all(slow_sink, requests, max_batch=1, max_latency=0, max_pending=1)
+
+        self.assertEqual([200, 200, 503, 503], statuses)
+        self.assertEqual(2, batcher.stats["rejected"])
+        self.assertEqual(2, batcher.stats["flushed"])
+        # The rejected uplinks are not claimed, their retries are accepted
+        self.assertEqual(2, len(self.server.deduplicator.cache))
+
+    def test_failing_sink_dead_letters_the_batch(self):
+        calls = []
+
+        def failing_sink(batch):
+            calls.append(len(batch))
+            raise IOError("SNS unreachable")
+
+        dead_letters = DeadLetterSink(self.log)
+        requests = [("GET", "/sigfox?time=1515360218&id=D%d&data=02180AE4" % i, None) for i in range(3)]
+        statuses, batcher = self.request_all(failing_sink, requests, max_batch=3, max_latency=0.5,
+                                             dead_letters=dead_letters)
+
+        self.assertEqual([200, 200, 200], statuses)
+        self.assertEqual([3, 3], calls)
+        self.assertEqual(1, batcher.stats["retries"])
+        self.assertEqual([STORE] * 3, [entry["stage"] for entry in dead_letters.entries])
+        self.assertEqual("OSError: SNS unreachable", dead_letters.entries[0]["error"])
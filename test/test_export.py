@@ -0,0 +1,148 @@
+"""
+Tests for the streaming DeviceData export
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+import io
+import json
+import math
+import threading
+from decimal import Decimal
+
+from chalicelib import export
+
+
+# Two items per page, the segment of an item is its position modulo the segments
+class TestExportTable:
+    def __init__(self, items, page_size=2):
+        self.items = items
+        self.page_size = page_size
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _page(self, found, arguments):
+        with self.lock:
+            self.calls += 1
+        first = arguments.get("ExclusiveStartKey", {}).get("position", 0)
+        names = arguments["ExpressionAttributeNames"]
+        fields = [names[name.strip()] for name in arguments["ProjectionExpression"].split(",")]
+        page = [dict((field, item[field]) for field in fields if field in item)
+                for item in found[first:first + self.page_size]]
+        response = {"Items": page}
+        if first + self.page_size < len(found):
+            response["LastEvaluatedKey"] = {"position": first + self.page_size}
+        return response
+
+    def _in_range(self, item, values):
+        return any(values[low] <= item["timeStamp"] <= values[high]
+                   for low, high in [(":from", ":to"), (":from_s", ":to_s")] if low in values)
+
+    def query(self, **arguments):
+        values = arguments["ExpressionAttributeValues"]
+        found = [item for item in self.items if item["DevEUI"] == values[":dev_eui"] and self._in_range(item, values)]
+        return self._page(found, arguments)
+
+    def scan(self, **arguments):
+        values = arguments["ExpressionAttributeValues"]
+        found = [item for position, item in enumerate(self.items)
+                 if position % arguments["TotalSegments"] == arguments["Segment"] and self._in_range(item, values)]
+        return self._page(found, arguments)
+
+
+def stored_item(dev_eui, time_stamp):
+    item = {"DevEUI": dev_eui, "timeStamp": Decimal(time_stamp), "type": "LORA", "payload": "02180AE4",
+            "extra": "{}"}
+    if time_stamp % 2:
+        item["geo"] = {"lat": "41.38", "lng": "2.17"}
+    else:
+        item["ka"] = {"interval": "24", "voltage": "2.788"}
+    return item
+
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.items = [stored_item("A", 1515360218000 + i) for i in range(7)]
+        self.items += [stored_item("B", 1515360218000 + i) for i in range(5)]
+        self.table = TestExportTable(self.items)
+
+    def test_query_pages_every_device(self):
+        items = list(export.query_items(self.table, ["A", "B"], 1515360218001, 1515360218004))
+        self.assertEqual(8, len(items))
+        self.assertNotIn("extra", items[0])
+
+    def test_sigfox_items_in_seconds_are_exported(self):
+        self.table.items.append(dict(stored_item("C", 1515360218), type="SIGFOX"))
+        self.table.items.append(dict(stored_item("C", 1515360219), type="SIGFOX"))
+
+        queried = list(export.query_items(self.table, ["A", "C"], 1515360218000, 1515360218001))
+        scanned = list(export.scan_items(self.table, 1515360218000, 1515360218001, segments=2))
+
+        self.assertEqual([("A", 1515360218000), ("A", 1515360218001), ("C", 1515360218)],
+                         sorted((item["DevEUI"], item["timeStamp"]) for item in queried))
+        self.assertEqual([("A", 1515360218000), ("A", 1515360218001), ("B", 1515360218000),
+                          ("B", 1515360218001), ("C", 1515360218)],
+                         sorted((item["DevEUI"], item["timeStamp"]) for item in scanned))
+
+    def test_ranges_in_seconds_and_milliseconds_do_not_overlap(self):
+        self.assertEqual([(":from_s", ":to_s", 1515360219, 1515360219),
+                          (":from", ":to", 1515360218001, 1515360219000)],
+                         export.stored_ranges(1515360218001, 1515360219000))
+        self.assertEqual([(":from_s", ":to_s", 0, 10 ** 11 - 1), (":from", ":to", 10 ** 11, 2 ** 63)],
+                         export.stored_ranges(0, 2 ** 63))
+        self.assertEqual([(":from", ":to", 1515360218001, 1515360218999)],
+                         export.stored_ranges(1515360218001, 1515360218999))
+        self.assertEqual([], export.stored_ranges(2, 1))
+
+    def test_parallel_scan_returns_every_item(self):
+        items = list(export.scan_items(self.table, 0, 2 ** 63, segments=3, max_pending=1))
+        self.assertEqual(sorted((item["DevEUI"], item["timeStamp"]) for item in self.items),
+                         sorted((item["DevEUI"], item["timeStamp"]) for item in items))
+
+    def test_scan_stops_when_the_consumer_does(self):
+        items = export.scan_items(self.table, 0, 2 ** 63, segments=2, max_pending=1)
+        next(items)
+        items.close()
+        self.assertLess(self.table.calls, 12)
+
+    def test_scan_errors_reach_the_consumer(self):
+        def failing(**arguments):
+            raise Exception("ProvisionedThroughputExceededException")
+        self.table.scan = failing
+        with self.assertRaises(Exception):
+            list(export.scan_items(self.table, 0, 2 ** 63, segments=2))
+
+    def test_columnar_round_trip_in_chunks(self):
+        stream = io.BytesIO()
+        rows = export.export(export.query_items(self.table, ["A", "B"], 0, 2 ** 63),
+                             export.ColumnarWriter(stream, chunk_rows=5))
+        stream.seek(0)
+        chunks = list(export.read_columnar(stream))
+
+        self.assertEqual(12, rows)
+        self.assertEqual([5, 5, 2], [len(chunk["timeStamp"]) for chunk in chunks])
+        first = chunks[0]
+        self.assertEqual(["A"] * 5, first["DevEUI"])
+        self.assertEqual(1515360218000, first["timeStamp"][0])
+        self.assertEqual(2.788, first["voltage"][0])
+        self.assertEqual(24, first["interval"][0])
+        self.assertTrue(math.isnan(first["lat"][0]))
+        self.assertEqual(41.38, first["lat"][1])
+        self.assertEqual(export.NO_INTERVAL, first["interval"][1])
+
+    def test_ndjson_keeps_the_items(self):
+        stream = io.BytesIO()
+        export.export(iter(self.items[:2]), export.NdjsonWriter(stream))
+        lines = stream.getvalue().decode().splitlines()
+        self.assertEqual(2, len(lines))
+        self.assertEqual(1515360218000, json.loads(lines[0])["timeStamp"])
+
+    def test_sigfox_seconds_are_exported_as_milliseconds(self):
+        row = export.to_row({"DevEUI": "S", "timeStamp": Decimal(1515360218), "type": "SIGFOX"})
+        self.assertEqual(1515360218000, row[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
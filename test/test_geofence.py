@@ -0,0 +1,145 @@
+"""
+Tests for the geofence index and the enter / exit events
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+import json
+from decimal import Decimal
+
+from chalicelib.geofence import Fence, GridIndex, GeofenceEngine, point_in_polygon, load_fences, ENTER, EXIT
+from chalicelib.server import Server, NOTIFY_TOPIC
+from test.test_app import TestDynamoDB, TestLog, TestSNS, TestConditionalCheckFailed
+
+
+def square(fence_id, lat, lng, size=0.005, devices=None):
+    return Fence(fence_id, [(lat, lng), (lat + size, lng), (lat + size, lng + size), (lat, lng + size)], devices)
+
+
+def position(dev_eui, time_stamp, lat, lng):
+    return {"DevEUI": dev_eui, "timeStamp": time_stamp, "GEO": {"lat": str(lat), "lng": str(lng)}}
+
+
+# put_item only replaces a state with an older timeStamp
+class StateTable(TestDynamoDB):
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        stored = self.get_item({"DevEUI": Item["DevEUI"]}).get("Item")
+        if stored is not None and stored["timeStamp"] >= ExpressionAttributeValues[":t"]:
+            raise TestConditionalCheckFailed()
+        TestDynamoDB.put_item(self, Item)
+
+
+class FailingStates(TestDynamoDB):
+    def batch_get_item(self, RequestItems):
+        raise Exception("ProvisionedThroughputExceededException")
+
+
+class GeofenceTest(unittest.TestCase):
+    def setUp(self):
+        self.fences = [square("port", 41.350, 2.160), square("depot", 41.400, 2.200, devices=["B"])]
+        self.fences += [square("far%d" % i, 10 + i * 0.1, 10) for i in range(1000)]
+        self.engine = GeofenceEngine(TestLog(), self.fences)
+
+    def test_point_in_polygon(self):
+        triangle = [(0, 0), (10, 0), (0, 10)]
+        self.assertTrue(point_in_polygon(1, 1, triangle))
+        self.assertFalse(point_in_polygon(6, 6, triangle))
+
+    def test_only_the_fences_of_the_cell_are_tested(self):
+        index = GridIndex(self.fences)
+        self.assertEqual(["port"], [fence.fence_id for fence in index.candidates(41.352, 2.162)])
+        self.assertEqual({"port"}, index.containing("A", 41.352, 2.162))
+        self.assertEqual(set(), index.containing("A", 41.402, 2.202))
+        self.assertEqual({"depot"}, index.containing("B", 41.402, 2.202))
+
+    def test_wide_fences_are_checked_everywhere(self):
+        index = GridIndex([square("country", 40, 0, size=3)])
+        self.assertEqual({"country"}, index.containing("A", 41.5, 2.1))
+        self.assertEqual(1, len(index.wide))
+
+    def test_enter_and_exit_are_sent_once(self):
+        events = self.engine.evaluate([position("A", 3, 41.352, 2.162), position("A", 1, 41.0, 2.0),
+                                       position("A", 2, 41.351, 2.161), position("A", 4, 41.0, 2.0), None])
+        self.assertEqual([(ENTER, "port", 2), (EXIT, "port", 4)],
+                         [(event["event"], event["fence_id"], event["timeStamp"]) for event in events])
+
+        self.assertEqual([], self.engine.evaluate([position("A", 5, 41.0, 2.0)]))
+        self.assertEqual([], self.engine.evaluate([position("A", 3, 41.352, 2.162)]))
+        self.assertEqual(1, self.engine.stats["stale"])
+
+    def test_state_is_shared_through_the_table(self):
+        states = StateTable("GeofenceState")
+        GeofenceEngine(TestLog(), self.fences, state_table=states).evaluate([position("A", 1, 41.352, 2.162)])
+
+        other = GeofenceEngine(TestLog(), self.fences, state_table=states)
+        events = other.evaluate([position("A", 2, 41.353, 2.163), position("A", 3, 41.0, 2.0)])
+        self.assertEqual([EXIT], [event["event"] for event in events])
+        self.assertEqual(2, states.batch_gets)
+
+    def test_newer_state_of_another_container_is_kept(self):
+        states = StateTable("GeofenceState")
+        engine = GeofenceEngine(TestLog(), self.fences, state_table=states)
+        other = GeofenceEngine(TestLog(), self.fences, state_table=states)
+        engine.evaluate([position("A", 1, 41.0, 2.0)])
+        other.evaluate([position("A", 5, 41.352, 2.162)])
+
+        self.assertEqual([], engine.evaluate([position("A", 3, 41.352, 2.162)]))
+        self.assertEqual(1, engine.stats["conflicts"])
+        self.assertEqual(0, engine.stats[ENTER])
+        self.assertEqual(5, states.get_item({"DevEUI": "A"})["Item"]["timeStamp"])
+
+        # The cached state was dropped, the next batch reads the one of the other container
+        self.assertEqual([EXIT], [event["event"] for event in engine.evaluate([position("A", 6, 41.0, 2.0)])])
+
+    def test_only_the_container_that_saves_the_state_sends_the_events(self):
+        states = StateTable("GeofenceState")
+        engine = GeofenceEngine(TestLog(), self.fences, state_table=states)
+        other = GeofenceEngine(TestLog(), self.fences, state_table=states)
+        engine.evaluate([position("A", 1, 41.0, 2.0)])
+        other.evaluate([position("A", 1, 41.0, 2.0)])
+
+        # Both read the state outside the port, the first one to save it sends the enter event
+        self.assertEqual([ENTER], [event["event"] for event in other.evaluate([position("A", 2, 41.352, 2.162)])])
+        self.assertEqual([], engine.evaluate([position("A", 2, 41.352, 2.162)]))
+        self.assertEqual(1, engine.stats["conflicts"])
+
+    def test_states_expire(self):
+        states = StateTable("GeofenceState")
+        engine = GeofenceEngine(TestLog(), self.fences, state_table=states, state_ttl=-1)
+        engine.evaluate([position("A", 1, 41.352, 2.162)])
+        engine.evaluate([position("A", 2, 41.352, 2.162)])
+        self.assertEqual(2, states.batch_gets)
+
+    def test_devices_without_state_are_skipped(self):
+        engine = GeofenceEngine(TestLog(), self.fences, state_table=FailingStates("GeofenceState"))
+        self.assertEqual([], engine.evaluate([position("A", 1, 41.352, 2.162)]))
+        self.assertEqual(1, engine.stats["errors"])
+
+    def test_fences_are_loaded_from_the_table(self):
+        class FenceTable:
+            def scan(self, **arguments):
+                if "ExclusiveStartKey" not in arguments:
+                    return {"Items": [{"fence_id": "a", "polygon": [[Decimal(0), Decimal(0)], [Decimal(1), Decimal(0)],
+                                                                     [Decimal(0), Decimal(1)]]}],
+                            "LastEvaluatedKey": {"fence_id": "a"}}
+                return {"Items": [{"fence_id": "b", "polygon": [[2, 2], [3, 2], [2, 3]], "devices": ["X"]}]}
+
+        fences = load_fences(FenceTable())
+        self.assertEqual(["a", "b"], [fence.fence_id for fence in fences])
+        self.assertEqual(frozenset(["X"]), fences[1].devices)
+
+    def test_server_notifies_the_events(self):
+        sns = TestSNS()
+        server = Server(TestDynamoDB(), None, sns, TestLog(), geofences=self.engine)
+        server.dispatch_geofences([position("A", 1, 41.352, 2.162)])
+
+        self.assertEqual(NOTIFY_TOPIC, sns.return_topicarn())
+        self.assertEqual("Geofence enter port A", sns.Subject)
+        self.assertEqual("port", json.loads(sns.return_message())["fence_id"])
+        self.assertEqual(1, server.metrics.counters["geofence_events"])
+
+
+if __name__ == '__main__':
+    unittest.main()
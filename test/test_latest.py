@@ -0,0 +1,118 @@
+"""
+Tests for the latest state view of every device
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+import re
+
+from chalicelib.latest import LatestState
+from chalicelib.payload_codecs import CODECS
+from chalicelib.server import Server
+from test.test_app import TestDynamoDB, TestLog, TestSNS, TestConditionalCheckFailed
+
+CONDITION = re.compile(r"\(attribute_not_exists\((#\w+)\) OR (#\w+) <= (:\w+)\)")
+
+
+# Evaluates the SET expressions and timestamp conditions written by LatestState
+class TestLatestTable(TestDynamoDB):
+    def __init__(self):
+        super().__init__("DeviceLatest")
+        self.state = {}
+        self.writes = 0
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression, ExpressionAttributeNames,
+                    ExpressionAttributeValues):
+        self.writes += 1
+        item = self.state.setdefault(Key["DevEUI"], dict(Key))
+        for name, _, value in CONDITION.findall(ConditionExpression):
+            name = ExpressionAttributeNames[name]
+            if name in item and item[name] > ExpressionAttributeValues[value]:
+                raise TestConditionalCheckFailed()
+        for assignment in UpdateExpression[len("SET "):].split(", "):
+            name, value = assignment.split(" = ")
+            item[ExpressionAttributeNames[name]] = ExpressionAttributeValues[value]
+
+    def get_item(self, Key):
+        item = self.state.get(Key["DevEUI"])
+        return {"Item": item} if item is not None else {}
+
+
+def keep_alive(dev_eui, time_stamp, voltage):
+    return {"DevEUI": dev_eui, "timeStamp": time_stamp, "ka": {"interval": "24", "voltage": voltage}}
+
+
+def position(dev_eui, time_stamp, lat):
+    return {"DevEUI": dev_eui, "timeStamp": time_stamp, "geo": {"lat": lat, "lng": "2.1"}}
+
+
+class LatestStateTest(unittest.TestCase):
+    def setUp(self):
+        self.table = TestLatestTable()
+        self.latest = LatestState(self.table, TestLog())
+
+    def test_batch_writes_each_device_once(self):
+        self.latest.update([keep_alive("A", 10, "2.7"), position("A", 11, "41.1"), keep_alive("A", 12, "2.8"),
+                            keep_alive("B", 5, "3.0")])
+
+        self.assertEqual(2, self.table.writes)
+        state = self.latest.get("A")
+        self.assertEqual(12, state["last_seen"])
+        self.assertEqual("2.8", state["ka"]["voltage"])
+        self.assertEqual(12, state["ka_ts"])
+        self.assertEqual("41.1", state["geo"]["lat"])
+        self.assertEqual(11, state["geo_ts"])
+
+    def test_late_uplinks_do_not_overwrite_newer_state(self):
+        self.latest.update([keep_alive("A", 20, "2.9")])
+        self.latest.update([keep_alive("A", 10, "2.5"), position("A", 15, "41.1")])
+
+        state = self.latest.get("A")
+        self.assertEqual("2.9", state["ka"]["voltage"])
+        self.assertEqual(20, state["last_seen"])
+        self.assertEqual("41.1", state["geo"]["lat"])
+        self.assertEqual(2, self.latest.stats["stale"])
+
+    def test_reprocessing_is_idempotent(self):
+        self.latest.update([keep_alive("A", 20, "2.9")])
+        self.latest.update([keep_alive("A", 20, "2.9")])
+        self.assertEqual(0, self.latest.stats["stale"])
+        self.assertEqual(2, self.table.writes)
+
+    def test_get_many_reads_in_one_call(self):
+        self.latest.update([keep_alive("A", 1, "2.9"), keep_alive("B", 1, "2.9")])
+        self.table.items = list(self.table.state.values())
+
+        found = self.latest.get_many(["A", "B", "C", "A"])
+
+        self.assertEqual(["A", "B"], sorted(found))
+        self.assertEqual(1, self.table.batch_gets)
+
+    def test_codecs_registered_at_runtime_are_kept(self):
+        CODECS.register("03", "TEMP", "data", lambda raw: {"celsius": str(raw[1])})
+        try:
+            self.latest.update([{"DevEUI": "A", "timeStamp": 10, "data": {"celsius": "21"}}])
+        finally:
+            del CODECS.codecs[("03", None)]
+            CODECS._attributes = None
+        self.assertEqual({"celsius": "21"}, self.latest.get("A")["data"])
+        self.assertEqual(10, self.latest.get("A")["data_ts"])
+
+    def test_errors_do_not_stop_the_batch(self):
+        def failing(**kwargs):
+            raise Exception("ProvisionedThroughputExceededException")
+        self.table.update_item = failing
+        self.latest.update([keep_alive("A", 1, "2.9"), keep_alive("B", 1, "2.9")])
+        self.assertEqual(2, self.latest.stats["errors"])
+
+    def test_fused_pipeline_updates_the_view(self):
+        server = Server(TestDynamoDB(), None, TestSNS(), TestLog(), latest=self.latest)
+        server.persist_and_parse([{"virtual_tx": "A001", "timeStamp": 1499366509000, "DevEUI": "260113E3",
+                                   "payload": "02180AE4"}])
+        self.assertEqual("2.788", self.latest.get("260113E3")["ka"]["voltage"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+"""
+Tests for the per-stage metrics and the sampled payload logging
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+import json
+
+from chalicelib.metrics import Metrics, PayloadSampler
+from chalicelib.server import Server
+from test.test_app import TestDynamoDB, TestLog, TestSNS
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.emitted = []
+        self.metrics = Metrics("Test/Platform", self.emitted.append)
+
+    def test_flush_emits_one_emf_record_and_resets(self):
+        for milliseconds in [1.0, 3.0, 2.0]:
+            self.metrics.record("persist", milliseconds)
+        self.metrics.count("persisted", 25)
+
+        record = self.metrics.flush("realtime_lambda_function")
+
+        self.assertEqual(1, len(self.emitted))
+        self.assertEqual(record, json.loads(self.emitted[0]))
+        self.assertEqual("realtime_lambda_function", record["function"])
+        self.assertEqual(6.0, record["persist_ms"])
+        self.assertEqual(3.0, record["persist_max_ms"])
+        self.assertEqual(3, record["persist_calls"])
+        self.assertEqual(25, record["persisted"])
+        definition = record["_aws"]["CloudWatchMetrics"][0]
+        self.assertEqual("Test/Platform", definition["Namespace"])
+        self.assertEqual([["function"]], definition["Dimensions"])
+        self.assertIn({"Name": "persist_ms", "Unit": "Milliseconds"}, definition["Metrics"])
+        self.assertIn({"Name": "persisted", "Unit": "Count"}, definition["Metrics"])
+
+        self.assertIsNone(self.metrics.flush("realtime_lambda_function"))
+        self.assertEqual(1, len(self.emitted))
+
+    def test_timer_records_a_call(self):
+        with self.metrics.timer("decode"):
+            pass
+        self.assertEqual(1, self.metrics.timings["decode"][1])
+
+    def test_server_times_its_stages(self):
+        server = Server(TestDynamoDB(), None, TestSNS(), TestLog(), metrics=self.metrics)
+        events = [{"virtual_tx": "A001", "timeStamp": 1499366509000, "DevEUI": "260113E3", "payload": "02180998"}]
+
+        server.persist_and_parse(events)
+        server.update_data_batch([Server.parse_payload(events[0])])
+        record = self.metrics.flush("test")
+
+        for stage in ["decode", "persist", "alarm", "publish", "update"]:
+            self.assertEqual(1, record[stage + "_calls"], stage)
+        self.assertEqual(1, record["persisted"])
+        self.assertEqual(1, record["alarms_notified"])
+
+
+class PayloadSamplerTest(unittest.TestCase):
+    def test_rate_zero_logs_nothing(self):
+        log = TestLog()
+        sampler = PayloadSampler(log, 0)
+        for _ in range(100):
+            sampler.log_payload("Received", {"a": 1})
+        self.assertEqual(0, log.return_logging_times())
+
+    def test_rate_one_logs_everything(self):
+        log = TestLog()
+        sampler = PayloadSampler(log, 1)
+        sampler.log_payload("Received", "02180AE4")
+        self.assertEqual(1, log.return_logging_times())
+        self.assertEqual("Received 02180AE4", log.return_message())
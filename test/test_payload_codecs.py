@@ -0,0 +1,69 @@
+"""
+Tests for the payload codec registry
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+import random
+
+from chalicelib.payload_codecs import default_registry, CodecRegistry, KEEP_ALIVE_LAYOUT
+from chalicelib.server import extract_lat_long, extract_keep_alive
+from test.test_app import TestLog
+
+
+class PayloadCodecsTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = default_registry()
+
+    def test_geo_codec_matches_string_decoder(self):
+        rnd = random.Random(3)
+        for _ in range(200):
+            payload = "10%06x%06x0734" % (rnd.randint(0, 0xFFFFFF), rnd.randint(0, 0xFFFFFF))
+            self.assertEqual(("GEO", extract_lat_long(payload)), self.registry.decode(payload))
+
+    def test_keep_alive_codec_matches_string_decoder(self):
+        for payload in ["02180AE4", "02000000", "02FFFFFF", "02180998"]:
+            self.assertEqual(("KA", extract_keep_alive(payload)), self.registry.decode(payload))
+
+    def test_trailing_bytes_and_odd_lengths_are_ignored(self):
+        for payload in ["02180AE4F", "02180AE4FF", "10bb17f18198100734a"]:
+            self.assertEqual(self.registry.decode(payload[:len(payload) // 2 * 2]), self.registry.decode(payload))
+        self.assertEqual(("KA", extract_keep_alive("02180AE4")), self.registry.decode("02180AE41"))
+
+    def test_unknown_packet_id_is_counted(self):
+        self.assertIsNone(self.registry.decode("A1bb17f18198100734"))
+        self.assertEqual(1, self.registry.stats()["unknown"])
+
+    def test_malformed_payload_is_counted_as_error(self):
+        self.assertIsNone(self.registry.decode("10bb"))
+        self.assertEqual(1, self.registry.stats()["GEO"]["errors"])
+
+        log = TestLog()
+        self.assertIsNone(self.registry.decode("10bb", log=log))
+        self.assertTrue(log.return_message().startswith("Malformed GEO payload 10bb"))
+
+    def test_decode_counts_per_codec(self):
+        self.registry.decode("02180AE4")
+        self.registry.decode("02180AE4")
+        self.registry.decode("10bb17f18198100734")
+
+        stats = self.registry.stats()
+        self.assertEqual(2, stats["KA"]["count"])
+        self.assertEqual(1, stats["GEO"]["count"])
+
+    def test_model_codec_overrides_default(self):
+        registry = default_registry()
+        registry.register("02", "KA", "ka", lambda raw: {"voltage": str(KEEP_ALIVE_LAYOUT.unpack_from(raw)[1])},
+                          model="legacy")
+
+        self.assertEqual(("KA", {"voltage": "2788"}), registry.decode("02180AE4", "legacy"))
+        self.assertEqual(("KA", extract_keep_alive("02180AE4")), registry.decode("02180AE4", "other"))
+
+    def test_new_packet_type_without_touching_server(self):
+        registry = CodecRegistry()
+        registry.register("20", "TEMP", "temp", lambda raw: {"celsius": str(raw[1])})
+
+        self.assertEqual(("TEMP", {"celsius": "21"}), registry.decode("2015"))
+        self.assertEqual({"TEMP": "temp"}, registry.attributes())
@@ -0,0 +1,121 @@
+"""
+Tests for the buffered SNS publisher
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+import json
+
+from chalicelib.publisher import BatchPublisher
+from chalicelib.server import Server
+from test.test_app import TestDynamoDB, TestSNS, TestLog
+from test.test_bulk import UnreachableSNS
+
+STORE_TOPIC = "arn:aws:sns:eu-west-1:488643450383:StoreDeviceData"
+PARSER_TOPIC = "arn:aws:sns:eu-west-1:488643450383:PayloadParser"
+
+
+class PublisherTest(unittest.TestCase):
+    def setUp(self):
+        self.sns_client = TestSNS()
+        self.log = TestLog()
+
+    def test_buffers_until_flush(self):
+        publisher = BatchPublisher(self.sns_client, self.log, max_wait=60)
+        for i in range(3):
+            publisher.publish(STORE_TOPIC, "New IOT Event", str(i))
+
+        self.assertEqual(0, len(self.sns_client.batches))
+        self.assertEqual(3, publisher.pending())
+
+        publisher.flush()
+
+        self.assertEqual(1, len(self.sns_client.batches))
+        self.assertEqual(["0", "1", "2"], [entry["Message"] for entry in self.sns_client.batches[0][1]])
+        self.assertEqual(0, publisher.pending())
+
+    def test_flushes_full_batches_of_10(self):
+        publisher = BatchPublisher(self.sns_client, self.log, max_wait=60)
+        for i in range(25):
+            publisher.publish(STORE_TOPIC, "New IOT Event", str(i))
+        publisher.flush()
+
+        self.assertEqual([10, 10, 5], [len(entries) for _, entries in self.sns_client.batches])
+        self.assertEqual(0, self.sns_client.return_published_times())
+
+    def test_buffers_per_topic(self):
+        publisher = BatchPublisher(self.sns_client, self.log, max_wait=60)
+        publisher.publish(STORE_TOPIC, "New IOT Event", "a")
+        publisher.publish(PARSER_TOPIC, "New IOT Event", "b")
+        publisher.flush()
+
+        self.assertEqual(sorted([STORE_TOPIC, PARSER_TOPIC]), sorted(topic for topic, _ in self.sns_client.batches))
+
+    def test_flushes_when_size_budget_is_hit(self):
+        publisher = BatchPublisher(self.sns_client, self.log, max_bytes=100, max_wait=60)
+        publisher.publish(STORE_TOPIC, "", "x" * 60)
+        publisher.publish(STORE_TOPIC, "", "y" * 60)
+
+        self.assertEqual(1, len(self.sns_client.batches))
+        self.assertEqual(1, publisher.pending())
+
+    def test_flushes_when_time_budget_is_hit(self):
+        publisher = BatchPublisher(self.sns_client, self.log, max_wait=0)
+        publisher.publish(STORE_TOPIC, "New IOT Event", "a")
+
+        self.assertEqual(1, len(self.sns_client.batches))
+
+    def test_retries_failed_entries_individually(self):
+        sns_client = TestSNS(failed_ids=["1"])
+        publisher = BatchPublisher(sns_client, self.log, max_wait=60)
+        for i in range(3):
+            publisher.publish(STORE_TOPIC, "New IOT Event", str(i))
+        publisher.flush()
+
+        self.assertEqual(1, sns_client.return_published_times())
+        self.assertEqual("1", sns_client.return_message())
+        self.assertEqual(1, publisher.stats["retried"])
+
+    def test_failed_flush_does_not_keep_the_messages(self):
+        sns_client = UnreachableSNS()
+        publisher = BatchPublisher(sns_client, self.log, max_wait=60)
+        publisher.publish(STORE_TOPIC, "New IOT Event", "0")
+        publisher.publish(PARSER_TOPIC, "New IOT Event", "1")
+        with self.assertRaises(IOError):
+            publisher.flush()
+        self.assertEqual(0, publisher.pending())
+
+        # The next invocation of the warm container only sends its own messages
+        sns_client.reachable = True
+        publisher.publish(STORE_TOPIC, "New IOT Event", "2")
+        publisher.flush()
+        self.assertEqual([["2"]], [[entry["Message"] for entry in entries] for _, entries in sns_client.batches])
+
+    def test_failed_invocation_discards_its_messages(self):
+        class FailingGeofences:
+            def evaluate(self, parsed_events):
+                raise IOError("Geofence states unreachable")
+
+        publisher = BatchPublisher(self.sns_client, self.log, max_wait=60)
+        server = Server(TestDynamoDB(), None, self.sns_client, self.log, publisher=publisher,
+                        geofences=FailingGeofences())
+        # A low voltage keep alive, its alarm is buffered before the geofences fail
+        with self.assertRaises(IOError):
+            server.parse_events([{"virtual_tx": "A001", "timeStamp": 1499366509000, "DevEUI": "A",
+                                  "payload": "02180998"}])
+        self.assertEqual(0, publisher.pending())
+
+    def test_server_publishes_through_publisher(self):
+        publisher = BatchPublisher(self.sns_client, self.log, max_wait=60)
+        server = Server(None, None, self.sns_client, self.log, publisher=publisher)
+        data = {"virtual_tx": "A001", "DevEUI": "260113E3"}
+
+        server.publish_data_store_device(data)
+        server.publish_data_payload_parser(data)
+        server.flush_published()
+
+        self.assertEqual(2, len(self.sns_client.batches))
+        self.assertEqual(json.dumps(data), self.sns_client.batches[0][1][0]["Message"])
+        self.assertEqual(0, self.sns_client.return_published_times())
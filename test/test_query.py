@@ -0,0 +1,107 @@
+"""
+Tests for the paginated time range reads of DeviceData
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+from decimal import Decimal
+
+from chalicelib import query
+from chalicelib.payload_codecs import CODECS
+
+
+# Only understands the key condition built by query_device_data
+class TestDeviceDataTable:
+    def __init__(self, items):
+        self.items = sorted(items, key=lambda item: (item["DevEUI"], item["timeStamp"]))
+        self.queries = []
+
+    def query(self, KeyConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues,
+              ProjectionExpression, ScanIndexForward, Limit, ExclusiveStartKey=None):
+        self.queries.append(locals())
+        values = ExpressionAttributeValues
+        found = [item for item in self.items if item["DevEUI"] == values[":dev_eui"]
+                 and values[":from"] <= item["timeStamp"] <= values[":to"]]
+        if not ScanIndexForward:
+            found.reverse()
+        if ExclusiveStartKey is not None:
+            start = [item["timeStamp"] for item in found].index(ExclusiveStartKey["timeStamp"])
+            found = found[start + 1:]
+
+        fields = [ExpressionAttributeNames[name.strip()] for name in ProjectionExpression.split(",")]
+        page = [dict((field, item[field]) for field in fields if field in item) for item in found[:Limit]]
+        response = {"Items": page, "Count": len(page)}
+        if len(found) > Limit:
+            last = found[Limit - 1]
+            response["LastEvaluatedKey"] = {"DevEUI": last["DevEUI"], "timeStamp": last["timeStamp"]}
+        return response
+
+
+def stored_item(dev_eui, timestamp):
+    return {"DevEUI": dev_eui, "timeStamp": Decimal(timestamp), "payload": "02180AE4", "type": "LORA",
+            "ka": {"interval": "24", "voltage": "2.788"}, "extra": "{\"DevEUI_uplink\": {}}"}
+
+
+class QueryTest(unittest.TestCase):
+    def setUp(self):
+        items = [stored_item("A", 1000 + i) for i in range(5)] + [stored_item("B", 1002)]
+        self.table = TestDeviceDataTable(items)
+
+    def test_range_skips_extra_by_default(self):
+        result = query.query_from_params(self.table, "A", {"from": "1001", "to": "1003"})
+
+        self.assertEqual([1001, 1002, 1003], [item["timeStamp"] for item in result["items"]])
+        self.assertIsInstance(result["items"][0]["timeStamp"], int)
+        self.assertNotIn("extra", result["items"][0])
+        self.assertEqual("2.788", result["items"][0]["ka"]["voltage"])
+        self.assertIsNone(result["cursor"])
+
+    def test_default_fields_include_the_codecs_registered_at_runtime(self):
+        self.table.items[0]["temp"] = {"celsius": "21"}
+        CODECS.register("03", "TEMP", "temp", lambda raw: {"celsius": str(raw[1])})
+        try:
+            result = query.query_from_params(self.table, "A", {"from": "1000", "to": "1000"})
+        finally:
+            del CODECS.codecs[("03", None)]
+            CODECS._attributes = None
+        self.assertEqual({"celsius": "21"}, result["items"][0]["temp"])
+        self.assertNotIn("temp", query.default_fields())
+
+    def test_cursor_walks_every_page(self):
+        params = {"limit": "2"}
+        pages = []
+        while True:
+            result = query.query_from_params(self.table, "A", params)
+            pages.append([item["timeStamp"] for item in result["items"]])
+            if result["cursor"] is None:
+                break
+            params = {"limit": "2", "cursor": result["cursor"]}
+
+        self.assertEqual([[1000, 1001], [1002, 1003], [1004]], pages)
+
+    def test_newest_first_and_fields(self):
+        result = query.query_from_params(self.table, "A", {"order": "desc", "limit": "1",
+                                                           "fields": "timeStamp,extra"})
+        self.assertEqual([{"timeStamp": 1004, "extra": "{\"DevEUI_uplink\": {}}"}], result["items"])
+
+    def test_iso_dates(self):
+        start = query.parse_timestamp("2017-03-11T10:52:50.412Z", 0)
+        self.assertEqual(1489229570412, start)
+
+    def test_invalid_parameters(self):
+        cursor = query.encode_cursor({"DevEUI": "B", "timeStamp": Decimal(1002)})
+        for params in [{"limit": "0"}, {"limit": "ten"}, {"fields": "a;b"}, {"from": "yesterday"},
+                       {"from": "2000", "to": "1000"}, {"order": "up"}, {"cursor": "???"}, {"cursor": cursor}]:
+            with self.assertRaises(query.QueryError, msg=str(params)):
+                query.query_from_params(self.table, "A", params)
+        self.assertEqual([], self.table.queries)
+
+    def test_limit_is_capped(self):
+        query.query_from_params(self.table, "A", {"limit": "100000"})
+        self.assertEqual(query.MAX_LIMIT, self.table.queries[0]["Limit"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+Tests for the cached device registry and the metadata driven decoding and enrichment
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+from decimal import Decimal
+
+from chalicelib.registry import DeviceRegistry, BATCH_GET_SIZE, UNKNOWN
+from chalicelib.server import Server, CODECS
+from test.test_app import TestDynamoDB, TestLog, TestSNS
+
+
+class FailingDevices(TestDynamoDB):
+    def batch_get_item(self, RequestItems):
+        self.batch_gets += 1
+        raise Exception("ProvisionedThroughputExceededException")
+
+
+def devices_table(*devices):
+    table = TestDynamoDB("Devices")
+    for device in devices:
+        table.put_item(Item=device)
+    return table
+
+
+class DeviceRegistryTest(unittest.TestCase):
+    def test_prefetch_reads_every_device_once(self):
+        table = devices_table({"DevEUI": "A", "model": "tracker"}, {"DevEUI": "B", "owner": "acme"})
+        registry = DeviceRegistry(table, TestLog())
+
+        registry.prefetch(["A", "B", "A", "C"])
+        self.assertEqual(1, table.batch_gets)
+
+        self.assertEqual("tracker", registry.get("A")["model"])
+        self.assertEqual("acme", registry.get("B")["owner"])
+        self.assertIs(UNKNOWN, registry.get("C"))
+        self.assertEqual(1, table.batch_gets)
+        self.assertEqual(3, registry.stats["hits"])
+
+    def test_prefetch_is_chunked(self):
+        table = devices_table()
+        registry = DeviceRegistry(table, TestLog())
+        registry.prefetch(["%04X" % i for i in range(BATCH_GET_SIZE + 1)])
+        self.assertEqual(2, table.batch_gets)
+
+    def test_miss_fetches_a_single_device(self):
+        table = devices_table({"DevEUI": "A", "model": "tracker"})
+        registry = DeviceRegistry(table, TestLog())
+        self.assertEqual("tracker", registry.get("A")["model"])
+        self.assertEqual(1, registry.stats["misses"])
+        self.assertEqual(1, table.batch_gets)
+
+    def test_errors_are_cached_briefly(self):
+        table = FailingDevices("Devices")
+        registry = DeviceRegistry(table, TestLog())
+
+        self.assertIs(UNKNOWN, registry.get("A"))
+        self.assertIs(UNKNOWN, registry.get("A"))
+        self.assertEqual(1, table.batch_gets)
+
+        registry.error_ttl = -1
+        registry.cache.discard("A")
+        registry.get("A")
+        self.assertIs(UNKNOWN, registry.get("A"))
+
+        self.assertEqual(3, table.batch_gets)
+        self.assertEqual(3, registry.stats["errors"])
+
+    def test_unknown_is_read_only(self):
+        with self.assertRaises(TypeError):
+            UNKNOWN["model"] = "tracker"
+
+
+class ServerRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.device_data = TestDynamoDB()
+        self.devices = devices_table({"DevEUI": "260113E3", "model": "tracker", "owner": "acme",
+                                      "low_voltage": Decimal("2.5")})
+        self.sns = TestSNS()
+        self.server = Server(self.device_data, self.devices, self.sns, TestLog())
+
+    def test_persist_and_parse_enriches_with_one_read(self):
+        events = [{"virtual_tx": "A00%d" % i, "timeStamp": 1499366509000 + i, "DevEUI": "260113E3",
+                   "payload": "02180AE4"} for i in range(3)]
+        events.append({"virtual_tx": "B001", "timeStamp": 1499366509000, "DevEUI": "OTHER", "payload": "02180AE4"})
+
+        self.server.persist_and_parse(events)
+
+        self.assertEqual(1, self.devices.batch_gets)
+        self.assertEqual("acme", self.device_data.batch_written[0]["owner"])
+        self.assertEqual("tracker", self.device_data.batch_written[0]["model"])
+        self.assertNotIn("owner", self.device_data.batch_written[-1])
+
+    def test_enrich_keeps_the_message_fields(self):
+        event = {"DevEUI": "260113E3", "model": "from-message"}
+        self.assertEqual("from-message", self.server.enrich(event)["model"])
+        self.assertEqual("acme", self.server.enrich(event)["owner"])
+
+    def test_device_threshold_drives_the_alarm(self):
+        # 2.6V is below the default threshold but above the one of this device
+        self.server.dispatch_alarm("A001", {"DevEUI": "260113E3", "KA": {"voltage": "2.600"}})
+        self.assertEqual(0, self.server.metrics.counters.get("alarms_notified", 0))
+
+        self.server.dispatch_alarm("A002", {"DevEUI": "OTHER", "KA": {"voltage": "2.600"}})
+        self.assertEqual(1, self.server.metrics.counters["alarms_notified"])
+
+    def test_model_codec_is_used(self):
+        CODECS.register("02", "KA", "ka", lambda raw: {"tracker": raw.hex()}, model="tracker")
+        try:
+            parsed = self.server.decode({"DevEUI": "260113E3", "timeStamp": 1499366509000, "payload": "02180AE4"})
+        finally:
+            del CODECS.codecs[("02", "tracker")]
+        self.assertEqual({"tracker": "02180ae4"}, parsed["KA"])
+
+    def test_without_registry_the_defaults_apply(self):
+        server = Server(self.device_data, None, self.sns, TestLog())
+        self.assertIs(UNKNOWN, server.device("260113E3"))
+        self.assertIn("voltage", server.decode({"DevEUI": "260113E3", "timeStamp": 1499366509000, "payload": "02180AE4"})["KA"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+"""
+Tests for the hourly and daily rollups
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+import re
+from decimal import Decimal
+
+from chalicelib import rollups
+from chalicelib.publisher import BatchPublisher
+from chalicelib.query import QueryError
+from chalicelib.rollups import RollupStore, HOUR, DAY
+from chalicelib.server import Server
+from test.test_app import TestDynamoDB, TestLog, TestSNS, TestConditionalCheckFailed
+from test.test_bulk import UnreachableSNS
+
+CONDITION = re.compile(r"\(attribute_not_exists\((\w+)\) OR (\w+) ([<>]) (:\w+)\)")
+IF_NOT_EXISTS = re.compile(r"if_not_exists\((\w+), (:\w+)\)")
+
+
+# Evaluates the ADD, SET and conditions written by RollupStore
+class TestRollupTable(TestDynamoDB):
+    def __init__(self):
+        super().__init__("Rollups")
+        self.buckets = {}
+        self.writes = 0
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ConditionExpression=None,
+                    ReturnValues="NONE"):
+        self.writes += 1
+        values = ExpressionAttributeValues
+        item = self.buckets.setdefault((Key["bucket"], Key["start"]), dict(Key))
+        for name, _, operator, value in CONDITION.findall(ConditionExpression or ""):
+            if name in item and not (item[name] > values[value] if operator == ">" else item[name] < values[value]):
+                raise TestConditionalCheckFailed()
+
+        adds, _, sets = UpdateExpression.partition(" SET ")
+        if adds.startswith("SET "):
+            adds, sets = "", adds[len("SET "):]
+        for add in adds[len("ADD "):].split(", ") if adds else []:
+            name, value = add.split(" ")
+            item[name] = item.get(name, 0) + values[value]
+        for assignment in re.split(r", (?=\w+ = )", sets) if sets else []:
+            name, value = assignment.split(" = ")
+            default = IF_NOT_EXISTS.match(value)
+            if default is None:
+                item[name] = values[value]
+            elif name not in item:
+                item[name] = values[default.group(2)]
+        return {"Attributes": dict(item)} if ReturnValues == "ALL_NEW" else {}
+
+    def query(self, KeyConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues):
+        values = ExpressionAttributeValues
+        found = [item for (bucket, start), item in sorted(self.buckets.items())
+                 if bucket == values[":bucket"] and values[":from"] <= start <= values[":to"]]
+        return {"Items": found}
+
+
+def keep_alive(time_stamp, voltage, dev_eui="A"):
+    return {"DevEUI": dev_eui, "timeStamp": time_stamp, "ka": {"interval": "24", "voltage": voltage}}
+
+
+def position(time_stamp, lat, dev_eui="A"):
+    return {"DevEUI": dev_eui, "timeStamp": time_stamp, "geo": {"lat": lat, "lng": "2.1"}}
+
+
+class RollupTest(unittest.TestCase):
+    def setUp(self):
+        self.table = TestRollupTable()
+        self.rollups = RollupStore(self.table, TestLog())
+        self.day = 1515283200000
+
+    def bucket(self, resolution, start):
+        return self.table.buckets.get(("A#" + resolution, start))
+
+    def test_a_new_bucket_is_one_write(self):
+        self.rollups.update([keep_alive(self.day + 10, "2.8"), keep_alive(self.day + 20, "2.6"),
+                             position(self.day + 30, "41.1"), position(self.day + 40, "41.2")])
+
+        self.assertEqual(2, self.table.writes)
+        hour = self.bucket("hour", self.day)
+        self.assertEqual(4, hour["uplinks"])
+        self.assertEqual(2, hour["ka_count"])
+        self.assertEqual(Decimal("5.4"), hour["voltage_sum"])
+        self.assertEqual(Decimal("2.6"), hour["voltage_min"])
+        self.assertEqual(Decimal("2.8"), hour["voltage_max"])
+        self.assertEqual("41.1", hour["first_geo"]["lat"])
+        self.assertEqual("41.2", hour["last_geo"]["lat"])
+        self.assertEqual(hour["uplinks"], self.bucket("day", self.day)["uplinks"])
+
+    def test_later_batches_fix_the_extremes(self):
+        self.rollups.update([keep_alive(self.day + 10, "2.7"), position(self.day + 20, "41.1")])
+        self.rollups.update([keep_alive(self.day + 30, "2.9"), position(self.day + 40, "41.2")])
+        self.rollups.update([keep_alive(self.day + 5, "2.8"), position(self.day + 1, "41.0")])
+
+        hour = self.bucket("hour", self.day)
+        self.assertEqual(6, hour["uplinks"])
+        self.assertEqual(Decimal("2.7"), hour["voltage_min"])
+        self.assertEqual(Decimal("2.9"), hour["voltage_max"])
+        self.assertEqual(("41.0", self.day + 1), (hour["first_geo"]["lat"], hour["first_geo_ts"]))
+        self.assertEqual(("41.2", self.day + 40), (hour["last_geo"]["lat"], hour["last_geo_ts"]))
+
+    def test_buckets_by_resolution(self):
+        self.rollups.update([keep_alive(self.day + i * HOUR, "2.8") for i in range(30)])
+
+        hours = self.rollups.query("A", "hour", self.day, self.day + DAY - 1)
+        days = self.rollups.query("A", "day", self.day, self.day + 2 * DAY)
+
+        self.assertEqual(24, len(hours))
+        self.assertEqual([24, 6], [day["uplinks"] for day in days])
+
+    def test_sigfox_seconds_are_bucketed_as_milliseconds(self):
+        self.assertEqual(1515360218000, rollups.epoch_millis(1515360218))
+        self.assertEqual(1515360218000, rollups.epoch_millis(Decimal(1515360218000)))
+
+    def test_query_range_is_bounded(self):
+        with self.assertRaises(QueryError):
+            self.rollups.query("A", "hour", 0, rollups.MAX_BUCKETS * HOUR)
+
+    def test_parsing_payload_updates_the_rollups(self):
+        server = Server(TestDynamoDB(), None, TestSNS(), TestLog(), rollups=self.rollups)
+        server.persist_and_parse([{"virtual_tx": "A001", "timeStamp": self.day, "DevEUI": "A",
+                                   "payload": "02180AE4"}])
+        self.assertIsNone(self.bucket("day", self.day))
+
+        server.flush_published()
+        self.assertEqual(Decimal("2.788"), self.bucket("day", self.day)["voltage_max"])
+
+    def test_failed_alarm_dispatch_does_not_leave_rollups_behind(self):
+        sns = UnreachableSNS()
+        server = Server(TestDynamoDB(), None, sns, TestLog(), rollups=self.rollups)
+        # A low voltage keep alive, its alarm can not be published
+        uplink = {"virtual_tx": "A001", "timeStamp": self.day, "DevEUI": "A", "payload": "02180998"}
+
+        with self.assertRaises(IOError):
+            server.persist_and_parse([uplink])
+        self.assertEqual([], server.pending_rollups)
+
+        sns.reachable = True
+        server.persist_and_parse([uplink])
+        server.flush_published()
+        self.assertEqual(1, self.bucket("day", self.day)["uplinks"])
+
+    def test_rollups_of_a_failed_invocation_are_not_applied(self):
+        publisher = BatchPublisher(UnreachableSNS(), TestLog())
+        server = Server(TestDynamoDB(), None, TestSNS(), TestLog(), publisher=publisher, rollups=self.rollups)
+        server.persist_and_parse([{"virtual_tx": "A001", "timeStamp": self.day, "DevEUI": "A",
+                                   "payload": "02180AE4"}])
+        publisher.publish("arn:topic", "subject", "message")
+
+        with self.assertRaises(IOError):
+            server.flush_published()
+        self.assertIsNone(self.bucket("day", self.day))
+        server.flush_published()
+        self.assertIsNone(self.bucket("day", self.day))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+"""
+Tests for the compiled alarm rules
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+import json
+import os
+import tempfile
+
+from chalicelib.alarms import AlarmTracker
+from chalicelib.payload_codecs import CODECS
+from chalicelib.rules import RuleEngine, RuleError, compile_rules, load_rules, DEFAULT_RULES
+from chalicelib.server import Server
+from test.test_app import TestDynamoDB, TestLog, TestSNS
+
+HOUR = 3600 * 1000
+T0 = 1500000000000
+
+RULES = [{"rule_id": "low_voltage", "packet": "KA", "field": "voltage", "op": "<=", "value": 2.65,
+          "hysteresis": 0.05, "device_attribute": "low_voltage", "models": {"tracker": 2.5}},
+         {"rule_id": "voltage_drop", "type": "rate", "packet": "KA", "field": "voltage", "op": "<=",
+          "value": -0.1, "per_seconds": 3600},
+         {"rule_id": "missing_keep_alive", "type": "missing", "packet": "KA", "grace": 1.5},
+         {"rule_id": "north", "packet": "GEO", "field": "lat", "op": ">", "value": 60, "only_models": ["boat"]}]
+
+
+def keep_alive(hours, voltage, dev_eui="A", interval="1"):
+    return "vtx%d" % hours, {"DevEUI": dev_eui, "timeStamp": T0 + int(hours * HOUR),
+                                  "KA": {"interval": interval, "voltage": voltage}}
+
+
+def fired(results, rule_id=None):
+    return [(result.rule.rule_id, result.triggered, result.recovered) for result in results
+            if rule_id is None or result.rule.rule_id == rule_id]
+
+
+class RuleEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = RuleEngine(compile_rules(RULES))
+        self.devices = {"T": {"model": "tracker"}, "D": {"low_voltage": 2.9}, "B": {"model": "boat"}}
+
+    def device(self, dev_eui):
+        return self.devices.get(dev_eui, {})
+
+    def evaluate(self, *records):
+        return self.engine.evaluate(list(records), self.device)
+
+    def test_thresholds_by_device_model_and_default(self):
+        self.assertEqual([("low_voltage", True, False)], fired(self.evaluate(keep_alive(0, "2.6")), "low_voltage"))
+        self.assertEqual([("low_voltage", False, True)],
+                         fired(self.evaluate(keep_alive(0, "2.6", "T")), "low_voltage"))
+        self.assertEqual([("low_voltage", True, False)],
+                         fired(self.evaluate(keep_alive(0, "2.8", "D")), "low_voltage"))
+
+    def test_hysteresis(self):
+        self.assertEqual([("low_voltage", False, False)], fired(self.evaluate(keep_alive(0, "2.68")), "low_voltage"))
+        self.assertEqual([("low_voltage", False, True)], fired(self.evaluate(keep_alive(0, "2.71")), "low_voltage"))
+
+    def test_rate_needs_a_previous_value(self):
+        self.assertNotIn("voltage_drop", [result.rule.rule_id for result in self.evaluate(keep_alive(0, "3.0"))])
+        results = self.evaluate(keep_alive(1, "2.85"), keep_alive(4, "2.85"))
+
+        self.assertIn(("voltage_drop", True, False), fired(results[:3]))
+        self.assertIn(("voltage_drop", False, True), fired(results[3:]))
+
+    def test_an_arriving_keep_alive_only_clears_missing(self):
+        first = [result for result in self.evaluate(keep_alive(0, "3.0")) if result.rule.type == "missing"]
+        missing = [result for result in self.evaluate(keep_alive(1, "3.0"), keep_alive(4, "3.0"))
+                   if result.rule.type == "missing"]
+
+        self.assertEqual([("missing_keep_alive", False, True)], fired(first))
+        self.assertIsNone(first[0].value)
+        # 3 hours without a keep alive is overdue, but it arrived
+        self.assertEqual([("missing_keep_alive", False, True)] * 2, fired(missing))
+        self.assertEqual([3600.0, 10800.0], [result.value for result in missing])
+
+    def test_late_records_are_skipped_by_the_stateful_rules(self):
+        self.evaluate(keep_alive(1, "3.0"))
+        self.assertEqual(["low_voltage"], [result.rule.rule_id for result in self.evaluate(keep_alive(0, "3.0"))])
+
+    def test_only_the_rules_of_the_packet_are_evaluated(self):
+        position = ("vtx", {"DevEUI": "B", "timeStamp": T0, "GEO": {"lat": "61.0", "lng": "2.0"}})
+        self.assertEqual([("north", True, False)], fired(self.evaluate(position)))
+        self.assertEqual([], fired(self.evaluate(("vtx", dict(position[1], DevEUI="A")), ("vtx", None))))
+        self.assertEqual(1, self.engine.stats["evaluated"])
+
+    def test_overdue_keep_alives(self):
+        latest = [{"DevEUI": "A", "ka": {"interval": "1", "voltage": "3.0"}, "ka_ts": T0},
+                  {"DevEUI": "B", "ka": {"interval": "24", "voltage": "3.0"}, "ka_ts": T0},
+                  {"DevEUI": "C", "geo": {"lat": "1", "lng": "1"}, "geo_ts": T0}]
+        self.assertEqual(["A"], [result.dev_eui for result in self.engine.overdue(latest, T0 + 2 * HOUR, self.device)])
+
+    def test_overdue_packets_are_read_from_the_attribute_of_their_codec(self):
+        CODECS.register("04", "HB", "heartbeat", lambda raw: {"interval": str(raw[1])})
+        try:
+            engine = RuleEngine(compile_rules([{"rule_id": "missing_heartbeat", "type": "missing", "packet": "HB"}]))
+            latest = [{"DevEUI": "A", "heartbeat": {"interval": "1"}, "heartbeat_ts": T0}]
+            overdue = engine.overdue(latest, T0 + 2 * HOUR, self.device)
+        finally:
+            del CODECS.codecs[("04", None)]
+            CODECS._attributes = None
+        self.assertEqual(["A"], [result.dev_eui for result in overdue])
+
+    def test_invalid_rules(self):
+        for definitions in [[{"rule_id": "a", "op": "=", "field": "voltage", "value": 1}],
+                            [{"rule_id": "a", "type": "median"}], [{"op": "<"}],
+                            [DEFAULT_RULES[0], DEFAULT_RULES[0]]]:
+            with self.assertRaises(RuleError):
+                compile_rules(definitions)
+
+    def test_rules_file(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as rules_file:
+            json.dump(RULES, rules_file)
+        try:
+            self.assertEqual(["low_voltage", "voltage_drop", "missing_keep_alive", "north"],
+                             [rule.rule_id for rule in load_rules(rules_file.name)])
+        finally:
+            os.remove(rules_file.name)
+
+
+class ServerRulesTest(unittest.TestCase):
+    def test_new_rules_are_tagged_and_tracked(self):
+        sns = TestSNS()
+        log = TestLog()
+        server = Server(TestDynamoDB(), None, sns, log, alarms=AlarmTracker(log),
+                        rules=RuleEngine(compile_rules(RULES)))
+
+        server.dispatch_alarms([keep_alive(0, "3.0"), keep_alive(1, "2.8")])
+
+        self.assertEqual("Triggered Alarm voltage_drop A", sns.Subject)
+        message = json.loads(sns.return_message())
+        self.assertEqual("voltage_drop", message["alarm"])
+        self.assertEqual("vtx1", message["virtual_tx"])
+        self.assertEqual(1, sns.return_published_times())
+        self.assertEqual(6, server.metrics.counters["rules_evaluated"])
+
+        server.dispatch_alarms([keep_alive(2, "2.8")])
+        self.assertEqual("Cleared Alarm voltage_drop A", sns.Subject)
+        self.assertEqual(2, sns.return_published_times())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+"""
+Tests for the serialization layer, what goes on the wire must not change
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+import json
+
+from chalicelib import serialization
+from chalicelib.server import Server
+from test.test_app import TestLog, TestSNS
+from test.serialization_benchmark import UPLINK, check_compatibility
+
+
+class SerializationTest(unittest.TestCase):
+    def test_messages_are_compatible(self):
+        check_compatibility([UPLINK % i for i in range(50)])
+
+    def test_loads_matches_json(self):
+        message = json.dumps({"virtual_tx": "A001", "timeStamp": 1499366509000, "extra": "{\"a\": \"\\u00e9\"}",
+                              "rssi": -64.514969, "test": None, "list": [1, 2.5, True]})
+        self.assertEqual(json.loads(message), serialization.loads(message))
+        self.assertEqual(json.loads(message), serialization.loads(message.encode()))
+
+    def test_lora_extra_keeps_raw_body(self):
+        body = UPLINK % 412
+        self.assertIs(body, Server.parse_lora_json(body)["extra"])
+
+    def test_payload_parser_forwards_raw_message(self):
+        sns_client = TestSNS()
+        server = Server(None, None, sns_client, TestLog())
+        raw_message = json.dumps(Server.parse_lora_json(UPLINK % 412))
+
+        server.publish_data_payload_parser(serialization.loads(raw_message), raw_message)
+
+        self.assertIs(raw_message, sns_client.return_message())
@@ -0,0 +1,52 @@
+"""
+Tests for the ISO-8601 fast path, it must agree with dateutil
+
+
+@author: Eduard Cespedes Borràs
+@mail: eduard@iot-partners.com
+"""
+import unittest
+import calendar
+import random
+from datetime import datetime, timedelta
+
+from dateutil import parser
+
+from chalicelib import timestamps
+
+
+def dateutil_millis(text):
+    dt = parser.parse(text)
+    dt = dt - dt.utcoffset()
+    return calendar.timegm(dt.timetuple()) * 1000 + dt.microsecond // 1000
+
+
+class TimestampsTest(unittest.TestCase):
+    def test_network_server_format(self):
+        self.assertEqual(1489229570412, timestamps.to_epoch_millis("2017-03-11T11:52:50.412+01:00"))
+        self.assertEqual(1489229570412, timestamps.to_epoch_millis("2017-03-11T10:52:50.412Z"))
+        self.assertEqual(1489229570000, timestamps.to_epoch_millis("2017-03-11T05:52:50-05:00"))
+
+    def test_fraction_is_truncated_to_millis(self):
+        self.assertEqual(1499359309510, timestamps.to_epoch_millis("2017-07-06T18:41:49.51+02:00"))
+        self.assertEqual(1499359309519, timestamps.to_epoch_millis("2017-07-06T18:41:49.519999+02:00"))
+
+    def test_agrees_with_dateutil(self):
+        rnd = random.Random(11)
+        start = datetime(2015, 1, 1)
+        for _ in range(500):
+            dt = start + timedelta(seconds=rnd.randint(0, 10 ** 9), milliseconds=rnd.randint(0, 999))
+            minutes = rnd.choice([0, 60, 120, -300, 330, 765])
+            sign = "+" if minutes >= 0 else "-"
+            text = dt.strftime("%Y-%m-%dT%H:%M:%S.") + "%03d" % (dt.microsecond // 1000) + \
+                "%s%02d:%02d" % (sign, abs(minutes) // 60, abs(minutes) % 60)
+            self.assertEqual(dateutil_millis(text), timestamps.to_epoch_millis(text), text)
+
+    def test_other_formats_fall_back_to_dateutil(self):
+        self.assertEqual(1489229570412, timestamps.to_epoch_millis("2017-03-11 10:52:50.412 +0000"))
+        self.assertEqual(1489229570000, timestamps.to_epoch_millis("Sat, 11 Mar 2017 10:52:50 GMT"))
+        self.assertEqual(1489229570000, timestamps.to_epoch_millis("2017-03-11T10:52:50"))
+
+    def test_invalid_dates_are_rejected(self):
+        with self.assertRaises(ValueError):
+            timestamps.to_epoch_millis("2017-02-30T10:52:50Z")